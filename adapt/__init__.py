@@ -4,3 +4,5 @@ ADAPT - Adapter Detection and Processing Tool
 Copyright (c) 2023 Wiep K. van der Toorn (w.vandertoorn@fu-berlin.de)
 
 """
+
+from .detect import Detector
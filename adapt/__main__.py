@@ -7,18 +7,42 @@ Copyright (c) 2023 Wiep K. van der Toorn (w.vandertoorn@fu-berlin.de)
 
 import glob
 import os
+import shutil
 import sys
+import tempfile
 from functools import partial
 from multiprocessing import Pool
 
 import pandas as pd
 
-from .detect import detect_adapter_in_read
+from .detect import _get_read_window, detect_adapter_in_read
 from .extract import extract_adapter_from_read
-from .io import (copy_and_process_fast5_file, process_fast5_file,
-                 write_results_to_csv)
+from .io import (ErrorsWriter, ExtractedSignalWriter, ResultsWriter,
+                 RunManifest, in_file_order, load_adapter_boundaries,
+                 process_fast5_file, process_fast5_files,
+                 remove_signal_shards, watch_fast5_files,
+                 write_sliced_fast5_file)
 from .parser import parser
-from .trim import trim_adapter_from_read
+from .trim import get_trim_slice
+
+# arguments that do not change the outputs of a file, they are not part of the run manifest parameters
+RUN_ONLY_ARGS = [
+    "input_path",
+    "save_path",
+    "fast5_subset",
+    "fast5_subset_txt",
+    "j",
+    "unit_size",
+    "threads",
+    "prefetch",
+    "resume",
+    "max_errors",
+    "watch",
+    "watch_interval",
+    "watch_settle",
+    "watch_timeout",
+    "stop_file",
+]
 
 
 def main(args=None):
@@ -30,6 +54,11 @@ def main(args=None):
     os.makedirs(args.save_path, exist_ok=True)
 
     # parse files to process
+    if args.watch and (args.fast5_subset_txt is not None or args.fast5_subset is not None):
+        raise ValueError(
+            "`--watch` processes the fast5 files of `--input_path` as they are written, it can not be combined "
+            "with a fast5 subset."
+        )
     if args.fast5_subset_txt is not None:
         files_df = pd.read_csv(args.fast5_subset_txt, header=None, names=["filename"])
         files_df["src"] = files_df.filename.apply(
@@ -46,88 +75,201 @@ def main(args=None):
         fnames_src = [os.path.basename(x) for x in flist_src]
         files_df = pd.DataFrame(dict(filename=fnames_src, src=flist_src))
 
-    process_args = []
+    if len(files_df) == 0 and not args.watch:
+        raise ValueError(
+            f"Provided `--input_path`={args.input_path} contains no fast5 files."
+        )
+    if args.resume and args.global_output_csv:
+        raise ValueError(
+            "`--resume` requires per-file outputs, it can not be combined with `--global_output_csv`."
+        )
+
+    # skip the files completed by a previous run with the same parameters
+    manifest = RunManifest(
+        args.save_path,
+        {name: value for name, value in vars(args).items() if name not in RUN_ONLY_ARGS},
+        resume=args.resume,
+    )
+    if args.resume:
+        files_df = files_df.loc[[not manifest.is_complete(src) for src in files_df.src]]
+
     process_call = lambda x: None
+    unit_size = args.unit_size
+
+    detect_kwargs = {
+        "max_obs": args.max_obs,
+        "min_obs_adapter": args.min_obs_adapter,
+        "border_trim": args.border_trim,
+        "partial_read": args.partial_read,
+        "normalization": args.normalization,
+        "norm_window": args.norm_window,
+        "engine": args.engine,
+        "search": args.search,
+        "search_step": args.search_step,
+        "adaptive": args.adaptive,
+        "start_window": args.start_window,
+        "min_gain": args.min_gain,
+        "min_contrast": args.min_contrast,
+    }
+    # detection and extraction only load the signal prefix of the detection window, trim loads the full signal
+    _, prefetch_end = _get_read_window(
+        args.normalization, args.max_obs, args.norm_window, args.partial_read
+    )
+
+    if args.mode != "detect" and args.boundaries is not None:
+        # fail early on unreadable boundaries, forked worker processes inherit the loaded lookup
+        load_adapter_boundaries(args.boundaries)
 
     # execute different modes
+    shard_dir = None
     if args.mode == "trim":
-        trim_kwargs = {"buffer": args.trimming_buffer}
-
-        files_df["dst"] = files_df.src.apply(
-            lambda x: x.replace(args.input_path, args.save_path)
-        )
+        trim_kwargs = {
+            "buffer": args.trimming_buffer,
+            "boundaries": args.boundaries,
+            **detect_kwargs,
+        }
 
-        process_args = files_df[["src", "dst"]].values.tolist()
         process_call = partial(
-            copy_and_process_fast5_file,
-            process_fn=trim_adapter_from_read,
-            process_kwargs=trim_kwargs,
+            write_sliced_fast5_file,
+            slice_fn=get_trim_slice,
+            slice_kwargs=trim_kwargs,
+            threads=args.threads,
+            compression=None if args.trim_compression == "source" else args.trim_compression,
+            chunk_size=args.trim_chunk_size,
+            prefetch=args.prefetch,
+            record_errors=True,
         )
-        mp_map_fn = lambda pool_obj: pool_obj.starmap
+        # trimmed files are written by a single process, process whole files
+        unit_size = None
 
     elif args.mode == "detect":
-        detect_kwargs = {
-            "max_obs": args.max_obs,
-            "min_obs_adapter": args.min_obs_adapter,
-            "border_trim": args.border_trim,
-        }
-
-        process_args = files_df["src"].values.tolist()
         process_call = partial(
             process_fast5_file,
             mode="r",
             process_fn=detect_adapter_in_read,
             process_kwargs=detect_kwargs,
+            threads=args.threads,
+            prefetch=args.prefetch,
+            prefetch_end=prefetch_end,
+            record_errors=True,
         )
-        mp_map_fn = lambda pool_obj: pool_obj.map
 
     else:  # "extract"
         extract_kwargs = {
             "extract_buffer": args.extraction_buffer,
+            "boundaries": args.boundaries,
+            **detect_kwargs,
         }
 
-        process_args = files_df["src"].values.tolist()
+        if args.j > 1 and (args.watch or len(files_df) > 0):
+            # worker processes write the adapter signals to shard files and only send back the read metadata,
+            # the shards are copied to the output and deleted per file
+            shard_dir = tempfile.mkdtemp(prefix=".adapt_shards_", dir=args.save_path)
+
         process_call = partial(
             process_fast5_file,
             mode="r",
             process_fn=extract_adapter_from_read,
             process_kwargs=extract_kwargs,
+            threads=args.threads,
+            prefetch=args.prefetch,
+            prefetch_end=prefetch_end,
+            shard_dir=shard_dir,
+            record_errors=True,
+        )
+
+    # write the results of every file as soon as it is processed
+    remove_from_filepath = [args.save_path, args.input_path]
+    table_modes = ["detect"]
+    writers = []
+    if args.mode == "extract" and args.extract_format == "csv":
+        table_modes.append("extract")
+    elif args.mode == "extract":
+        writers.append(
+            ExtractedSignalWriter(
+                args.save_path,
+                args.extract_format,
+                remove_from_filepath,
+                args.global_output_csv,
+                args.output_format,
+            )
+        )
+    writers.append(
+        ResultsWriter(
+            args.save_path,
+            table_modes,
+            remove_from_filepath,
+            args.global_output_csv,
+            args.output_format,
         )
-        mp_map_fn = lambda pool_obj: pool_obj.map
+    )
+    # reads and files that fail to process are recorded, the other reads and files are processed
+    errors_writer = ErrorsWriter(args.save_path, remove_from_filepath, resume=args.resume)
 
-    if len(process_args) > 1:
-        with Pool(args.j) as p:
-            res = mp_map_fn(p)(
-                process_call, process_args
-            )  # list (files) of lists (processResults)
+    # in watch mode, the worker processes are kept for the files of every poll
+    pool = Pool(args.j) if args.watch and args.j > 1 else None
 
-    elif len(process_args) == 1:
-        if type(process_args[0]) == list:
-            res = [process_call(*process_args[0])]
+    def process_files(srcs):
+        if args.mode == "trim":
+            process_args = [[src, src.replace(args.input_path, args.save_path)] for src in srcs]
         else:
-            res = [process_call(process_args[0])]
-    else:
-        raise ValueError(
-            f"Provided `--input_path`={args.input_path} contains no fast5 files."
+            process_args = [[src] for src in srcs]
+
+        results = process_fast5_files(
+            process_call,
+            process_args,
+            srcs,
+            processes=args.j,
+            unit_size=unit_size,
+            record_errors=True,
+            pool=pool,
         )
+        if args.global_output_csv:
+            # per-file outputs are written as the files complete, the global outputs keep the file order
+            results = in_file_order(results)
 
-    # save results
-    write_results_to_csv(
-        res,
-        args.save_path,
-        "detect",
-        [args.save_path, args.input_path],
-        args.global_output_csv,
-    )
+        for i, file_res in results:
+            outputs = []
+            for writer in writers:
+                outputs.extend(writer.write(file_res))
+            if args.mode == "trim":
+                outputs.append(process_args[i][1])
+            remove_signal_shards(file_res)
 
-    if args.mode == "extract":
-        write_results_to_csv(
-            res,
-            args.save_path,
-            "extract",
-            [args.save_path, args.input_path],
-            args.global_output_csv,
-        )
+            errors_writer.write(file_res.errors)
+            if all(error.read_id is not None for error in file_res.errors):
+                # files that failed as a whole are not complete, they are processed again on resume
+                manifest.record(process_args[i][0], outputs, len(file_res.errors))
+
+            if args.max_errors is not None and errors_writer.n_errors > args.max_errors:
+                raise RuntimeError(
+                    f"{errors_writer.n_errors} reads and files failed to process, more than "
+                    f"`--max_errors`={args.max_errors}, see {errors_writer.path}."
+                )
+
+    try:
+        if not args.watch:
+            process_files(files_df["src"].tolist())
+        else:
+            for srcs in watch_fast5_files(
+                args.input_path,
+                args.watch_interval,
+                args.watch_settle,
+                args.watch_timeout,
+                args.stop_file,
+            ):
+                if args.resume:
+                    srcs = [src for src in srcs if not manifest.is_complete(src)]
+                process_files(srcs)
+    finally:
+        for writer in writers:
+            writer.close()
+        errors_writer.close()
+        manifest.close()
+        if pool is not None:
+            pool.terminate()
+        if shard_dir is not None:
+            shutil.rmtree(shard_dir, ignore_errors=True)
 
 
 if __name__ == "__main__":
@@ -15,7 +15,15 @@ cimport cython
 import numpy as np
 
 cimport numpy as np
-from libc.math cimport log
+from libc.math cimport isnan, log, NAN
+from cython.parallel cimport parallel, prange
+from libc.stdlib cimport calloc, free, malloc
+
+from ._c_normalize cimport _normalize_int16
+
+
+cdef extern from "<algorithm>" namespace "std" nogil:
+	void nth_element[Iter](Iter first, Iter nth, Iter last)
 
 DTYPE = np.float64
 ctypedef np.float64_t DTYPE_t
@@ -24,9 +32,10 @@ DTYPE_INT = np.int64
 ctypedef np.int64_t DTYPE_INT_t
 
 # Calculate the variance of a segment of signal, given cumsum and cumsum of squared signal.
+@cython.cdivision(True)
 @cython.boundscheck(False)
 cdef inline double var_c(DTYPE_INT_t start, DTYPE_INT_t end, 
-						 DTYPE_t[:] c, DTYPE_t[:] c2):
+						 const DTYPE_t* c, const DTYPE_t* c2) noexcept nogil:
 	"""
 	Adapted from https://github.com/jmschrei/PyPore/blob/master/PyPore/cparsers.pyx
 
@@ -41,32 +50,202 @@ cdef inline double var_c(DTYPE_INT_t start, DTYPE_INT_t end,
 		return c2[end-1]/end - (c[end-1]/end) ** 2
 	return (c2[end-1]-c2[start-1])/(end-start) - ((c[end-1]-c[start-1])/(end-start)) ** 2
 
-# find single best split based on maximal LLR
-def _best_split(DTYPE_INT_t start, 
-				DTYPE_INT_t end, 
-				np.ndarray[DTYPE_t] c, 
-				np.ndarray[DTYPE_t] c2, 
-				DTYPE_INT_t offset_head, 
-				DTYPE_INT_t offset_tail):
+# find single best split based on maximal LLR among the split positions `lo, lo + stride, ...` below `hi`,
+# summed log-variance terms of the head and/or tail segments are taken from `head_terms` and `tail_terms` 
+# if given (indexed by split position)
+@cython.boundscheck(False)
+cdef inline DTYPE_INT_t _scan_split(DTYPE_INT_t start, 
+									DTYPE_INT_t end, 
+									const DTYPE_t* c, 
+									const DTYPE_t* c2, 
+									DTYPE_INT_t lo, 
+									DTYPE_INT_t hi,
+									DTYPE_INT_t stride,
+									const DTYPE_t* head_terms,
+									const DTYPE_t* tail_terms,
+									DTYPE_t* split_gain) noexcept nogil:
 	
 	cdef DTYPE_t var_summed
 	cdef DTYPE_t var_summed_head
 	cdef DTYPE_t var_summed_tail
 	cdef DTYPE_t gain
-	cdef DTYPE_t split_gain = 0.
 	cdef DTYPE_INT_t x = -1
 	cdef DTYPE_INT_t i
+
+	split_gain[0] = 0.
 	
 	var_summed = ( end-start ) * log( var_c( start, end, c, c2))
-	for i in range( start + offset_head, end - offset_tail):
-		var_summed_head = ( i-start ) * log( var_c( start, i, c, c2 ) )
-		var_summed_tail = ( end-i ) * log( var_c( i, end, c, c2 ) )
+	i = lo
+	while i < hi:
+		if head_terms != NULL:
+			var_summed_head = head_terms[i]
+		else:
+			var_summed_head = ( i-start ) * log( var_c( start, i, c, c2 ) )
+		if tail_terms != NULL:
+			var_summed_tail = tail_terms[i]
+		else:
+			var_summed_tail = ( end-i ) * log( var_c( i, end, c, c2 ) )
 		gain = var_summed-( var_summed_head+var_summed_tail )
-		if gain > split_gain:
-			split_gain = gain
+		if gain > split_gain[0]:
+			split_gain[0] = gain
 			x = i
+		i += stride
 	
-	return x, split_gain
+	return x
+
+# find single best split based on maximal LLR. For `step` > 1 only every `step`-th split position is 
+# evaluated, the best of which is refined at full resolution within `step` positions on either side
+cdef inline DTYPE_INT_t _best_split_c(DTYPE_INT_t start, 
+									  DTYPE_INT_t end, 
+									  const DTYPE_t* c, 
+									  const DTYPE_t* c2, 
+									  DTYPE_INT_t offset_head, 
+									  DTYPE_INT_t offset_tail,
+									  DTYPE_INT_t step,
+									  const DTYPE_t* head_terms,
+									  const DTYPE_t* tail_terms,
+									  DTYPE_t* split_gain) noexcept nogil:
+
+	cdef DTYPE_INT_t lo = start + offset_head
+	cdef DTYPE_INT_t hi = end - offset_tail
+	cdef DTYPE_INT_t x
+
+	if step <= 1:
+		return _scan_split(start, end, c, c2, lo, hi, 1, head_terms, tail_terms, split_gain)
+
+	x = _scan_split(start, end, c, c2, lo, hi, step, head_terms, tail_terms, split_gain)
+	if x == -1:
+		return x
+	return _scan_split(start, end, c, c2, max(lo, x - step + 1), min(hi, x + step), 1,
+					   head_terms, tail_terms, split_gain)
+
+# median of `signal[start:end]`, uses `buffer` as scratch space, returns NaN if the segment contains NaN
+@cython.cdivision(True)
+@cython.boundscheck(False)
+cdef inline double _median(const DTYPE_t* signal, 
+						   DTYPE_INT_t start, 
+						   DTYPE_INT_t end, 
+						   DTYPE_t* buffer) noexcept nogil:
+	
+	cdef DTYPE_INT_t n = end - start
+	cdef DTYPE_INT_t k = n // 2
+	cdef DTYPE_INT_t i
+	cdef DTYPE_t low
+
+	if n <= 0:
+		return NAN
+	for i in range(n):
+		buffer[i] = signal[start + i]
+		if isnan(buffer[i]):
+			return NAN
+
+	nth_element(buffer, buffer + k, buffer + n)
+	if n % 2:
+		return buffer[k]
+
+	low = buffer[0]
+	for i in range(1, k):
+		if buffer[i] > low:
+			low = buffer[i]
+	return (low + buffer[k]) / 2
+
+# detect the adapter boundaries in `raw_signal[:n]`, `work` should hold at least 2 * n values.
+# For `step` > 1 the splits are searched coarse-to-fine, see `_best_split_c`.
+# If `stats` is not NULL, the split gain and median contrast of the detected adapter are written to
+# `stats[0]` and `stats[1]` (both 0 if no adapter is found)
+@cython.boundscheck(False)
+cdef void _llr_detect_adapter(const DTYPE_t* raw_signal,
+							  DTYPE_INT_t n,
+							  const DTYPE_t* c, 
+							  const DTYPE_t* c2,
+							  DTYPE_INT_t min_obs_adapter,
+							  DTYPE_INT_t border_trim,
+							  DTYPE_INT_t step,
+							  DTYPE_t* work,
+							  DTYPE_INT_t* start,
+							  DTYPE_INT_t* stop,
+							  DTYPE_t* stats) noexcept nogil:
+
+	cdef DTYPE_INT_t x_first = 0
+	cdef DTYPE_INT_t x_head = 0
+	cdef DTYPE_INT_t x_tail = 0
+	cdef DTYPE_INT_t length = n - 1
+	cdef DTYPE_INT_t i
+	cdef DTYPE_t gain_first = 0.
+	cdef DTYPE_t gain_head = 0.
+	cdef DTYPE_t gain_tail = 0.
+	cdef DTYPE_t medians[4]
+	cdef DTYPE_t diffs[3]
+
+	# summed log-variance of the segments [0, i) and [i, length), shared between the first split and the
+	# head and tail splits respectively. Only precomputed for the exhaustive search
+	cdef DTYPE_t* prefix_terms = NULL
+	cdef DTYPE_t* suffix_terms = NULL
+
+	start[0] = 0
+	stop[0] = 0
+	if stats != NULL:
+		stats[0] = 0.
+		stats[1] = 0.
+
+	if step <= 1:
+		prefix_terms = work
+		suffix_terms = work + n
+		for i in range(border_trim, length - border_trim):
+			prefix_terms[i] = i * log( var_c( 0, i, c, c2 ) )
+		for i in range(min_obs_adapter + border_trim, length - border_trim):
+			suffix_terms[i] = ( length-i ) * log( var_c( i, length, c, c2 ) )
+
+	x_first = _best_split_c(0, length, c, c2, min_obs_adapter + border_trim, border_trim, step,
+							prefix_terms, suffix_terms, &gain_first)
+	if x_first == -1:
+		# empty signal
+		return
+
+	x_head = _best_split_c(0, x_first, c, c2, border_trim, min_obs_adapter, step,
+						   prefix_terms, NULL, &gain_head)
+	x_tail = _best_split_c(x_first, length, c, c2, min_obs_adapter, border_trim, step,
+						   NULL, suffix_terms, &gain_tail)
+
+	if x_head == -1:
+		#x_first - border_trim - min_obs_adapter == 0
+		x_head = 1
+	if x_tail == -1:
+		#(length - x_first) - border_trim - min_obs_adapter == 0
+		x_tail = x_first+1
+
+	# the split terms are no longer needed, reuse `work` as scratch space for the medians
+	medians[0] = _median(raw_signal, 0, x_head, work)
+	medians[1] = _median(raw_signal, x_head, x_first, work)
+	medians[2] = _median(raw_signal, x_first, x_tail, work)
+	medians[3] = _median(raw_signal, x_tail, n, work)
+
+	for i in range(3):
+		diffs[i] = medians[i + 1] - medians[i]
+
+	# use fact that adapter represents a drop in pA space
+	# TODO: this might be too strict, leading to many failed detections
+
+	if gain_head > gain_tail and diffs[0] < 0 and diffs[1] > 0:
+		start[0] = x_head
+		stop[0] = x_first
+		if stats != NULL:
+			stats[0] = gain_head
+			stats[1] = min(-diffs[0], diffs[1])
+	# poly-A on 5` side of adapter` is detected as segment and has low variance
+	elif diffs[0] < 0 and diffs[1] > 0 and var_c( x_head, x_first, c, c2)  > var_c( x_first, x_tail, c, c2):
+		start[0] = x_head
+		stop[0] = x_first
+		if stats != NULL:
+			stats[0] = gain_head
+			stats[1] = min(-diffs[0], diffs[1])
+	elif  gain_tail > gain_head and diffs[1] < 0 and diffs[2] > 0:
+		start[0] = x_first
+		stop[0] = x_tail
+		if stats != NULL:
+			stats[0] = gain_tail
+			stats[1] = min(-diffs[1], diffs[2])
+	# segment not found
 
 # return all LLR's 
 def _gains(DTYPE_INT_t start, 
@@ -83,66 +262,196 @@ def _gains(DTYPE_INT_t start,
 
 	cdef np.ndarray[DTYPE_t] gains = np.zeros_like(c)
 	
-	var_summed = ( end-start ) * log( var_c( start, end, c, c2))
+	var_summed = ( end-start ) * log( var_c( start, end, &c[0], &c2[0]))
 	for i in range( start + offset_head, end - offset_tail):
-		var_summed_head = ( i-start ) * log( var_c( start, i, c, c2 ) )
-		var_summed_tail = ( end-i ) * log( var_c( i, end, c, c2 ) )
+		var_summed_head = ( i-start ) * log( var_c( start, i, &c[0], &c2[0] ) )
+		var_summed_tail = ( end-i ) * log( var_c( i, end, &c[0], &c2[0] ) )
 		gains[i] = var_summed-( var_summed_head+var_summed_tail )
 	
 	return gains
 
 
-def c_llr_detect_adapter(np.ndarray[DTYPE_t] raw_signal, 
-						 DTYPE_INT_t min_obs_adapter,
-						 DTYPE_INT_t border_trim):
+# cumsum of signal and of squared signal, equal to np.cumsum( signal ) and np.cumsum( np.multiply( signal, signal ) )
+@cython.boundscheck(False)
+cdef inline void _cumsums(const DTYPE_t* signal, 
+						  DTYPE_INT_t n, 
+						  DTYPE_t* c, 
+						  DTYPE_t* c2) noexcept nogil:
+	cdef DTYPE_INT_t i
+	cdef DTYPE_t sq
+	if n == 0:
+		return
+	c[0] = signal[0]
+	c2[0] = signal[0] * signal[0]
+	for i in range(1, n):
+		sq = signal[i] * signal[i]
+		c[i] = c[i-1] + signal[i]
+		c2[i] = c2[i-1] + sq
+
+# detect the adapter boundaries in `signal[:n]`, `work` should hold at least 4 * n values
+cdef inline void _llr_detect_adapter_nogil(const DTYPE_t* signal,
+										   DTYPE_INT_t n,
+										   DTYPE_INT_t min_obs_adapter,
+										   DTYPE_INT_t border_trim,
+										   DTYPE_INT_t step,
+										   DTYPE_t* work,
+										   DTYPE_INT_t* start,
+										   DTYPE_INT_t* stop,
+										   DTYPE_t* stats) noexcept nogil:
+	start[0] = 0
+	stop[0] = 0
+	if stats != NULL:
+		stats[0] = 0.
+		stats[1] = 0.
+	if n < 2:
+		# empty signal
+		return
+	_cumsums(signal, n, work, work + n)
+	_llr_detect_adapter(signal, n, work, work + n, min_obs_adapter, border_trim, step,
+						work + 2 * n, start, stop, stats)
 
-	cdef np.ndarray[DTYPE_t] c = np.cumsum( raw_signal )
-	cdef np.ndarray[DTYPE_t] c2 = np.cumsum( np.multiply( raw_signal, raw_signal ) )
 
-	cdef DTYPE_INT_t x_first = 0
-	cdef DTYPE_INT_t x_head = 0
-	cdef DTYPE_INT_t x_tail = 0
-	cdef DTYPE_INT_t length = len(raw_signal ) - 1
-	cdef DTYPE_t gain_head = 0.
-	cdef DTYPE_t gain_tail = 0.
+# return `work` if it holds at least 4 * n values, a new work buffer if `work` is None
+cdef DTYPE_t[::1] _work_buffer(DTYPE_t[::1] work, DTYPE_INT_t n):
+	if work is None:
+		return np.empty(4 * n, dtype=DTYPE)
+	if work.shape[0] < 4 * n:
+		raise ValueError(f"`work` should hold at least 4 * {n} values, got {work.shape[0]}.")
+	return work
 
-	x_first, _ = _best_split(0, length, c, c2, min_obs_adapter + border_trim, border_trim)
-	x_head, gain_head = _best_split(0, x_first, c, c2, border_trim, min_obs_adapter)
-	x_tail, gain_tail = _best_split(x_first, length, c, c2, min_obs_adapter, border_trim)
 
-	if x_first == -1:
+def c_llr_detect_adapter(const DTYPE_t[::1] raw_signal, 
+						 DTYPE_INT_t min_obs_adapter,
+						 DTYPE_INT_t border_trim,
+						 DTYPE_INT_t step = 1,
+						 DTYPE_t[::1] work = None):
+	"""Detect the adapter boundaries in `raw_signal`, returns (start, stop). The GIL is released during detection.
+	For `step` > 1 the boundaries are searched coarse-to-fine: only every `step`-th position is evaluated and the
+	best one is refined at full resolution. `work` is an optional work buffer of at least 4 * `raw_signal.size`
+	values, a new one is allocated if None."""
+
+	cdef DTYPE_INT_t n = raw_signal.shape[0]
+	cdef DTYPE_INT_t start = 0
+	cdef DTYPE_INT_t stop = 0
+
+	if n < 2:
 		# empty signal
 		return 0,0
-	if x_head == -1:
-		#x_first - border_trim - min_obs_adapter == 0
-		x_head = 1
-	if x_tail == -1:
-		#(length - x_first) - border_trim - min_obs_adapter == 0
-		x_tail = x_first+1
 
-		
-	cdef np.ndarray[DTYPE_t] medians = np.zeros(4)
-	medians[0] = np.median(raw_signal[:x_head])
-	medians[1] = np.median(raw_signal[x_head: x_first])
-	medians[2] = np.median(raw_signal[x_first:x_tail])
-	medians[3] = np.median(raw_signal[x_tail:])
+	work = _work_buffer(work, n)
+	with nogil:
+		_llr_detect_adapter_nogil(&raw_signal[0], n, min_obs_adapter, border_trim, step,
+								  &work[0], &start, &stop, NULL)
 
-	
-	cdef np.ndarray[DTYPE_t] diffs = np.diff(medians)
+	return start, stop
 
-	# use fact that adapter represents a drop in pA space
-	# TODO: this might be too strict, leading to many failed detections
 
-	if gain_head > gain_tail and diffs[0] < 0 and diffs[1] > 0:
-		return x_head, x_first 
-	# poly-A on 5` side of adapter` is detected as segment and has low variance
-	elif diffs[0] < 0 and diffs[1] > 0 and var_c( x_head, x_first, c, c2)  > var_c( x_first, x_tail, c, c2):
-		return x_head, x_first  
-	elif  gain_tail > gain_head and diffs[1] < 0 and diffs[2] > 0:
-		return x_first, x_tail 
-	# segment not found
-	else:
-		return 0,0
+def c_llr_detect_adapter_stats(const DTYPE_t[::1] raw_signal, 
+							   DTYPE_INT_t min_obs_adapter,
+							   DTYPE_INT_t border_trim,
+							   DTYPE_INT_t step = 1,
+							   DTYPE_t[::1] work = None):
+	"""Detect the adapter boundaries in `raw_signal` like `c_llr_detect_adapter`, returns (start, stop, gain, contrast).
+	`gain` is the LLR gain of the split that delimits the adapter and `contrast` the smallest difference between the
+	adapter median and the medians of its neighbouring segments. Both are 0 if no adapter is found."""
+
+	cdef DTYPE_INT_t n = raw_signal.shape[0]
+	cdef DTYPE_INT_t start = 0
+	cdef DTYPE_INT_t stop = 0
+	cdef DTYPE_t stats[2]
+
+	if n < 2:
+		# empty signal
+		return 0, 0, 0., 0.
+
+	work = _work_buffer(work, n)
+	with nogil:
+		_llr_detect_adapter_nogil(&raw_signal[0], n, min_obs_adapter, border_trim, step,
+								  &work[0], &start, &stop, stats)
+
+	return start, stop, stats[0], stats[1]
+
+
+ctypedef fused signal_t:
+	np.int16_t
+	DTYPE_t
+
+# one bin per int16 value, see `adapt._c_normalize`
+cdef Py_ssize_t HIST_SIZE = 65536
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def c_llr_detect_adapter_batch(const signal_t[::1] signals,
+							   const DTYPE_INT_t[::1] offsets,
+							   DTYPE_INT_t min_obs_adapter,
+							   DTYPE_INT_t border_trim,
+							   DTYPE_INT_t max_obs,
+							   DTYPE_INT_t norm_window,
+							   double outlier_thresh,
+							   DTYPE_INT_t step,
+							   int num_threads):
+	"""Detect the adapter boundaries of the reads `signals[offsets[i]:offsets[i+1]]` in parallel, returns 
+	an (N, 2) array of (start, stop). int16 signals are normalized first, using the statistics of the first 
+	`norm_window` data points of each read (full read if `norm_window` < 1). Only the first `max_obs` data
+	points of each read are normalized and searched. For `step` > 1 the boundaries are searched coarse-to-fine."""
+
+	cdef Py_ssize_t n_reads = offsets.shape[0] - 1
+	cdef np.ndarray[DTYPE_INT_t, ndim=2, mode="c"] boundaries = np.zeros((max(n_reads, 0), 2), dtype=DTYPE_INT)
+	cdef DTYPE_INT_t[:, ::1] res = boundaries
+	cdef DTYPE_INT_t max_len = 0
+	cdef DTYPE_INT_t n
+	cdef DTYPE_INT_t n_stats
+	cdef Py_ssize_t i
+	cdef DTYPE_t* work = NULL
+	cdef DTYPE_t* norm_signal = NULL
+	cdef DTYPE_INT_t* hist = NULL
+	# set by the threads that fail to allocate their buffers, shared as it is only written through the pointer
+	cdef int alloc_failed = 0
+	cdef int* alloc_failed_ptr = &alloc_failed
+
+	if n_reads < 1:
+		return boundaries
+	for i in range(n_reads):
+		if offsets[i] < 0 or offsets[i] > offsets[i+1] or offsets[i+1] > signals.shape[0]:
+			raise ValueError("`offsets` should be non-decreasing and within the bounds of `signals`.")
+		max_len = max(max_len, min(offsets[i+1] - offsets[i], max_obs))
+
+	with nogil, parallel(num_threads=num_threads):
+		work = NULL
+		norm_signal = NULL
+		hist = NULL
+		work = <DTYPE_t*> malloc(4 * max_len * sizeof(DTYPE_t))
+		if work == NULL:
+			alloc_failed_ptr[0] = 1
+		if signal_t is np.int16_t:
+			norm_signal = <DTYPE_t*> malloc(max_len * sizeof(DTYPE_t))
+			hist = <DTYPE_INT_t*> calloc(HIST_SIZE, sizeof(DTYPE_INT_t))
+			if norm_signal == NULL or hist == NULL:
+				alloc_failed_ptr[0] = 1
+
+		for i in prange(n_reads, schedule="dynamic"):
+			n = min(offsets[i+1] - offsets[i], max_obs)
+			# a thread without buffers can not process reads, the others stop early
+			if n < 2 or alloc_failed_ptr[0]:
+				continue
+			if signal_t is np.int16_t:
+				n_stats = offsets[i+1] - offsets[i]
+				if norm_window > 0:
+					n_stats = min(n_stats, norm_window)
+				_normalize_int16(&signals[offsets[i]], n_stats, n, outlier_thresh, norm_signal, hist)
+				_llr_detect_adapter_nogil(norm_signal, n, min_obs_adapter, border_trim, step,
+										  work, &res[i, 0], &res[i, 1], NULL)
+			else:
+				_llr_detect_adapter_nogil(&signals[offsets[i]], n, min_obs_adapter, border_trim, step,
+										  work, &res[i, 0], &res[i, 1], NULL)
+
+		free(work)
+		free(norm_signal)
+		free(hist)
+
+	if alloc_failed:
+		raise MemoryError(f"Could not allocate the detection buffers for reads of up to {max_len} data points.")
+	return boundaries
 
 
 def c_llr_detect_adapter_trace(np.ndarray[DTYPE_t] raw_signal, 
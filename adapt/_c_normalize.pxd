@@ -0,0 +1,5 @@
+cimport numpy as np
+
+
+cdef void _normalize_int16(const np.int16_t* signal, Py_ssize_t n_stats, Py_ssize_t n_out,
+						   double outlier_thresh, double* out, np.int64_t* hist) noexcept nogil
@@ -0,0 +1,208 @@
+"""
+ADAPT - Adapter Detection and Processing Tool
+
+Copyright (c) 2023 Wiep K. van der Toorn (w.vandertoorn@fu-berlin.de)
+
+"""
+
+
+#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
+
+cimport cython
+
+import numpy as np
+
+cimport numpy as np
+from libc.math cimport fabs
+from libc.stdlib cimport calloc, free
+from libc.string cimport memset
+
+DTYPE = np.float64
+ctypedef np.float64_t DTYPE_t
+
+DTYPE_INT = np.int64
+ctypedef np.int64_t DTYPE_INT_t
+
+# one bin per int16 value, value v is counted in bin v + HIST_OFFSET
+HIST_SIZE = 65536
+cdef Py_ssize_t HIST_OFFSET = 32768
+
+
+# Count the int16 values in `signal[:n]`, returns the lowest and highest non-empty bin.
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _count(const np.int16_t* signal, Py_ssize_t n, DTYPE_INT_t* hist,
+						Py_ssize_t* lo, Py_ssize_t* hi) noexcept nogil:
+	cdef Py_ssize_t i
+	cdef Py_ssize_t b
+	lo[0] = HIST_OFFSET * 2
+	hi[0] = -1
+	for i in range(n):
+		b = signal[i] + HIST_OFFSET
+		hist[b] += 1
+		if b < lo[0]:
+			lo[0] = b
+		if b > hi[0]:
+			hi[0] = b
+
+
+# Find the values at rank (n-1)//2 and n//2 of the histogram (the median pair).
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _median_pair(const DTYPE_INT_t* hist, Py_ssize_t lo, Py_ssize_t hi, Py_ssize_t n,
+							  Py_ssize_t* v_low, Py_ssize_t* v_high) noexcept nogil:
+	cdef Py_ssize_t k_low = (n - 1) // 2
+	cdef Py_ssize_t k_high = n // 2
+	cdef Py_ssize_t cum = 0
+	cdef Py_ssize_t b
+	cdef bint found_low = False
+	for b in range(lo, hi + 1):
+		cum += hist[b]
+		if cum > k_low and not found_low:
+			v_low[0] = b
+			found_low = True
+		if cum > k_high:
+			v_high[0] = b
+			return
+
+
+# Median of |(v - shift) / scale - center| over all values v in the histogram.
+# Values (v - shift) / scale - center are non-decreasing in v (also in floating point), so the
+# absolute deviations are ordered by merging the bins below and above the sign change.
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline double _abs_dev_median(const DTYPE_INT_t* hist, Py_ssize_t lo, Py_ssize_t hi, Py_ssize_t n,
+								   double shift, double scale, double center) noexcept nogil:
+	cdef Py_ssize_t k_low = (n - 1) // 2
+	cdef Py_ssize_t k_high = n // 2
+	cdef Py_ssize_t cum = 0
+	cdef Py_ssize_t left
+	cdef Py_ssize_t right = lo
+	cdef double d_left
+	cdef double d_right
+	cdef double d
+	cdef double d_low = 0.
+	cdef bint found_low = False
+
+	while right <= hi and (right - HIST_OFFSET - shift) / scale - center < 0:
+		right += 1
+	left = right - 1
+
+	while True:
+		while left >= lo and hist[left] == 0:
+			left -= 1
+		while right <= hi and hist[right] == 0:
+			right += 1
+
+		if left >= lo:
+			d_left = fabs((left - HIST_OFFSET - shift) / scale - center)
+		if right <= hi:
+			d_right = fabs((right - HIST_OFFSET - shift) / scale - center)
+
+		if right > hi or (left >= lo and d_left < d_right):
+			d = d_left
+			cum += hist[left]
+			left -= 1
+		else:
+			d = d_right
+			cum += hist[right]
+			right += 1
+
+		if cum > k_low and not found_low:
+			d_low = d
+			found_low = True
+		if cum > k_high:
+			if n % 2:
+				return d
+			return (d_low + d) / 2
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _normalize_int16(const np.int16_t* signal, Py_ssize_t n_stats, Py_ssize_t n_out,
+						   double outlier_thresh, double* out, DTYPE_INT_t* hist) noexcept nogil:
+	cdef Py_ssize_t lo
+	cdef Py_ssize_t hi
+	cdef Py_ssize_t v_low
+	cdef Py_ssize_t v_high
+	cdef Py_ssize_t i
+	cdef double shift
+	cdef double scale
+	cdef double read_med
+	cdef double read_mad
+	cdef double lower_lim
+	cdef double upper_lim
+	cdef double x
+
+	_count(signal, n_stats, hist, &lo, &hi)
+
+	_median_pair(hist, lo, hi, n_stats, &v_low, &v_high)
+	if n_stats % 2:
+		shift = <double>(v_low - HIST_OFFSET)
+	else:
+		shift = (<double>(v_low - HIST_OFFSET) + <double>(v_high - HIST_OFFSET)) / 2
+	scale = _abs_dev_median(hist, lo, hi, n_stats, shift, 1., 0.)
+
+	if scale == 0:
+		# all statistics of the normalized signal are NaN, no windsorizing
+		for i in range(n_out):
+			out[i] = (signal[i] - shift) / scale
+		memset(hist + lo, 0, (hi - lo + 1) * sizeof(DTYPE_INT_t))
+		return
+
+	# normalization is monotone, the median pair of the normalized signal maps from the raw median pair
+	if n_stats % 2:
+		read_med = (v_low - HIST_OFFSET - shift) / scale
+	else:
+		read_med = ((v_low - HIST_OFFSET - shift) / scale + (v_high - HIST_OFFSET - shift) / scale) / 2
+	read_mad = _abs_dev_median(hist, lo, hi, n_stats, shift, scale, read_med)
+	lower_lim = read_med - (read_mad * outlier_thresh)
+	upper_lim = read_med + (read_mad * outlier_thresh)
+
+	for i in range(n_out):
+		x = (signal[i] - shift) / scale
+		if x < lower_lim:
+			x = lower_lim
+		if x > upper_lim:
+			x = upper_lim
+		out[i] = x
+
+	memset(hist + lo, 0, (hi - lo + 1) * sizeof(DTYPE_INT_t))
+
+
+def c_normalize_int16(const np.int16_t[::1] signal,
+					  DTYPE_INT_t n_stats,
+					  double outlier_thresh,
+					  DTYPE_t[::1] out,
+					  DTYPE_INT_t[::1] hist = None):
+	"""MED/MAD normalization with windsorizing of int16 signal, computed with exact histogram statistics.
+
+	Statistics are computed over `signal[:n_stats]`, the normalized `signal[:out.size]` is written to `out`.
+	`hist` is an optional zero-filled work buffer of size `HIST_SIZE`, it is zero-filled again on return.
+	"""
+	cdef Py_ssize_t n_out = out.shape[0]
+	cdef DTYPE_INT_t* hist_ptr
+
+	if n_stats < 1 or n_stats > signal.shape[0]:
+		raise ValueError(f"`n_stats` should be between 1 and the signal length, got {n_stats}.")
+	if n_out > signal.shape[0]:
+		raise ValueError("`out` is larger than the signal.")
+	if hist is not None and hist.shape[0] != HIST_SIZE:
+		raise ValueError(f"`hist` should have size {HIST_SIZE}.")
+
+	if hist is None:
+		hist_ptr = <DTYPE_INT_t*> calloc(HIST_SIZE, sizeof(DTYPE_INT_t))
+		if hist_ptr == NULL:
+			raise MemoryError()
+	else:
+		hist_ptr = &hist[0]
+
+	with nogil:
+		_normalize_int16(&signal[0], n_stats, n_out, outlier_thresh,
+						 &out[0] if n_out else NULL, hist_ptr)
+
+	if hist is None:
+		free(hist_ptr)
@@ -0,0 +1,164 @@
+"""
+ADAPT - Adapter Detection and Processing Tool
+
+Copyright (c) 2023 Wiep K. van der Toorn (w.vandertoorn@fu-berlin.de)
+
+"""
+
+
+from typing import Tuple, Union
+
+import numpy as np
+
+
+def _var(
+    start: Union[int, np.ndarray],
+    end: Union[int, np.ndarray],
+    c: np.ndarray,
+    c2: np.ndarray,
+) -> np.ndarray:
+    """Variance of the segments `[start, end)` of a signal, given the cumsum and the cumsum of the
+    squared signal. Vectorized version of `var_c` in `adapt._c_llr_segmentation`."""
+    start, end = np.broadcast_arrays(np.asarray(start), np.asarray(end))
+    n = end - start
+
+    c_start = np.where(start > 0, c[start - 1], 0.0)
+    c2_start = np.where(start > 0, c2[start - 1], 0.0)
+    c_end = c[end - 1]
+    c2_end = c2[end - 1]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        var = (c2_end - c2_start) / n - ((c_end - c_start) / n) ** 2
+
+    return np.where(n == 0, 0.0, var)
+
+
+def _scan_split(
+    start: int,
+    end: int,
+    c: np.ndarray,
+    c2: np.ndarray,
+    idx: np.ndarray,
+) -> Tuple[int, float]:
+    """Find single best split among the split positions `idx` based on maximal LLR.
+    Returns -1 and a gain of 0 if no split with positive gain exists."""
+    if idx.size == 0:
+        return -1, 0.0
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        var_summed = (end - start) * np.log(_var(start, end, c, c2))
+        var_summed_head = (idx - start) * np.log(_var(start, idx, c, c2))
+        var_summed_tail = (end - idx) * np.log(_var(idx, end, c, c2))
+        gains = var_summed - (var_summed_head + var_summed_tail)
+
+    # first index with maximal positive gain, NaN gains are never selected
+    gains = np.where(gains > 0, gains, 0.0)
+    x = np.argmax(gains)
+    if gains[x] <= 0:
+        return -1, 0.0
+
+    return int(idx[x]), float(gains[x])
+
+
+def _best_split(
+    start: int,
+    end: int,
+    c: np.ndarray,
+    c2: np.ndarray,
+    offset_head: int,
+    offset_tail: int,
+    step: int = 1,
+) -> Tuple[int, float]:
+    """Find single best split in `[start + offset_head, end - offset_tail)` based on maximal LLR.
+    For `step` > 1 only every `step`-th split position is evaluated, the best of which is refined
+    at full resolution within `step` positions on either side."""
+    lo = start + offset_head
+    hi = end - offset_tail
+
+    if step <= 1:
+        return _scan_split(start, end, c, c2, np.arange(lo, hi))
+
+    x, _ = _scan_split(start, end, c, c2, np.arange(lo, hi, step))
+    if x == -1:
+        return -1, 0.0
+    return _scan_split(
+        start, end, c, c2, np.arange(max(lo, x - step + 1), min(hi, x + step))
+    )
+
+
+def np_llr_detect_adapter(
+    raw_signal: np.ndarray, min_obs_adapter: int, border_trim: int, step: int = 1
+) -> Tuple[int, int]:
+    """Detect the adapter boundaries in `raw_signal`, returns (start, stop). For `step` > 1 the
+    boundaries are searched coarse-to-fine, see `_best_split`.
+    Pure numpy equivalent of `adapt._c_llr_segmentation.c_llr_detect_adapter`."""
+    start, stop, _, _ = np_llr_detect_adapter_stats(
+        raw_signal, min_obs_adapter, border_trim, step
+    )
+    return start, stop
+
+
+def np_llr_detect_adapter_stats(
+    raw_signal: np.ndarray, min_obs_adapter: int, border_trim: int, step: int = 1
+) -> Tuple[int, int, float, float]:
+    """Detect the adapter boundaries in `raw_signal`, returns (start, stop, gain, contrast).
+    `gain` is the LLR gain of the split that delimits the adapter and `contrast` the smallest
+    difference between the adapter median and the medians of its neighbouring segments, both are 0
+    if no adapter is found.
+    Pure numpy equivalent of `adapt._c_llr_segmentation.c_llr_detect_adapter_stats`."""
+    raw_signal = np.asarray(raw_signal, dtype=np.float64)
+    if raw_signal.size < 2:
+        # empty signal
+        return 0, 0, 0.0, 0.0
+
+    c = np.cumsum(raw_signal)
+    c2 = np.cumsum(np.multiply(raw_signal, raw_signal))
+
+    length = raw_signal.size - 1
+
+    x_first, _ = _best_split(
+        0, length, c, c2, min_obs_adapter + border_trim, border_trim, step
+    )
+    if x_first == -1:
+        # empty signal
+        return 0, 0, 0.0, 0.0
+
+    x_head, gain_head = _best_split(
+        0, x_first, c, c2, border_trim, min_obs_adapter, step
+    )
+    x_tail, gain_tail = _best_split(
+        x_first, length, c, c2, min_obs_adapter, border_trim, step
+    )
+
+    if x_head == -1:
+        # x_first - border_trim - min_obs_adapter == 0
+        x_head = 1
+    if x_tail == -1:
+        # (length - x_first) - border_trim - min_obs_adapter == 0
+        x_tail = x_first + 1
+
+    medians = np.array(
+        [
+            np.median(raw_signal[:x_head]),
+            np.median(raw_signal[x_head:x_first]),
+            np.median(raw_signal[x_first:x_tail]),
+            np.median(raw_signal[x_tail:]),
+        ]
+    )
+    diffs = np.diff(medians)
+
+    # use fact that adapter represents a drop in pA space
+    if gain_head > gain_tail and diffs[0] < 0 and diffs[1] > 0:
+        return x_head, x_first, gain_head, float(min(-diffs[0], diffs[1]))
+    # poly-A on 5` side of adapter` is detected as segment and has low variance
+    elif (
+        diffs[0] < 0
+        and diffs[1] > 0
+        and _var(x_head, x_first, c, c2) > _var(x_first, x_tail, c, c2)
+    ):
+        return x_head, x_first, gain_head, float(min(-diffs[0], diffs[1]))
+    elif gain_tail > gain_head and diffs[1] < 0 and diffs[2] > 0:
+        return x_first, x_tail, gain_tail, float(min(-diffs[1], diffs[2]))
+    # segment not found
+    else:
+        return 0, 0, 0.0, 0.0
@@ -6,15 +6,130 @@ Copyright (c) 2023 Wiep K. van der Toorn (w.vandertoorn@fu-berlin.de)
 """
 
 
-from typing import List
+import os
+from typing import Callable, List, Optional, Tuple, Union
 
 import numpy as np
 
 from ont_fast5_api.fast5_read import Fast5Read
 
-from ._c_llr_segmentation import c_llr_detect_adapter
-from .normalize import normalize_signal
-from .utils import detectResults
+from ._np_llr_segmentation import np_llr_detect_adapter, np_llr_detect_adapter_stats
+from .io import load_adapter_boundaries, read_signal_hyperslab
+from .normalize import c_normalize_int16, normalize_signal
+from .utils import adaptiveDetectResults, detectResults
+
+try:
+    from ._c_llr_segmentation import (c_llr_detect_adapter,
+                                      c_llr_detect_adapter_batch,
+                                      c_llr_detect_adapter_stats)
+except ImportError:  # compiled extension not built, fall back on the numpy engine
+    c_llr_detect_adapter = None
+    c_llr_detect_adapter_batch = None
+    c_llr_detect_adapter_stats = None
+
+ENGINES = ["cython", "numpy"]
+DEFAULT_ENGINE = "numpy" if c_llr_detect_adapter is None else "cython"
+SEARCH_MODES = ["exhaustive", "coarse"]
+
+
+def _get_llr_detect_adapter(engine: Optional[str] = None, stats: bool = False) -> Callable:
+    """Return the adapter detection function of `engine`, None indicates `DEFAULT_ENGINE`.
+    With `stats`, the returned function also returns the gain and median contrast of the adapter."""
+    engine = DEFAULT_ENGINE if engine is None else engine
+
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine `{engine}`, expected one of {ENGINES}.")
+    if engine == "cython" and c_llr_detect_adapter is None:
+        raise ImportError(
+            "The compiled extension `adapt._c_llr_segmentation` is not available, "
+            "use the `numpy` engine instead."
+        )
+
+    if stats:
+        return {"cython": c_llr_detect_adapter_stats, "numpy": np_llr_detect_adapter_stats}[engine]
+    return {"cython": c_llr_detect_adapter, "numpy": np_llr_detect_adapter}[engine]
+
+
+def _detection_windows(start_window: int, max_obs: int) -> List[int]:
+    """Return the detection windows of the adaptive mode, `start_window` doubled up to `max_obs`."""
+    windows = [min(max(start_window, 1), max_obs)]
+    while windows[-1] < max_obs:
+        windows.append(min(2 * windows[-1], max_obs))
+    return windows
+
+
+def _is_confident(
+    start: int,
+    stop: int,
+    gain: float,
+    contrast: float,
+    window: int,
+    min_obs_adapter: int,
+    border_trim: int,
+    min_gain: float,
+    min_contrast: float,
+) -> bool:
+    """Accept an adapter detected in the first `window` data points if it is followed by a full
+    length segment within the window and its split gain and median contrast are high enough."""
+    return (
+        stop > start
+        and stop + min_obs_adapter + border_trim <= window
+        and gain >= min_gain
+        and contrast >= min_contrast
+    )
+
+
+def _detect_adapter_adaptive(
+    get_window_signal: Callable,
+    max_obs: int,
+    min_obs_adapter: int,
+    border_trim: int,
+    engine: Optional[str],
+    step: int,
+    start_window: int,
+    min_gain: float,
+    min_contrast: float,
+) -> adaptiveDetectResults:
+    """Detect the adapter in progressively larger windows, see `detect_adapter_in_signal`.
+    `get_window_signal(window)` returns the normalized signal of the first `window` data points and
+    whether the signal ends within the window."""
+    llr_detect_adapter = _get_llr_detect_adapter(engine, stats=True)
+
+    for window in _detection_windows(start_window, max_obs):
+        signal, exhausted = get_window_signal(window)
+        start, stop, gain, contrast = llr_detect_adapter(
+            np.ascontiguousarray(signal[:window]), min_obs_adapter, border_trim, step
+        )
+        if exhausted or _is_confident(
+            start, stop, gain, contrast, window, min_obs_adapter, border_trim, min_gain, min_contrast
+        ):
+            break
+
+    return adaptiveDetectResults(start, stop, window)
+
+
+def _get_search_step(search: str, search_step: int) -> int:
+    """Return the split position step of `search` mode, 1 indicates the exhaustive search."""
+    if search not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode `{search}`, expected one of {SEARCH_MODES}.")
+
+    return search_step if search == "coarse" else 1
+
+
+def _get_read_window(
+    normalization: str, max_obs: int, norm_window: Optional[int], partial_read: bool
+) -> Tuple[Optional[int], Optional[int]]:
+    """Return the normalization window and the end of the raw signal to load to detect the adapter in
+    the first `max_obs` data points of a read, None indicates the full read."""
+    if normalization == "full":
+        return None, (max_obs if partial_read else None)
+    if normalization == "window":
+        norm_window = max_obs if norm_window is None else norm_window
+        return norm_window, max(max_obs, norm_window)
+
+    raise ValueError(
+        f"Unknown normalization mode `{normalization}`, expected 'full' or 'window'."
+    )
 
 
 def detect_adapter_in_signal(
@@ -22,7 +137,14 @@ def detect_adapter_in_signal(
     max_obs: int = 40000,
     min_obs_adapter: int = 1000,
     border_trim: int = 500,
-) -> detectResults:
+    engine: Optional[str] = None,
+    search: str = "exhaustive",
+    search_step: int = 50,
+    adaptive: bool = False,
+    start_window: int = 10000,
+    min_gain: float = 1000.0,
+    min_contrast: float = 1.0,
+) -> Union[detectResults, adaptiveDetectResults]:
     """Function to detect DNA adapter segment in dRNA raw signal.
 
     Parameters
@@ -35,26 +157,165 @@ def detect_adapter_in_signal(
         Minimal length of the adapter signal, by default 1000
     border_trim : int, optional
         Ignore outer `border_trim` data points, a boundary can be detected between `border_trim` and `max_obs`-`border_trim`, by default 500
+    engine : str, optional
+        Detection engine, one of 'cython' (compiled extension) and 'numpy'. None indicates 'cython' if the
+        compiled extension is available and 'numpy' otherwise, by default None
+    search : str, optional
+        Boundary search mode, one of 'exhaustive' and 'coarse'. The 'exhaustive' search evaluates every possible
+        boundary position. The 'coarse' search evaluates every `search_step`-th position and refines the best one
+        at full resolution within `search_step` positions, see README for its accuracy, by default 'exhaustive'
+    search_step : int, optional
+        Step between the evaluated boundary positions in 'coarse' search mode, by default 50
+    adaptive : bool, optional
+        Detect the adapter in progressively larger windows: starting from the first `start_window` data points,
+        the window is doubled up to `max_obs` until a detected adapter passes a confidence check. An adapter
+        passes if a segment of at least `min_obs_adapter` + `border_trim` data points follows it within the
+        window, its split gain is at least `min_gain` and the difference between its median and the medians
+        of the neighbouring segments is at least `min_contrast`, by default False
+    start_window : int, optional
+        First window of the adaptive mode, by default 10000
+    min_gain : float, optional
+        Minimal LLR gain of the split that delimits the adapter in the adaptive mode, by default 1000.0
+    min_contrast : float, optional
+        Minimal median difference between the adapter and its neighbouring segments in the adaptive mode,
+        in normalized units, by default 1.0
 
     Returns
     -------
-    res : detectResults
-        Results class containing adapter start and end coordinates.
-        Start=end=0 indicates that no adapter was detected.
+    res : detectResults or adaptiveDetectResults
+        Results class containing adapter start and end coordinates, and the window the adapter was
+        detected in for the adaptive mode. Start=end=0 indicates that no adapter was detected.
 
     """
 
-    start, stop = c_llr_detect_adapter(signal[:max_obs], min_obs_adapter, border_trim)
+    step = _get_search_step(search, search_step)
+    if adaptive:
+        return _detect_adapter_adaptive(
+            lambda window: (signal[:window], signal.size <= window),
+            max_obs=max_obs,
+            min_obs_adapter=min_obs_adapter,
+            border_trim=border_trim,
+            engine=engine,
+            step=step,
+            start_window=start_window,
+            min_gain=min_gain,
+            min_contrast=min_contrast,
+        )
+
+    llr_detect_adapter = _get_llr_detect_adapter(engine)
+    start, stop = llr_detect_adapter(
+        np.ascontiguousarray(signal[:max_obs]), min_obs_adapter, border_trim, step
+    )
 
     return detectResults(start, stop)
 
 
+def detect_adapters_in_signals(
+    signals: np.ndarray,
+    offsets: np.ndarray,
+    max_obs: int = 40000,
+    min_obs_adapter: int = 1000,
+    border_trim: int = 500,
+    norm_window: Optional[int] = None,
+    threads: Optional[int] = None,
+    engine: Optional[str] = None,
+    search: str = "exhaustive",
+    search_step: int = 50,
+) -> np.ndarray:
+    """Function to detect DNA adapter segments in a batch of dRNA raw signals, in parallel.
+
+    Parameters
+    ----------
+    signals : np.ndarray
+        One-dimensional numpy array holding the concatenated signals of N reads. Signals of dtype np.int16 are
+        treated as raw signal and normalized prior to detection (see `adapt.normalize.normalize_signal`), signals
+        of dtype np.float64 are used as is (see `detect_adapter_in_signal`).
+    offsets : np.ndarray
+        One-dimensional array of N+1 offsets, the signal of read i is `signals[offsets[i]:offsets[i+1]]`.
+    max_obs : int, optional
+        Look for adapter in first `max_obs` data points of the raw signal. Value taken from default params in Tombo, by default 40000
+    min_obs_adapter : int, optional
+        Minimal length of the adapter signal, by default 1000
+    border_trim : int, optional
+        Ignore outer `border_trim` data points, a boundary can be detected between `border_trim` and `max_obs`-`border_trim`, by default 500
+    norm_window : int, optional
+        Compute the normalization statistics of np.int16 signals over the first `norm_window` data points of
+        each read. None indicates the full read, by default None
+    threads : int, optional
+        Number of threads to detect with. None indicates the number of CPUs, by default None
+    engine : str, optional
+        Detection engine, see `detect_adapter_in_signal`. The 'numpy' engine processes the reads one by one
+        in the calling thread, by default None
+    search : str, optional
+        Boundary search mode, see `detect_adapter_in_signal`, by default 'exhaustive'
+    search_step : int, optional
+        Step between the evaluated boundary positions in 'coarse' search mode, by default 50
+
+    Returns
+    -------
+    np.ndarray
+        Array of shape (N, 2) and dtype np.int64 with the adapter start and end coordinates per read.
+        Start=end=0 indicates that no adapter was detected.
+
+    Raises
+    ------
+    ValueError
+        If `offsets` are not non-decreasing or out of the bounds of `signals`.
+    """
+    llr_detect_adapter = _get_llr_detect_adapter(engine)
+    step = _get_search_step(search, search_step)
+
+    if signals.dtype != np.int16:
+        signals = signals.astype(np.float64, copy=False)
+    offsets = np.asarray(offsets, dtype=np.int64)
+
+    if llr_detect_adapter is np_llr_detect_adapter:
+        if (np.diff(offsets) < 0).any() or offsets[0] < 0 or offsets[-1] > signals.size:
+            raise ValueError(
+                "`offsets` should be non-decreasing and within the bounds of `signals`."
+            )
+
+        boundaries = np.zeros((offsets.size - 1, 2), dtype=np.int64)
+        for i, (offset_start, offset_stop) in enumerate(zip(offsets[:-1], offsets[1:])):
+            signal = signals[offset_start:offset_stop]
+            if signal.size < 2:
+                continue
+            if signal.dtype == np.int16:
+                signal = normalize_signal(signal, norm_window=norm_window, max_obs=max_obs)
+            boundaries[i] = np_llr_detect_adapter(
+                signal[:max_obs], min_obs_adapter, border_trim, step
+            )
+        return boundaries
+
+    return c_llr_detect_adapter_batch(
+        np.ascontiguousarray(signals),
+        np.ascontiguousarray(offsets),
+        min_obs_adapter,
+        border_trim,
+        max_obs,
+        0 if norm_window is None else norm_window,
+        5,
+        step,
+        os.cpu_count() if threads is None else threads,
+    )
+
+
 def detect_adapter_in_read(
     read: Fast5Read,
     max_obs: int = 40000,
     min_obs_adapter: int = 1000,
     border_trim: int = 500,
-) -> detectResults:
+    partial_read: bool = False,
+    normalization: str = "full",
+    norm_window: Optional[int] = None,
+    engine: Optional[str] = None,
+    search: str = "exhaustive",
+    search_step: int = 50,
+    adaptive: bool = False,
+    start_window: int = 10000,
+    min_gain: float = 1000.0,
+    min_contrast: float = 1.0,
+) -> Union[detectResults, adaptiveDetectResults]:
     """Function to detect DNA adapter segment in dRNA raw signal, directly from the fast5 read.
     Signal is normalized prior to detection.
 
@@ -68,21 +329,277 @@ def detect_adapter_in_read(
         Minimal length of the adapter signal, by default 1000
     border_trim : int, optional
         Ignore outer `border_trim` data points, a boundary can be detected between `border_trim` and `max_obs`-`border_trim`, by default 500
+    partial_read : bool, optional
+        Only load the first `max_obs` data points of the raw signal from disk (HDF5 hyperslab selection).
+        Normalization statistics are then computed over this prefix instead of over the full read, by default False
+    normalization : str, optional
+        Normalization mode, one of 'full' and 'window'. In 'full' mode the normalization statistics are computed
+        over the full (loaded) signal. In 'window' mode they are computed over the first `norm_window` data points
+        and only the data points needed for detection and normalization are loaded, by default 'full'
+    norm_window : int, optional
+        Number of data points to compute normalization statistics over in 'window' mode.
+        None indicates `max_obs`, by default None
+    engine : str, optional
+        Detection engine, see `detect_adapter_in_signal`, by default None
+    search : str, optional
+        Boundary search mode, see `detect_adapter_in_signal`, by default 'exhaustive'
+    search_step : int, optional
+        Step between the evaluated boundary positions in 'coarse' search mode, by default 50
+    adaptive : bool, optional
+        Detect the adapter in progressively larger windows, see `detect_adapter_in_signal`. Each window takes
+        the place of `max_obs` in loading and normalization: with `partial_read` or in 'window' mode (without
+        `norm_window`) only the window is loaded and normalized, the signal is loaded incrementally as the
+        window grows, by default False
+    start_window : int, optional
+        First window of the adaptive mode, by default 10000
+    min_gain : float, optional
+        Minimal LLR gain of the adapter in the adaptive mode, see `detect_adapter_in_signal`, by default 1000.0
+    min_contrast : float, optional
+        Minimal median contrast of the adapter in the adaptive mode, see `detect_adapter_in_signal`,
+        by default 1.0
 
     Returns
     -------
-    res : detectResults
-        Results class containing adapter start and end coordinates.
-        Start=end=0 indicates that no adapter was detected.
+    res : detectResults or adaptiveDetectResults
+        Results class containing adapter start and end coordinates, and the window the adapter was
+        detected in for the adaptive mode. Start=end=0 indicates that no adapter was detected.
 
     """
 
-    signal = read.get_raw_data(scale=False).copy()
-    norm_signal = normalize_signal(signal)
+    stats_window, read_end = _get_read_window(normalization, max_obs, norm_window, partial_read)
+
+    if adaptive:
+        return _detect_adapter_in_read_adaptive(
+            read,
+            max_obs=max_obs,
+            min_obs_adapter=min_obs_adapter,
+            border_trim=border_trim,
+            partial_read=partial_read,
+            normalization=normalization,
+            norm_window=norm_window,
+            engine=engine,
+            step=_get_search_step(search, search_step),
+            start_window=start_window,
+            min_gain=min_gain,
+            min_contrast=min_contrast,
+        )
+
+    signal = read.get_raw_data(end=read_end, scale=False)
+    norm_signal = normalize_signal(signal, norm_window=stats_window, max_obs=max_obs)
 
     return detect_adapter_in_signal(
         norm_signal,
         max_obs=max_obs,
         min_obs_adapter=min_obs_adapter,
         border_trim=border_trim,
+        engine=engine,
+        search=search,
+        search_step=search_step,
     )
+
+
+def get_adapter_in_read(
+    read: Fast5Read, boundaries: Optional[str] = None, **detect_kwargs
+) -> Union[detectResults, adaptiveDetectResults]:
+    """Adapter boundaries of a read, looked up in the detected adapter boundaries of a previous detect run
+    if given, otherwise detected with `detect_adapter_in_read`.
+
+    Parameters
+    ----------
+    read : Fast5Read
+        read entry from fast5 file (multi or single)
+    boundaries : str, optional
+        Path of the detected adapter boundaries, see `adapt.io.load_adapter_boundaries`. Reads that are not
+        in the table are detected. None indicates all reads are detected, by default None
+    **detect_kwargs
+        Keyword arguments for `detect_adapter_in_read`.
+
+    Returns
+    -------
+    res : detectResults or adaptiveDetectResults
+        Results class containing adapter start and end coordinates, see `detect_adapter_in_read`.
+    """
+    if boundaries is not None:
+        res = load_adapter_boundaries(boundaries).get(read.read_id)
+        if res is not None:
+            return res
+
+    return detect_adapter_in_read(read, **detect_kwargs)
+
+
+def _detect_adapter_in_read_adaptive(
+    read: Fast5Read,
+    max_obs: int,
+    min_obs_adapter: int,
+    border_trim: int,
+    partial_read: bool,
+    normalization: str,
+    norm_window: Optional[int],
+    engine: Optional[str],
+    step: int,
+    start_window: int,
+    min_gain: float,
+    min_contrast: float,
+) -> adaptiveDetectResults:
+    """Adaptive mode of `detect_adapter_in_read`, the raw signal is loaded incrementally."""
+    # loaded prefix of the raw signal, `read_end` is the requested end, None for the full read
+    signal = np.empty(0, dtype=np.int16)
+    read_end = 0
+
+    def get_window_signal(window):
+        nonlocal signal, read_end
+
+        window_norm, window_end = _get_read_window(
+            normalization, window, norm_window, partial_read
+        )
+
+        if read_end is not None and (window_end is None or window_end > read_end):
+            if signal.size == read_end:
+                # the signal might continue beyond the loaded prefix
+                signal = np.concatenate(
+                    [signal, read.get_raw_data(start=read_end, end=window_end, scale=False)]
+                )
+            read_end = window_end
+
+        exhausted = read_end is None or signal.size < read_end
+        norm_signal = normalize_signal(signal, norm_window=window_norm, max_obs=window)
+
+        return norm_signal, exhausted and signal.size <= window
+
+    return _detect_adapter_adaptive(
+        get_window_signal,
+        max_obs=max_obs,
+        min_obs_adapter=min_obs_adapter,
+        border_trim=border_trim,
+        engine=engine,
+        step=step,
+        start_window=start_window,
+        min_gain=min_gain,
+        min_contrast=min_contrast,
+    )
+
+
+class Detector:
+    """Adapter detector with preallocated work buffers, to detect adapters in many signals or reads.
+
+    The detection settings are fixed on construction, see `detect_adapter_in_read`. The work buffers
+    of detection and normalization are sized to `max_obs` once, `detect` and `detect_read` reuse them
+    and do not allocate per call. Only the buffer holding the raw signal of a read grows if a longer read
+    has to be loaded. Buffers are reused by the 'cython' engine and the histogram-based normalization, the
+    'numpy' engine allocates per call. A detector is not thread-safe, use a detector per thread.
+
+    Parameters
+    ----------
+    max_obs : int, optional
+        Look for adapter in first `max_obs` data points of the raw signal, by default 40000
+    min_obs_adapter : int, optional
+        Minimal length of the adapter signal, by default 1000
+    border_trim : int, optional
+        Ignore outer `border_trim` data points, by default 500
+    partial_read : bool, optional
+        Only load the first `max_obs` data points of the raw signal of a read, see `detect_adapter_in_read`,
+        by default False
+    normalization : str, optional
+        Normalization mode, one of 'full' and 'window', see `detect_adapter_in_read`, by default 'full'
+    norm_window : int, optional
+        Number of data points to compute normalization statistics over in 'window' mode.
+        None indicates `max_obs`, by default None
+    engine : str, optional
+        Detection engine, see `detect_adapter_in_signal`, by default None
+    search : str, optional
+        Boundary search mode, see `detect_adapter_in_signal`, by default 'exhaustive'
+    search_step : int, optional
+        Step between the evaluated boundary positions in 'coarse' search mode, by default 50
+
+    Raises
+    ------
+    ValueError
+        If the normalization mode, engine or search mode is unknown.
+    """
+
+    def __init__(
+        self,
+        max_obs: int = 40000,
+        min_obs_adapter: int = 1000,
+        border_trim: int = 500,
+        partial_read: bool = False,
+        normalization: str = "full",
+        norm_window: Optional[int] = None,
+        engine: Optional[str] = None,
+        search: str = "exhaustive",
+        search_step: int = 50,
+    ):
+        norm_window, read_end = _get_read_window(normalization, max_obs, norm_window, partial_read)
+
+        self.max_obs = max_obs
+        self.min_obs_adapter = min_obs_adapter
+        self.border_trim = border_trim
+        self.norm_window = norm_window
+        self.read_end = read_end
+
+        self._llr_detect_adapter = _get_llr_detect_adapter(engine)
+        self._step = _get_search_step(search, search_step)
+
+        self._work = np.empty(4 * max_obs, dtype=np.float64)
+        self._norm_signal = np.empty(max_obs, dtype=np.float64)
+        self._hist = None if c_normalize_int16 is None else np.zeros(65536, dtype=np.int64)
+        self._raw_signal = np.empty(max_obs if read_end is None else read_end, dtype=np.int16)
+
+    def detect(self, signal: np.ndarray) -> detectResults:
+        """Detect the adapter in a normalized signal, see `detect_adapter_in_signal`.
+
+        Parameters
+        ----------
+        signal : np.ndarray
+            One-dimensional numpy array representation of normalized dRNA signal, of dtype np.float64.
+
+        Returns
+        -------
+        res : detectResults
+            Results class containing adapter start and end coordinates.
+            Start=end=0 indicates that no adapter was detected.
+        """
+        signal = np.ascontiguousarray(signal[: self.max_obs], dtype=np.float64)
+
+        if self._llr_detect_adapter is c_llr_detect_adapter:
+            start, stop = c_llr_detect_adapter(
+                signal, self.min_obs_adapter, self.border_trim, self._step, self._work
+            )
+        else:
+            start, stop = self._llr_detect_adapter(
+                signal, self.min_obs_adapter, self.border_trim, self._step
+            )
+
+        return detectResults(start, stop)
+
+    def detect_read(self, read: Fast5Read) -> detectResults:
+        """Detect the adapter directly from the fast5 read, see `detect_adapter_in_read`.
+        The raw signal is read from disk into the raw signal buffer of the detector.
+
+        Parameters
+        ----------
+        read : Fast5Read
+            read entry from fast5 file (multi or single)
+
+        Returns
+        -------
+        res : detectResults
+            Results class containing adapter start and end coordinates.
+            Start=end=0 indicates that no adapter was detected.
+        """
+        dataset = read.handle[read.raw_dataset_name]
+        n = dataset.shape[0] if self.read_end is None else min(dataset.shape[0], self.read_end)
+
+        if n > self._raw_signal.size:
+            self._raw_signal = np.empty(n, dtype=np.int16)
+        raw_signal = read_signal_hyperslab(dataset, 0, n, out=self._raw_signal)
+
+        norm_signal = normalize_signal(
+            raw_signal,
+            norm_window=self.norm_window,
+            max_obs=self.max_obs,
+            out=self._norm_signal,
+            hist=self._hist,
+        )
+
+        return self.detect(norm_signal)
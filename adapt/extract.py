@@ -6,9 +6,13 @@ Copyright (c) 2023 Wiep K. van der Toorn (w.vandertoorn@fu-berlin.de)
 """
 
 
+from typing import Optional
+
+import numpy as np
+
 from ont_fast5_api.fast5_read import Fast5Read
 
-from .detect import detect_adapter_in_read
+from .detect import get_adapter_in_read
 from .utils import extractResults
 
 
@@ -19,6 +23,7 @@ def extract_signal_slice_from_read(
     extract_buffer: int = 0,
 ):
     """Extract a slice of signal from the raw signal attribute of a fast5 read.
+    Only the requested slice is loaded from disk.
 
     Parameters
     ----------
@@ -36,16 +41,19 @@ def extract_signal_slice_from_read(
     np.ndarray
         Slice of signal
     """
-    signal = read.get_raw_data(scale=False)
     slice_start = max(0, start - extract_buffer)
-    slice_stop = min(signal.size, stop + extract_buffer)
+    slice_stop = stop + extract_buffer
 
-    return signal[slice_start:slice_stop]
+    # copy, a view would keep the full signal cached by a `adapt.io.ReadContext` alive
+    return np.array(read.get_raw_data(start=slice_start, end=slice_stop, scale=False))
 
 
 def extract_adapter_from_read(
     read: Fast5Read,
     extract_buffer: int = 100,
+    partial_read: bool = False,
+    boundaries: Optional[str] = None,
+    **detect_kwargs,
 ) -> extractResults:
     """Extract adapter signal from read entry.
 
@@ -55,13 +63,24 @@ def extract_adapter_from_read(
         The read to process
     extract_buffer : int, optional
         Number of observation to include pre and post detected adapter, by default 100
+    partial_read : bool, optional
+        Only load the signal prefix used for adapter detection, see `adapt.detect.detect_adapter_in_read`,
+        by default False
+    boundaries : str, optional
+        Path of the detected adapter boundaries of a previous detect run to extract instead of detecting the
+        adapter, see `adapt.detect.get_adapter_in_read`, by default None
+    **detect_kwargs
+        Keyword arguments for `adapt.detect.detect_adapter_in_read`.
 
     Returns
     -------
     extractResults
         Wrapper class containing all relevant results
     """
-    start, stop = detect_adapter_in_read(read)
+    res = get_adapter_in_read(
+        read, boundaries=boundaries, partial_read=partial_read, **detect_kwargs
+    )
+    start, stop = res.adapter_start, res.adapter_end
     adapter_signal = extract_signal_slice_from_read(
         read, start, stop, extract_buffer=extract_buffer
     )
@@ -5,15 +5,479 @@ Copyright (c) 2023 Wiep K. van der Toorn (w.vandertoorn@fu-berlin.de)
 
 """
 
+import glob
+import json
 import os
 import shutil
-from typing import Callable, List
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from multiprocessing import Pool
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, Union
 
+import h5py
+import numpy as np
 import pandas as pd
 
+from ont_fast5_api.compression_settings import GZIP, VBZ
 from ont_fast5_api.fast5_interface import get_fast5_file, is_multi_read
+from ont_fast5_api.multi_fast5 import MultiFast5File
 
-from .utils import detect_results_to_df, extract_results_to_df, processResults
+from .utils import (ResultsBatch, detect_results_to_df, detectResults,
+                    extract_results_to_df, extractResults, processError,
+                    processResults, to_results_batches)
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional dependency, only needed for the parquet and feather output formats
+    pa = None
+    pq = None
+
+# compressions of the raw signal datasets written by `write_sliced_fast5_file` and `slice_signal_in_read`
+RAW_COMPRESSIONS = ["none", "gzip", "vbz"]
+
+
+def _ordered_thread_map(
+    fn: Callable, iterable: Iterable, threads: int, max_pending: int = None
+) -> Iterator:
+    """Apply `fn` to the items of `iterable` in a pool of threads, yield the results in input order.
+
+    Parameters
+    ----------
+    fn : Callable
+        Function to apply.
+    iterable : Iterable
+        Items to apply `fn` to, consumed by the calling thread.
+    threads : int
+        Number of threads in the pool.
+    max_pending : int, optional
+        Maximum number of submitted items that are not yet yielded, by default 2 * `threads`
+
+    Yields
+    ------
+    Iterator
+        Results of `fn` in the order of `iterable`.
+    """
+    max_pending = 2 * threads if max_pending is None else max_pending
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def read_signal_hyperslab(
+    dataset: Union[h5py.Dataset, h5py.h5d.DatasetID],
+    start: int,
+    stop: int,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Read `dataset[start:stop]` of a 1D dataset, with `0 <= start <= stop <= dataset.size`.
+
+    The hyperslab is read with the low-level h5py API, which avoids the selection overhead of slicing and
+    `read_direct`.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset or h5py.h5d.DatasetID
+        1D dataset to read from.
+    start : int
+        Start of the hyperslab.
+    stop : int
+        Stop of the half-open hyperslab.
+    out : np.ndarray, optional
+        Preallocated buffer of the dataset dtype to read into, should hold at least `stop` - `start` values.
+        None indicates a new array is allocated, by default None
+
+    Returns
+    -------
+    np.ndarray
+        The values `dataset[start:stop]`, a view of `out` if given.
+    """
+    dataset_id = dataset.id if isinstance(dataset, h5py.Dataset) else dataset
+    n = stop - start
+    out = np.empty(n, dtype=dataset_id.dtype) if out is None else out[:n]
+    if n > 0:
+        file_space = dataset_id.get_space()
+        file_space.select_hyperslab((start,), (n,))
+        dataset_id.read(h5py.h5s.create_simple((n,)), file_space, out)
+    return out
+
+
+def _attr_value(value):
+    """Convert an HDF5 attribute value to its python equivalent, decodes byte strings."""
+    if isinstance(value, np.ndarray) and value.ndim > 0:
+        return np.char.decode(value).tolist() if value.dtype.kind == "S" else value.tolist()
+    if isinstance(value, (np.ndarray, np.generic)):
+        value = value.item()
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class H5Read:
+    """Read of a multi fast5 file opened by `MultiFast5Reader`, a lightweight stand-in for `Fast5Read`.
+
+    Provides the attributes and methods of `Fast5Read` used by the processing functions: `read_id`,
+    `handle`, `raw_dataset_name`, `raw_dataset_group_name`, `get_raw_data` and `get_channel_info`. The raw
+    signal and channel info are read with the low-level h5py API, the read group is only opened when
+    `handle` is used.
+
+    Parameters
+    ----------
+    reader : MultiFast5Reader
+        The open file of the read.
+    read_id : str
+        Read id.
+    """
+
+    raw_dataset_group_name = "Raw"
+    raw_dataset_name = "Raw/Signal"
+
+    def __init__(self, reader: "MultiFast5Reader", read_id: str):
+        self.reader = reader
+        self.read_id = read_id
+        self._group_name = "read_" + read_id
+        self._handle = None
+        self._raw_dataset_id = None
+
+    @property
+    def handle(self) -> h5py.Group:
+        """The `read_<read_id>` group of the read."""
+        if self._handle is None:
+            self._handle = self.reader.handle[self._group_name]
+        return self._handle
+
+    def get_raw_dataset_id(self) -> h5py.h5d.DatasetID:
+        """Low-level h5py identifier of the raw signal dataset, opened once."""
+        if self._raw_dataset_id is None:
+            self._raw_dataset_id = h5py.h5d.open(
+                self.reader.handle.id, f"{self._group_name}/{self.raw_dataset_name}".encode()
+            )
+        return self._raw_dataset_id
+
+    def get_raw_data(
+        self,
+        read_number=None,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        scale: bool = False,
+    ) -> np.ndarray:
+        """Return the raw signal slice `[start:end]`, see `Fast5Read.get_raw_data`."""
+        dataset_id = self.get_raw_dataset_id()
+        start, stop, _ = slice(start, end).indices(dataset_id.get_space().get_simple_extent_dims()[0])
+        raw = read_signal_hyperslab(dataset_id, start, max(start, stop))
+
+        if scale:
+            channel_info = self.get_channel_info()
+            scaling = channel_info["range"] / channel_info["digitisation"]
+            raw = np.array(scaling * (raw + channel_info["offset"]), dtype=np.float32)
+        return raw
+
+    def get_channel_info(self) -> dict:
+        """Return the channel info of the read, see `Fast5Read.get_channel_info`."""
+        channel_info = self.reader.read_channel_attrs(f"{self._group_name}/channel_id")
+        channel_info["channel_number"] = int(channel_info["channel_number"])
+        return channel_info
+
+
+class MultiFast5Reader:
+    """Lightweight read-only reader of multi fast5 files, built on h5py directly.
+
+    The `read_*` groups are enumerated once when the file is opened, the reads are `H5Read` objects. The
+    channel attributes of all reads are read with the attribute names and types of the first read, which
+    avoids resolving them for every read. Use `open_fast5_file` to fall back on `ont_fast5_api` for files
+    with another layout.
+
+    Parameters
+    ----------
+    fast5_filepath : str
+        Path to the multi fast5 file.
+    """
+
+    # fixed-length string attributes are read into buffers of this width
+    STRING_ATTR_DTYPE = np.dtype("S256")
+
+    def __init__(self, fast5_filepath: str):
+        self.filename = fast5_filepath
+        self.mode = "r"
+        self.handle = h5py.File(fast5_filepath, "r")
+
+        names = list(self.handle)
+        self._read_ids = [name[5:] for name in names if name.startswith("read_")]
+        self._n_groups = len(names)
+        self._channel_attrs = None
+
+    def is_supported(self) -> bool:
+        """Whether the file has the multi fast5 layout read by `MultiFast5Reader`: only `read_*` groups, of
+        which (the first) has a raw signal dataset and channel info."""
+        if len(self._read_ids) == 0 or len(self._read_ids) != self._n_groups:
+            return False
+        read = self.handle["read_" + self._read_ids[0]]
+        return isinstance(read.get(H5Read.raw_dataset_name), h5py.Dataset) and "channel_id" in read
+
+    def read_channel_attrs(self, path: str) -> dict:
+        """Read the attributes of the channel group at `path`, with the attribute names, types and shapes of
+        the first channel group read. Groups with other attributes are read with h5py, as are attributes that
+        are not numeric or fixed-length strings (e.g. variable-length strings)."""
+        group_id = h5py.h5g.open(self.handle.id, path.encode())
+
+        if self._channel_attrs is None:
+            self._channel_attrs = []
+            for name in h5py.Group(group_id).attrs:
+                attr_id = h5py.h5a.open(group_id, name.encode())
+                dtype = attr_id.dtype
+                if dtype.kind == "S":
+                    dtype = self.STRING_ATTR_DTYPE
+                elif dtype.kind not in "biuf":
+                    dtype = None
+                self._channel_attrs.append((name.encode(), dtype, attr_id.shape))
+
+        if h5py.h5o.get_info(group_id).num_attrs != len(self._channel_attrs) or not all(
+            h5py.h5a.exists(group_id, name) for name, _, _ in self._channel_attrs
+        ):
+            return {key: _attr_value(value) for key, value in h5py.Group(group_id).attrs.items()}
+
+        attrs = dict()
+        for name, dtype, shape in self._channel_attrs:
+            if dtype is None:
+                value = h5py.Group(group_id).attrs[name.decode()]
+            else:
+                value = np.empty(shape, dtype=dtype)
+                h5py.h5a.open(group_id, name).read(value)
+            attrs[name.decode()] = _attr_value(value)
+        return attrs
+
+    def get_read_ids(self) -> List[str]:
+        return list(self._read_ids)
+
+    def get_read(self, read_id: str) -> H5Read:
+        return H5Read(self, read_id)
+
+    def get_reads(self) -> Iterator[H5Read]:
+        for read_id in self._read_ids:
+            yield self.get_read(read_id)
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_fast5_file(fast5_filepath: str, mode: str = "r"):
+    """Open a single or multi fast5 file. Multi fast5 files opened read-only are read with
+    `MultiFast5Reader` if their layout is supported, all other files with `ont_fast5_api`.
+
+    Parameters
+    ----------
+    fast5_filepath : str
+        Path to the fast5 file.
+    mode : str, optional
+        Opening mode, see `process_fast5_file`, by default "r"
+
+    Returns
+    -------
+    MultiFast5Reader, MultiFast5File or Fast5File
+        The open fast5 file, to be used as a context manager.
+    """
+    if mode == "r":
+        reader = MultiFast5Reader(fast5_filepath)
+        if reader.is_supported():
+            return reader
+        reader.close()
+    return get_fast5_file(fast5_filepath, mode=mode)
+
+
+def _get_reads_in_range(f5, read_range: Optional[Tuple[int, int]] = None) -> Iterable:
+    """Return the reads of an open fast5 file, only the reads `[start, stop)` of `read_range` if given."""
+    if read_range is None:
+        return f5.get_reads()
+    if isinstance(f5, (MultiFast5File, MultiFast5Reader)):
+        # only create the read objects in range
+        return (f5.get_read(read_id) for read_id in f5.get_read_ids()[slice(*read_range)])
+    return islice(f5.get_reads(), *read_range)
+
+
+class ReadContext:
+    """Per-read cache of the raw signal, raw attributes and channel info of a fast5 read.
+
+    A `ReadContext` is used in place of the `Fast5Read` it wraps by the processing functions, it is
+    created once per read by `process_fast5_file` and `write_sliced_fast5_file`. The raw signal is
+    loaded lazily and cached as a prefix that grows with the requested data points, so every data point
+    is read from disk at most once (e.g. a detection on the signal prefix followed by the extraction of
+    the adapter within that prefix). Other attributes are those of the wrapped read.
+
+    Parameters
+    ----------
+    read : Fast5Read
+        The read to wrap, should stay open while the context is used.
+    """
+
+    def __init__(self, read):
+        self.read = read
+        self.read_id = read.read_id
+        self._signal = None
+        self._complete = False
+        self._channel_info = None
+        self._raw_attrs = None
+
+    def __getattr__(self, name):
+        return getattr(self.read, name)
+
+    def _load_signal(self, end: Optional[int] = None) -> None:
+        """Extend the cached signal prefix to `end` data points, to the full signal if None."""
+        n_loaded = 0 if self._signal is None else self._signal.size
+        if self._complete or (end is not None and end <= n_loaded):
+            return
+
+        signal = self.read.get_raw_data(start=n_loaded, end=end, scale=False)
+        if self._signal is not None:
+            signal = np.concatenate([self._signal, signal])
+        signal.flags.writeable = False
+
+        self._signal = signal
+        self._complete = end is None or signal.size < end
+
+    def get_raw_data(
+        self,
+        read_number=None,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        scale: bool = False,
+    ) -> np.ndarray:
+        """Return the raw signal slice `[start:end]`, see `Fast5Read.get_raw_data`. Unscaled signal is a
+        read-only view of the cached signal."""
+        if (start is not None and start < 0) or end is None or end < 0:
+            self._load_signal()
+        else:
+            self._load_signal(end)
+
+        raw = self._signal[start:end]
+        if scale:
+            channel_info = self.get_channel_info()
+            scaling = channel_info["range"] / channel_info["digitisation"]
+            raw = np.array(scaling * (raw + channel_info["offset"]), dtype=np.float32)
+        return raw
+
+    def get_channel_info(self) -> dict:
+        """Return the channel info of the read, see `Fast5Read.get_channel_info`."""
+        if self._channel_info is None:
+            self._channel_info = self.read.get_channel_info()
+        return self._channel_info
+
+    @property
+    def raw_attrs(self) -> dict:
+        """Attributes of the raw dataset group of the read."""
+        if self._raw_attrs is None:
+            self._raw_attrs = dict(self.read.handle[self.read.raw_dataset_group_name].attrs)
+        return self._raw_attrs
+
+
+def _raw_byte_ranges(read, end: Optional[int] = None) -> List[Tuple[int, int]]:
+    """File byte ranges (offset, size) of the stored raw signal of a read that hold the data points
+    `[0, end)`, all data points if `end` is None."""
+    if isinstance(read, H5Read):
+        dataset_id = read.get_raw_dataset_id()
+    else:
+        dataset_id = read.handle[read.raw_dataset_name].id
+
+    offset = dataset_id.get_offset()
+    if offset is not None:
+        # contiguous dataset
+        size = dataset_id.get_storage_size()
+        if end is not None:
+            size = min(size, end * dataset_id.dtype.itemsize)
+        return [(offset, size)]
+
+    ranges = []
+
+    def _add_chunk(chunk):
+        if end is None or chunk.chunk_offset[0] < end:
+            ranges.append((chunk.byte_offset, chunk.size))
+
+    if hasattr(dataset_id, "chunk_iter"):
+        dataset_id.chunk_iter(_add_chunk)
+    else:  # h5py < 3.8
+        for i in range(dataset_id.get_num_chunks()):
+            _add_chunk(dataset_id.get_chunk_info(i))
+    return ranges
+
+
+def _pread_ranges(fd: int, ranges: List[Tuple[int, int]]) -> None:
+    """Read the byte ranges from a file descriptor, which loads them into the OS page cache."""
+    for offset, size in ranges:
+        os.pread(fd, size, offset)
+
+
+def _prefetch_reads(
+    reads: Iterable,
+    fast5_filepath: str,
+    prefetch: int = 0,
+    prefetch_end: Optional[int] = None,
+) -> Iterator:
+    """Yield the reads of an open fast5 file, while the stored raw signal of the next `prefetch` reads is
+    read from the file by a pool of background threads.
+
+    h5py holds the GIL during HDF5 calls, so decompressing the signal of the next reads in another thread
+    would not overlap with processing. Instead, the stored (compressed) bytes of the raw signal are read
+    from the file with `os.pread`, which releases the GIL, so that HDF5 finds them in the OS page cache.
+    This hides the access latency of e.g. network filesystems behind the processing of the current read.
+
+    Parameters
+    ----------
+    reads : Iterable
+        Reads of the open fast5 file at `fast5_filepath`.
+    fast5_filepath : str
+        Path to the fast5 file.
+    prefetch : int, optional
+        Number of reads to prefetch ahead of the yielded read. 0 disables prefetching, by default 0
+    prefetch_end : int, optional
+        Only prefetch the stored data points `[0, prefetch_end)` of the raw signal. None indicates the full
+        signal, by default None
+
+    Yields
+    ------
+    Iterator
+        The reads, in order.
+    """
+    if prefetch <= 0:
+        yield from reads
+        return
+
+    fd = os.open(fast5_filepath, os.O_RDONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=prefetch) as executor:
+            pending = deque()
+            for read in reads:
+                try:
+                    ranges = _raw_byte_ranges(read, prefetch_end)
+                except (KeyError, RuntimeError, ValueError):
+                    # prefetching is best effort, errors surface when the read is processed
+                    ranges = []
+                pending.append((read, executor.submit(_pread_ranges, fd, ranges)))
+
+                if len(pending) > prefetch:
+                    read, future = pending.popleft()
+                    future.cancel()
+                    yield read
+
+            while pending:
+                read, future = pending.popleft()
+                future.cancel()
+                yield read
+    finally:
+        os.close(fd)
 
 
 def process_fast5_file(
@@ -21,7 +485,13 @@ def process_fast5_file(
     mode: str,
     process_fn: Callable,
     process_kwargs: dict = dict(),
-) -> List[processResults]:
+    threads: int = 1,
+    read_range: Optional[Tuple[int, int]] = None,
+    prefetch: int = 0,
+    prefetch_end: Optional[int] = None,
+    shard_dir: Optional[str] = None,
+    record_errors: bool = False,
+) -> ResultsBatch:
     """Open fast5 file and apply processing function.
 
     Parameters
@@ -34,28 +504,148 @@ def process_fast5_file(
         Processing function to apply to the fast5 file.
     process_kwargs : dict, optional
         Keyword arguments for `process_fn`, by default dict()
+    threads : int, optional
+        Number of threads to apply `process_fn` with. For `threads` > 1, the reads are fed from the
+        calling thread to a thread pool, results keep the file order, by default 1
+    read_range : Tuple[int, int], optional
+        Only process the reads `[start, stop)` (in file order) of `read_range`. None indicates all reads,
+        by default None
+    prefetch : int, optional
+        Number of reads of which the stored raw signal is read ahead in the background, see
+        `_prefetch_reads`. 0 disables prefetching, by default 0
+    prefetch_end : int, optional
+        Only prefetch the raw signal data points `[0, prefetch_end)`, e.g. the signal prefix used for adapter
+        detection. None indicates the full signal, by default None
+    shard_dir : str, optional
+        Write the adapter signals of extraction results to a shard file in `shard_dir`, the returned results
+        refer to it, see `write_signal_shard`. None indicates the adapter signals are returned, by default None
+    record_errors : bool, optional
+        Record the exceptions raised by reads that fail to process, and by the file, as `processError` in the
+        errors of the returned results and continue with the next read, instead of raising them. The results
+        of the reads processed before a file error are kept, by default False
 
     Returns
     -------
-    List[processResults]
-        List of processing results.
+    ResultsBatch
+        Processing results, a sequence of `processResults` stored column-wise.
     """
 
+    def _process_read(read):
+        read = ReadContext(read)
+        try:
+            return processResults(fast5_filepath, read.read_id, process_fn(read, **process_kwargs))
+        except Exception as e:
+            if not record_errors:
+                raise
+            return processError.from_exception(fast5_filepath, read.read_id, "process", e)
+
     results = []
-    with get_fast5_file(fast5_filepath, mode=mode) as f5:
-        for read in f5.get_reads():
-            read_id = read.read_id
-            processed = process_fn(read, **process_kwargs)
-            results.append(processResults(fast5_filepath, read_id, processed))
+    errors = []
+    try:
+        with open_fast5_file(fast5_filepath, mode=mode) as f5:
+            reads = _prefetch_reads(
+                _get_reads_in_range(f5, read_range), fast5_filepath, prefetch, prefetch_end
+            )
+            if threads > 1:
+                processed_reads = _ordered_thread_map(_process_read, reads, threads)
+            else:
+                processed_reads = map(_process_read, reads)
+
+            for res in processed_reads:
+                (errors if isinstance(res, processError) else results).append(res)
+    except Exception as e:
+        if not record_errors:
+            raise
+        errors.append(processError.from_exception(fast5_filepath, None, "file", e))
+
+    results = ResultsBatch.from_results(results, filepath=fast5_filepath, errors=errors)
+    if shard_dir is not None:
+        results = write_signal_shard(results, shard_dir)
 
     return results
 
 
+def write_signal_shard(results: ResultsBatch, shard_dir: str) -> ResultsBatch:
+    """Write the adapter signals of extraction results to a new shard file, so that worker processes return
+    the compact results batch only, instead of sending every adapter signal to the main process.
+
+    The adapter signals are concatenated in a np.int16 .npy file in `shard_dir`. Load them with
+    `load_adapter_signals`, delete the shard files with `remove_signal_shards` once they are written.
+
+    Parameters
+    ----------
+    results : ResultsBatch
+        Processing results, the results of other processing functions than adapter extraction are returned
+        unchanged.
+    shard_dir : str
+        Directory to write the shard file to.
+
+    Returns
+    -------
+    ResultsBatch
+        Processing results, of which the adapter signals are stored in the shard file.
+    """
+    if results.results_type is not extractResults:
+        return results
+
+    pieces = results.adapter_signal_pieces()
+    signal = np.concatenate(pieces) if len(pieces) else np.empty(0, dtype=np.int16)
+
+    fd, path = tempfile.mkstemp(suffix=".npy", prefix="signal_shard_", dir=shard_dir)
+    with os.fdopen(fd, "wb") as f:
+        np.save(f, signal.astype(np.int16, copy=False))
+
+    return ResultsBatch(
+        results.filepath,
+        results.results_type,
+        results.records,
+        [(path, 0, signal.size)] if signal.size else [],
+        results.signal_offsets,
+        results.errors,
+    )
+
+
+def load_adapter_signals(results: ResultsBatch) -> ResultsBatch:
+    """Load the adapter signals of extraction results that are stored in shard files, see `write_signal_shard`.
+
+    Parameters
+    ----------
+    results : ResultsBatch
+        Processing results, results without adapter signals in shard files are returned unchanged.
+
+    Returns
+    -------
+    ResultsBatch
+        Processing results with the adapter signals in memory.
+    """
+    if results.results_type is not extractResults or len(results.shard_paths()) == 0:
+        return results
+
+    signal = np.concatenate(results.adapter_signal_pieces())
+    return ResultsBatch(
+        results.filepath,
+        results.results_type,
+        results.records,
+        [(signal, 0, signal.size)],
+        results.signal_offsets,
+        results.errors,
+    )
+
+
+def remove_signal_shards(results: ResultsBatch) -> None:
+    """Delete the shard files that the adapter signals of extraction results are stored in, see
+    `write_signal_shard`."""
+    for path in results.shard_paths():
+        if os.path.isfile(path):
+            os.remove(path)
+
+
 def copy_and_process_fast5_file(
     fast5_filepath_src: str,
     fast5_filepath_dst: str,
     process_fn: Callable,
     process_kwargs: dict = dict(),
+    threads: int = 1,
 ):
     """First copy the fast5 file, open the new copy and apply the processing function.
 
@@ -69,14 +659,581 @@ def copy_and_process_fast5_file(
         Processing function to apply to the new fast5 copy.
     process_kwargs : dict, optional
         Keyword arguments for `process_fn`, by default dict()
+    threads : int, optional
+        Number of threads to apply `process_fn` with, see `process_fast5_file`, by default 1
 
     Returns
     -------
-    List[processResults]
-        List of processing results.
+    ResultsBatch
+        Processing results.
     """
     shutil.copy(fast5_filepath_src, fast5_filepath_dst)
-    return process_fast5_file(fast5_filepath_dst, "a", process_fn, process_kwargs)
+    return process_fast5_file(
+        fast5_filepath_dst, "a", process_fn, process_kwargs, threads=threads
+    )
+
+
+def raw_dataset_layout(
+    src_dataset: h5py.Dataset,
+    size: int,
+    compression: Optional[str] = None,
+    chunk_size: Optional[int] = None,
+) -> Tuple[h5py.h5p.PropDCID, Tuple[int]]:
+    """Dataset creation property list and maximum shape for a raw signal dataset of `size` data points
+    that replaces `src_dataset`.
+
+    Parameters
+    ----------
+    src_dataset : h5py.Dataset
+        Source raw signal dataset, its filters (compression) and chunking are kept unless overridden.
+    size : int
+        Number of data points of the new dataset.
+    compression : str, optional
+        Compression of the new dataset, one of `RAW_COMPRESSIONS`. None indicates the compression of
+        `src_dataset`, by default None
+    chunk_size : int, optional
+        Chunk size of the new dataset. None indicates the chunk size of `src_dataset`, a single chunk if
+        `src_dataset` is not chunked and the new dataset is compressed, or a contiguous dataset if the new
+        dataset is not compressed, by default None
+
+    Returns
+    -------
+    Tuple[h5py.h5p.PropDCID, Tuple[int]]
+        Dataset creation property list and maximum shape, see `write_raw_dataset`.
+
+    Raises
+    ------
+    ValueError
+        For an unknown or unavailable compression, or a chunk size smaller than 1.
+    """
+    if compression is not None and compression not in RAW_COMPRESSIONS:
+        raise ValueError(f"Unknown compression {compression}, choose from {RAW_COMPRESSIONS}.")
+    if compression == "vbz" and not h5py.h5z.filter_avail(VBZ.compression):
+        raise ValueError(f"VBZ compression filter (id={VBZ.compression}) is not available.")
+    if chunk_size is not None and chunk_size < 1:
+        raise ValueError(f"`chunk_size` should be at least 1, got {chunk_size}.")
+
+    dcpl = src_dataset.id.get_create_plist()
+
+    if compression is not None:
+        if dcpl.get_layout() == h5py.h5d.CHUNKED:
+            dcpl.remove_filter(h5py.h5z.FILTER_ALL)
+        if compression == "none" and chunk_size is None:
+            # uncompressed chunks are stored at full size, store the signal contiguously
+            dcpl.set_layout(h5py.h5d.CONTIGUOUS)
+        elif compression != "none" and dcpl.get_layout() != h5py.h5d.CHUNKED:
+            # filters need a chunked layout
+            dcpl.set_chunk((max(1, size),))
+        if compression == "gzip":
+            dcpl.set_deflate(GZIP.compression_opts)
+        elif compression == "vbz":
+            dcpl.set_filter(VBZ.compression, h5py.h5z.FLAG_OPTIONAL, VBZ.compression_opts)
+
+    if chunk_size is not None:
+        dcpl.set_chunk((chunk_size,))
+
+    if dcpl.get_layout() != h5py.h5d.CHUNKED:
+        return dcpl, (size,)
+    if src_dataset.maxshape[0] is None or size == 0:
+        return dcpl, (h5py.h5s.UNLIMITED,)
+
+    # fixed size dataset, chunks can not exceed the (shorter) signal
+    dcpl.set_chunk((min(dcpl.get_chunk()[0], size),))
+    return dcpl, (size,)
+
+
+def write_raw_dataset(
+    group: h5py.Group,
+    name: str,
+    signal: np.ndarray,
+    dcpl: h5py.h5p.PropDCID,
+    maxshape: Tuple[int],
+) -> h5py.Dataset:
+    """Write `signal` as dataset `name` of `group`, with the creation property list and maximum shape of
+    `raw_dataset_layout`."""
+    space = h5py.h5s.create_simple((signal.size,), maxshape)
+    dataset = h5py.Dataset(
+        h5py.h5d.create(group.id, name.encode(), h5py.h5t.py_create(signal.dtype), space, dcpl=dcpl)
+    )
+    if signal.size > 0:
+        dataset.write_direct(np.ascontiguousarray(signal))
+    return dataset
+
+
+def _copy_fast5_group(
+    src_group: h5py.Group,
+    dst_group: h5py.Group,
+    raw_path: List[str],
+    signal: np.ndarray,
+    hardlinks: dict,
+    compression: Optional[str] = None,
+    chunk_size: Optional[int] = None,
+) -> None:
+    """Copy the members of `src_group` to `dst_group`, except for the raw dataset at the relative path
+    `raw_path`, which is written as `signal`. Only the groups on the raw dataset path are traversed, all
+    other members are copied as a whole. Objects that are hard linked in the source file (e.g. the
+    `context_tags` and `tracking_id` groups shared by the reads of a multi fast5 file) are copied once and
+    hard linked again, `hardlinks` maps their source address to their path in the destination file.
+    See `raw_dataset_layout` for `compression` and `chunk_size`."""
+    for name in src_group:
+        obj = src_group[name]
+
+        if name == raw_path[0] and len(raw_path) == 1:
+            dcpl, maxshape = raw_dataset_layout(obj, signal.size, compression, chunk_size)
+            dataset = write_raw_dataset(dst_group, name, signal, dcpl, maxshape)
+            dataset.attrs.update(obj.attrs)
+        elif name == raw_path[0]:
+            group = dst_group.create_group(name)
+            group.attrs.update(obj.attrs)
+            if len(raw_path) == 2:
+                # raw dataset group, keep the dtype of the duration attribute
+                duration = obj.attrs.get("duration", np.uint32(0))
+                group.attrs["duration"] = np.asarray(signal.size, dtype=np.asarray(duration).dtype)
+            _copy_fast5_group(
+                obj, group, raw_path[1:], signal, hardlinks, compression, chunk_size
+            )
+        else:
+            info = h5py.h5o.get_info(obj.id)
+            if info.rc > 1 and info.addr in hardlinks:
+                dst_group[name] = dst_group.file[hardlinks[info.addr]]
+                continue
+
+            src_group.copy(obj, dst_group, name=name)
+            if info.rc > 1:
+                hardlinks[info.addr] = dst_group[name].name
+
+
+def write_sliced_fast5_file(
+    fast5_filepath_src: str,
+    fast5_filepath_dst: str,
+    slice_fn: Callable,
+    slice_kwargs: dict = dict(),
+    threads: int = 1,
+    read_range: Optional[Tuple[int, int]] = None,
+    compression: Optional[str] = None,
+    chunk_size: Optional[int] = None,
+    prefetch: int = 0,
+    record_errors: bool = False,
+) -> ResultsBatch:
+    """Write a new fast5 file with the reads of the source file, of which the raw signal is sliced.
+
+    The new file is written in a single pass: for every read, the raw signal slice is read from the source
+    file and written to a raw dataset with the compression and chunking of the source dataset (unless
+    `compression` or `chunk_size` are given), all other groups, datasets and attributes are copied
+    unchanged. The duration attribute of the raw dataset group is changed to the slice length. Hard links
+    between the reads of a multi fast5 file are kept. Reads that fail to process or to write are left out of
+    the new file.
+
+    Parameters
+    ----------
+    fast5_filepath_src : str
+        Path to fast5 file to process.
+    fast5_filepath_dst : str
+        Path to write the new fast5 file to, an existing file is overwritten.
+    slice_fn : Callable
+        Function that returns the processing results and raw signal slice (start, stop) of a read, called
+        as `slice_fn(read, **slice_kwargs)`. A stop of -1 indicates the signal end.
+    slice_kwargs : dict, optional
+        Keyword arguments for `slice_fn`, by default dict()
+    threads : int, optional
+        Number of threads to apply `slice_fn` with, see `process_fast5_file`. The new file is written by
+        the calling thread, by default 1
+    read_range : Tuple[int, int], optional
+        Only process and write the reads `[start, stop)` (in file order) of `read_range`. None indicates
+        all reads, by default None
+    compression : str, optional
+        Compression of the raw datasets, one of `RAW_COMPRESSIONS`. None indicates the compression of the
+        source raw datasets, by default None
+    chunk_size : int, optional
+        Chunk size of the raw datasets. None indicates the chunk size of the source raw datasets, by default None
+    prefetch : int, optional
+        Number of reads of which the stored raw signal is read ahead in the background, see
+        `_prefetch_reads`. 0 disables prefetching, by default 0
+    record_errors : bool, optional
+        Record the exceptions raised by reads that fail to process or to write, and by the file, as
+        `processError` in the errors of the returned results and continue with the next read, instead of
+        raising them, see `process_fast5_file`, by default False
+
+    Returns
+    -------
+    ResultsBatch
+        Processing results, with the path of the new fast5 file.
+    """
+
+    def _error(read_id, stage, exception):
+        if not record_errors:
+            raise exception
+        return processError.from_exception(fast5_filepath_dst, read_id, stage, exception)
+
+    def _slice_read(read):
+        read = ReadContext(read)
+        try:
+            return read, slice_fn(read, **slice_kwargs)
+        except Exception as e:
+            return read, _error(read.read_id, "process", e)
+
+    results = []
+    errors = []
+    hardlinks = dict()
+
+    try:
+        with open_fast5_file(fast5_filepath_src, mode="r") as f5, h5py.File(
+            fast5_filepath_dst, "w"
+        ) as dst:
+            dst.attrs.update(f5.handle.attrs)
+
+            # the full signal is written, prefetch it all
+            reads = _prefetch_reads(
+                _get_reads_in_range(f5, read_range), fast5_filepath_src, prefetch
+            )
+            if threads > 1:
+                sliced_reads = _ordered_thread_map(_slice_read, reads, threads)
+            else:
+                sliced_reads = map(_slice_read, reads)
+
+            for read, sliced in sliced_reads:
+                if isinstance(sliced, processError):
+                    errors.append(sliced)
+                    continue
+
+                res, start, stop = sliced
+                try:
+                    signal = read.get_raw_data(
+                        start=max(0, start), end=None if stop == -1 else stop, scale=False
+                    )
+                except Exception as e:
+                    errors.append(_error(read.read_id, "process", e))
+                    continue
+
+                src_group = read.handle
+                try:
+                    dst_group = dst.require_group(src_group.name)
+                    dst_group.attrs.update(src_group.attrs)
+                    _copy_fast5_group(
+                        src_group,
+                        dst_group,
+                        read.raw_dataset_name.split("/"),
+                        signal,
+                        hardlinks,
+                        compression,
+                        chunk_size,
+                    )
+                except Exception as e:
+                    errors.append(_error(read.read_id, "write", e))
+                    if src_group.name != "/" and src_group.name in dst:
+                        # drop the partially written read, and the hard linked objects copied with it
+                        del dst[src_group.name]
+                        for addr, path in list(hardlinks.items()):
+                            if path.startswith(src_group.name + "/"):
+                                del hardlinks[addr]
+                    continue
+
+                results.append(processResults(fast5_filepath_dst, read.read_id, res))
+    except Exception as e:
+        if not record_errors:
+            raise
+        errors.append(processError.from_exception(fast5_filepath_dst, None, "file", e))
+
+    return ResultsBatch.from_results(results, filepath=fast5_filepath_dst, errors=errors)
+
+
+def count_reads_in_fast5(fast5_filepath: str) -> int:
+    """Return the number of reads in a single or multi fast5 file."""
+    with open_fast5_file(fast5_filepath, mode="r") as f5:
+        return len(f5.get_read_ids())
+
+
+def make_work_units(
+    read_counts: List[int], unit_size: Optional[int] = None
+) -> List[Tuple[int, int, int]]:
+    """Split files into work units of consecutive reads, the files ordered largest first.
+
+    Parameters
+    ----------
+    read_counts : List[int]
+        Number of reads per file.
+    unit_size : int, optional
+        Maximum number of reads per work unit. None indicates a work unit per file, by default None
+
+    Returns
+    -------
+    List[Tuple[int, int, int]]
+        Work units (file index, start, stop) covering the reads `[start, stop)` of the file. The units of a
+        file are consecutive and in read order, so that a file completes without waiting for the units of
+        other files. Files are ordered by decreasing number of reads, files of equal size keep the file order.
+    """
+    units = []
+    for i in sorted(range(len(read_counts)), key=lambda i: -read_counts[i]):
+        n_reads = read_counts[i]
+        step = n_reads if unit_size is None else unit_size
+        units.extend((i, start, min(start + step, n_reads)) for start in range(0, n_reads, max(step, 1)))
+
+    return units
+
+
+def _count_reads(args: Tuple[str, bool]) -> Union[int, processError]:
+    """Count the reads of a fast5 file, returns the error of the file if it can not be read and errors are
+    recorded."""
+    fast5_filepath, record_errors = args
+    try:
+        return count_reads_in_fast5(fast5_filepath)
+    except Exception as e:
+        if not record_errors:
+            raise
+        return processError.from_exception(fast5_filepath, None, "file", e)
+
+
+def _process_work_unit(
+    unit: Tuple[Callable, tuple, int, int, int, bool, str, bool]
+) -> Tuple[int, int, ResultsBatch]:
+    """Apply `process_call` to a work unit, returns the file index, unit start and processing results. If
+    errors are recorded, an exception of `process_call` is returned as the error of the file."""
+    process_call, args, i, start, stop, whole_file, fast5_filepath, record_errors = unit
+    try:
+        if whole_file:
+            return i, start, process_call(*args)
+        return i, start, process_call(*args, read_range=(start, stop))
+    except Exception as e:
+        if not record_errors:
+            raise
+        return i, start, _file_error_batch(fast5_filepath, e)
+
+
+def _file_error_batch(fast5_filepath: str, exception: BaseException) -> ResultsBatch:
+    """Empty results of a fast5 file that failed to process."""
+    return ResultsBatch.from_results(
+        [],
+        filepath=fast5_filepath,
+        errors=[processError.from_exception(fast5_filepath, None, "file", exception)],
+    )
+
+
+def process_fast5_files(
+    process_call: Callable,
+    process_args: List[tuple],
+    fast5_filepaths: List[str],
+    processes: int = 1,
+    unit_size: Optional[int] = None,
+    record_errors: bool = False,
+    pool: Optional[Pool] = None,
+) -> Iterator[Tuple[int, ResultsBatch]]:
+    """Process fast5 files in work units of consecutive reads on a pool of processes.
+
+    The reads of every file are counted first. The files are then split into work units of at most
+    `unit_size` reads, see `make_work_units`. The files are processed largest first and the units of a file
+    one after the other, the units are collected as they complete. A large file does not keep a single
+    process busy at the end of a run, and every file completes without waiting for the units of other
+    files. The results of a file are yielded as soon as all of its work units are done, in file order.
+
+    Parameters
+    ----------
+    process_call : Callable
+        Function that processes a fast5 file, called as `process_call(*process_args[i])` for a whole file
+        and as `process_call(*process_args[i], read_range=(start, stop))` for a work unit, see
+        `process_fast5_file`. Should be picklable for `processes` > 1.
+    process_args : List[tuple]
+        Positional arguments of `process_call` per file.
+    fast5_filepaths : List[str]
+        Path of the fast5 file to count the reads of, per file.
+    processes : int, optional
+        Number of processes. For `processes` <= 1 the files are processed one by one in the calling
+        process, by default 1
+    unit_size : int, optional
+        Maximum number of reads per work unit. None indicates a work unit per file, by default None
+    record_errors : bool, optional
+        Return the exceptions raised by a file, while counting its reads or by `process_call`, as the
+        `processError` of the file in its results and continue with the other files, instead of raising them.
+        `process_call` should record the errors of failing reads itself, e.g. see `process_fast5_file`, by
+        default False
+    pool : Pool, optional
+        Pool of processes to process the files on instead of a new pool of `processes` processes, e.g. a pool
+        that is kept across calls. The pool is not closed. None indicates a new pool, by default None
+
+    Yields
+    ------
+    Iterator[Tuple[int, ResultsBatch]]
+        Index of the file in `process_args` and its processing results in file order, in order of completion.
+        The results of the work units of a file are concatenated.
+    """
+    if pool is None and (processes <= 1 or len(process_args) <= 1):
+        for i, args in enumerate(process_args):
+            try:
+                results = process_call(*args)
+            except Exception as e:
+                if not record_errors:
+                    raise
+                results = _file_error_batch(fast5_filepaths[i], e)
+            yield i, results
+        return
+
+    if pool is None:
+        with Pool(processes) as pool:
+            yield from _process_fast5_files_in_pool(
+                pool, process_call, process_args, fast5_filepaths, unit_size, record_errors
+            )
+    else:
+        yield from _process_fast5_files_in_pool(
+            pool, process_call, process_args, fast5_filepaths, unit_size, record_errors
+        )
+
+
+def _process_fast5_files_in_pool(
+    pool: Pool,
+    process_call: Callable,
+    process_args: List[tuple],
+    fast5_filepaths: List[str],
+    unit_size: Optional[int] = None,
+    record_errors: bool = False,
+) -> Iterator[Tuple[int, ResultsBatch]]:
+    """Process fast5 files in work units on `pool`, see `process_fast5_files`."""
+    read_counts = pool.map(_count_reads, [(path, record_errors) for path in fast5_filepaths])
+    # files that can not be read have no reads to process
+    count_errors = dict()
+    for i, n_reads in enumerate(read_counts):
+        if isinstance(n_reads, processError):
+            count_errors[i] = [n_reads]
+            read_counts[i] = 0
+    units = make_work_units(read_counts, unit_size)
+
+    # files without reads have no work units
+    n_pending = [0] * len(process_args)
+    for i, _, _ in units:
+        n_pending[i] += 1
+    for i, n_units in enumerate(n_pending):
+        if n_units == 0:
+            yield i, ResultsBatch.from_results(
+                [], filepath=fast5_filepaths[i], errors=count_errors.get(i)
+            )
+
+    partial_results = [dict() for _ in process_args]
+    for i, start, results in pool.imap_unordered(
+        _process_work_unit,
+        (
+            (
+                process_call,
+                process_args[i],
+                i,
+                start,
+                stop,
+                start == 0 and stop == read_counts[i],
+                fast5_filepaths[i],
+                record_errors,
+            )
+            for i, start, stop in units
+        ),
+    ):
+        partial_results[i][start] = results
+        n_pending[i] -= 1
+        if n_pending[i] == 0:
+            batches = [
+                batch
+                for _, res in sorted(partial_results[i].items())
+                for batch in to_results_batches(res)
+            ]
+            if len(batches) == 0:
+                yield i, ResultsBatch.from_results([], filepath=fast5_filepaths[i])
+            else:
+                yield i, ResultsBatch.concat(batches)
+            partial_results[i] = None
+
+
+def in_file_order(
+    results: Iterable[Tuple[int, ResultsBatch]]
+) -> Iterator[Tuple[int, ResultsBatch]]:
+    """Yield the file results of `process_fast5_files` in file order, e.g. to append them to a global output.
+    Files that complete early are held until the files before them are done.
+
+    Parameters
+    ----------
+    results : Iterable[Tuple[int, ResultsBatch]]
+        Index of the file and its processing results, every file index once, in order of completion.
+
+    Yields
+    ------
+    Iterator[Tuple[int, ResultsBatch]]
+        Index of the file and its processing results, in order of the file index.
+    """
+    pending = dict()
+    next_i = 0
+    for i, file_results in results:
+        pending[i] = file_results
+        while next_i in pending:
+            yield next_i, pending.pop(next_i)
+            next_i += 1
+
+
+def watch_fast5_files(
+    input_path: str,
+    interval: float = 10.0,
+    settle_time: float = 60.0,
+    timeout: Optional[float] = None,
+    stop_file: Optional[str] = None,
+) -> Iterator[List[str]]:
+    """Poll a directory for fast5 files that are being written, e.g. by a sequencer, and yield them once they
+    are complete.
+
+    A fast5 file is complete when it was last modified at least `settle_time` seconds ago, and its size and
+    modification time did not change since the previous poll, so a file is complete at the earliest on the
+    second poll it is seen in. Yielded files are not checked again. Polling stops when
+    the directory did not change for `timeout` seconds, or when `stop_file` exists. All remaining fast5 files
+    are then yielded as complete after a stop file, and left out after a timeout.
+
+    Parameters
+    ----------
+    input_path : str
+        Directory to watch.
+    interval : float, optional
+        Time between polls in seconds, by default 10.0
+    settle_time : float, optional
+        Minimum time since the last modification of a complete file in seconds, by default 60.0
+    timeout : float, optional
+        Stop when no fast5 file was added or changed for `timeout` seconds. None indicates no timeout, by
+        default None
+    stop_file : str, optional
+        Stop when a file exists at this path. None indicates no stop file, by default None
+
+    Yields
+    ------
+    Iterator[List[str]]
+        Paths of the fast5 files completed since the previous poll, sorted, as `os.path.join(input_path, name)`.
+        Every fast5 file is yielded once. The time between polls includes the time the caller takes to process
+        the yielded files.
+    """
+    done = set()
+    last_stats = dict()
+    last_change = time.monotonic()
+
+    while True:
+        stop = stop_file is not None and os.path.exists(stop_file)
+
+        stats = dict()
+        with os.scandir(input_path) as entries:
+            for entry in entries:
+                if entry.name.endswith(".fast5") and entry.path not in done:
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:  # removed since listed
+                        continue
+                    stats[entry.path] = (stat.st_size, stat.st_mtime_ns)
+
+        if stats != last_stats:
+            last_change = time.monotonic()
+        now = time.time_ns()
+        complete = sorted(
+            path
+            for path, stat in stats.items()
+            if stop or (last_stats.get(path) == stat and now - stat[1] >= settle_time * 1e9)
+        )
+        last_stats = {path: stat for path, stat in stats.items() if path not in complete}
+
+        if len(complete):
+            done.update(complete)
+            yield complete
+            last_change = time.monotonic()
+        if stop or (timeout is not None and time.monotonic() - last_change >= timeout):
+            return
+        if len(complete) == 0:
+            time.sleep(interval)
 
 
 def remove_reads_from_multi_fast5(
@@ -146,6 +1303,716 @@ def remove_reads_from_fast5(fast5_filepath: str, read_ids: List[str]) -> None:
         os.remove(fast5_filepath)
 
 
+RESULTS_TO_DF_FNS = {
+    "detect": detect_results_to_df,
+    "extract": extract_results_to_df,
+}
+RESULTS_OUTNAMES = {
+    "detect": "detected_adapter_boundaries",
+    "extract": "extracted_adapters",
+}
+OUTPUT_FORMATS = ["csv", "parquet", "feather"]
+
+
+def _rel_filepath(filepath: str, remove_from_filepath: List[str] = []) -> str:
+    """Remove the strings of `remove_from_filepath` from `filepath`."""
+    for rem_str in remove_from_filepath:
+        filepath = filepath.replace(rem_str, "")
+    return filepath
+
+
+def _output_suffix(rel_filepath: str) -> str:
+    """Suffix of the per-file outputs of the fast5 file at `rel_filepath`."""
+    filename = os.path.splitext(os.path.basename(rel_filepath))[0]
+    subdirname = os.path.basename(os.path.dirname(rel_filepath))
+    if len(subdirname):
+        filename = subdirname + "_" + filename
+    return "_" + filename
+
+
+class _TableAppender:
+    """Table file that is appended to in batches of rows, in 'csv', 'parquet' or 'feather' format.
+
+    Csv tables are semicolon-separated and flushed per batch. Parquet and feather (Arrow IPC) tables are
+    zstd-compressed, with a row group or record batch per batch. Their column types follow the DataFrame
+    dtypes, string columns are stored as strings and `rel_filepath` is dictionary-encoded in parquet tables.
+    The file is created on the first batch.
+    """
+
+    def __init__(self, path: str, output_format: str):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(
+                f"Unknown output format `{output_format}`, expected one of {OUTPUT_FORMATS}."
+            )
+        if output_format != "csv" and pa is None:
+            raise ImportError(
+                f"Output format `{output_format}` requires pyarrow, install it with `pip install pyarrow`."
+            )
+
+        self.path = path
+        self.output_format = output_format
+        self._writer = None
+
+    def _to_arrow(self, df: pd.DataFrame):
+        fields = []
+        for name, dtype in df.dtypes.items():
+            if name == "rel_filepath" and self.output_format == "parquet":
+                # Arrow IPC files do not support dictionaries that grow across batches
+                type_ = pa.dictionary(pa.int32(), pa.string())
+            elif pd.api.types.is_string_dtype(dtype):
+                type_ = pa.string()
+            else:
+                type_ = pa.from_numpy_dtype(dtype)
+            fields.append(pa.field(name, type_))
+
+        return pa.Table.from_pandas(df, schema=pa.schema(fields), preserve_index=False)
+
+    def append(self, df: pd.DataFrame):
+        if self.output_format == "csv":
+            header = self._writer is None
+            if self._writer is None:
+                self._writer = open(self.path, "w")
+            df.to_csv(self._writer, sep=";", index=False, header=header)
+            self._writer.flush()
+            return
+
+        table = self._to_arrow(df)
+        if self._writer is None:
+            if self.output_format == "parquet":
+                self._writer = pq.ParquetWriter(self.path, table.schema, compression="zstd")
+            else:  # "feather"
+                self._writer = pa.ipc.new_file(
+                    self.path, table.schema, options=pa.ipc.IpcWriteOptions(compression="zstd")
+                )
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+class ResultsWriter:
+    """Streaming writer of processing results, results are written per processed file.
+
+    With per-file outputs, the table of a file is written to a temporary file that is renamed when complete.
+    With a global output, the results of every file are appended to a single table, the rows of a file are
+    contiguous and the files are in the order they are written. Only the results of the file being written
+    are held in memory, results of completed files survive an interrupted run (the footer of a global parquet
+    or feather table is only written when the writer is closed).
+    Use one writer per output directory, in a single process.
+
+    Parameters
+    ----------
+    outdir : str
+        The location to save the output tables to
+    adapt_modes : List[str]
+        Output modes, each one of 'detect' and 'extract'
+    remove_from_filepath : List[str], optional
+        List of strings to remove from absolute filepath to
+        obtain relative filepath to `input_dir`, by default []
+    global_output : bool, optional
+        Boolean flag that indicates whether to output a table describing all processed files instead of a table per
+        file, by default False
+    output_format : str, optional
+        Format of the 'detect' tables, one of 'csv', 'parquet' and 'feather'. The 'parquet' and 'feather' formats
+        require pyarrow. The 'extract' tables are always written as csv, by default 'csv'
+    """
+
+    def __init__(
+        self,
+        outdir: str,
+        adapt_modes: List[str],
+        remove_from_filepath: List[str] = [],
+        global_output: bool = False,
+        output_format: str = "csv",
+    ):
+        self.outdir = outdir
+        self.adapt_modes = adapt_modes
+        self.remove_from_filepath = remove_from_filepath
+        self.global_output = global_output
+        self.output_formats = {
+            adapt_mode: output_format if adapt_mode == "detect" else "csv"
+            for adapt_mode in adapt_modes
+        }
+
+        self._global_tables = dict()
+        if global_output:
+            for adapt_mode in adapt_modes:
+                self._global_tables[adapt_mode] = self._open(adapt_mode, "")
+
+    def _open(self, adapt_mode: str, suffix: str, tmp: str = "") -> _TableAppender:
+        output_format = self.output_formats[adapt_mode]
+        path = os.path.join(self.outdir, f"{RESULTS_OUTNAMES[adapt_mode]}{suffix}.{output_format}")
+        return _TableAppender(path + tmp, output_format)
+
+    def write(self, file_results: Union[ResultsBatch, List[processResults]]) -> List[str]:
+        """Write the processing results of a file.
+
+        Parameters
+        ----------
+        file_results : Union[ResultsBatch, List[processResults]]
+            Processing results of the reads of a single file, files without reads are skipped.
+
+        Returns
+        -------
+        List[str]
+            Paths of the per-file output tables written, empty for a global output.
+        """
+        if len(file_results) == 0:
+            return []
+        results = ResultsBatch.concat(to_results_batches(file_results))
+        rel_filepath = _rel_filepath(results.filepath, self.remove_from_filepath)
+
+        written = []
+        for adapt_mode in self.adapt_modes:
+            results_df = RESULTS_TO_DF_FNS[adapt_mode](results)
+            results_df["rel_filepath"] = rel_filepath
+
+            if self.global_output:
+                self._global_tables[adapt_mode].append(results_df)
+            else:
+                table = self._open(adapt_mode, _output_suffix(rel_filepath), tmp=".tmp")
+                table.append(results_df)
+                table.close()
+                os.replace(table.path, table.path[: -len(".tmp")])
+                written.append(table.path[: -len(".tmp")])
+
+        return written
+
+    def close(self):
+        """Close the global output tables."""
+        for table in self._global_tables.values():
+            table.close()
+        self._global_tables = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class _NpyAppender:
+    """One-dimensional .npy file that is appended to, the header is updated after every append so the
+    file is a valid .npy file of the data appended so far."""
+
+    def __init__(self, path: str, dtype: np.dtype):
+        self.dtype = np.dtype(dtype)
+        self.size = 0
+        self._f = open(path, "wb")
+        self._header_size = self._write_header()
+
+    def _write_header(self) -> int:
+        self._f.seek(0)
+        np.lib.format.write_array_header_1_0(
+            self._f,
+            {
+                "descr": np.lib.format.dtype_to_descr(self.dtype),
+                "fortran_order": False,
+                "shape": (self.size,),
+            },
+        )
+        return self._f.tell()
+
+    def append(self, arr: np.ndarray):
+        self._f.seek(0, os.SEEK_END)
+        self._f.write(np.ascontiguousarray(arr, dtype=self.dtype).tobytes())
+        self.size += len(arr)
+        if self._write_header() != self._header_size:
+            # the header of one-dimensional arrays is padded to a fixed size
+            raise RuntimeError("The .npy header size changed while appending.")
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+
+class _Hdf5Appender:
+    """HDF5 file with resizable one-dimensional datasets that are appended to."""
+
+    def __init__(self, path: str, dtypes: dict):
+        self._f = h5py.File(path, "w")
+        for name, dtype in dtypes.items():
+            self._f.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=True)
+
+    def size(self, name: str) -> int:
+        return self._f[name].shape[0]
+
+    def append(self, name: str, arr):
+        dataset = self._f[name]
+        size = dataset.shape[0]
+        dataset.resize((size + len(arr),))
+        dataset[size:] = arr
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+
+EXTRACT_METADATA_COLUMNS = [
+    "rel_filepath",
+    "read_id",
+    "extraction_buffer",
+    "digitisation",
+    "range",
+    "offset",
+]
+
+
+class ExtractedSignalWriter:
+    """Streaming writer of extracted adapter signals as a ragged array, results are written per processed file.
+
+    The adapter signals of all reads with a detected adapter are concatenated in a single np.int16 array,
+    with an np.int64 offsets index of N+1 entries: the adapter signal of read i is `signal[offsets[i]:offsets[i+1]]`.
+    The metadata table describes the reads in the same order, see `read_extracted_adapters`.
+
+    In 'npy' format `extracted_adapters[SUFFIX]_signal.npy`, `extracted_adapters[SUFFIX]_offsets.npy` and
+    the `extracted_adapters[SUFFIX]_metadata` table are written, the arrays can be memory-mapped. In 'hdf5' format a single
+    `extracted_adapters[SUFFIX].hdf5` file is written with the `signal` and `offsets` datasets and a dataset per
+    metadata column. Per-file outputs are written to temporary files that are renamed when complete. A global output
+    is appended to per file, like in `ResultsWriter`.
+
+    Parameters
+    ----------
+    outdir : str
+        The location to save the output files to
+    extract_format : str
+        One of 'npy' and 'hdf5'
+    remove_from_filepath : List[str], optional
+        List of strings to remove from absolute filepath to
+        obtain relative filepath to `input_dir`, by default []
+    global_output : bool, optional
+        Boolean flag that indicates whether to output files describing all processed files instead of per
+        file, by default False
+    output_format : str, optional
+        Format of the metadata table in 'npy' format, see `ResultsWriter`, by default 'csv'
+    """
+
+    def __init__(
+        self,
+        outdir: str,
+        extract_format: str,
+        remove_from_filepath: List[str] = [],
+        global_output: bool = False,
+        output_format: str = "csv",
+    ):
+        if extract_format not in ["npy", "hdf5"]:
+            raise ValueError(f"Unknown extract format `{extract_format}`, expected 'npy' or 'hdf5'.")
+
+        self.outdir = outdir
+        self.extract_format = extract_format
+        self.remove_from_filepath = remove_from_filepath
+        self.global_output = global_output
+        self.output_format = output_format
+
+        self._global_output = None
+        if global_output:
+            self._global_output = self._open(os.path.join(outdir, RESULTS_OUTNAMES["extract"]))
+
+    def _paths(self, prefix: str) -> List[str]:
+        if self.extract_format == "npy":
+            return [
+                f"{prefix}_signal.npy",
+                f"{prefix}_offsets.npy",
+                f"{prefix}_metadata.{self.output_format}",
+            ]
+        return [f"{prefix}.hdf5"]
+
+    def _open(self, prefix: str, tmp: str = ""):
+        paths = [path + tmp for path in self._paths(prefix)]
+
+        if self.extract_format == "npy":
+            signal = _NpyAppender(paths[0], np.int16)
+            offsets = _NpyAppender(paths[1], np.int64)
+            offsets.append(np.zeros(1, dtype=np.int64))
+            metadata = _TableAppender(paths[2], self.output_format)
+            return signal, offsets, metadata
+
+        output = _Hdf5Appender(
+            paths[0],
+            dict(
+                signal=np.int16,
+                offsets=np.int64,
+                rel_filepath=h5py.string_dtype(),
+                read_id=h5py.string_dtype(),
+                extraction_buffer=np.int64,
+                digitisation=np.float64,
+                range=np.float64,
+                offset=np.float64,
+            ),
+        )
+        output.append("offsets", np.zeros(1, dtype=np.int64))
+        return output
+
+    def _append(
+        self, output, signals: List[np.ndarray], offsets: np.ndarray, metadata: pd.DataFrame
+    ):
+        if self.extract_format == "npy":
+            signal_out, offsets_out, metadata_out = output
+            offsets_out.append(offsets + signal_out.size)
+            for signal in signals:
+                signal_out.append(signal)
+            metadata_out.append(metadata)
+        else:
+            output.append("offsets", offsets + output.size("signal"))
+            for signal in signals:
+                output.append("signal", signal)
+            for column in EXTRACT_METADATA_COLUMNS:
+                output.append(column, metadata[column].to_numpy())
+            output.flush()
+
+    def _close(self, output):
+        if self.extract_format == "npy":
+            for f in output:
+                f.close()
+        else:
+            output.close()
+
+    def write(self, file_results: Union[ResultsBatch, List[processResults]]) -> List[str]:
+        """Write the extracted adapter signals of a file.
+
+        Parameters
+        ----------
+        file_results : Union[ResultsBatch, List[processResults]]
+            Adapter extraction results of the reads of a single file, files without reads are skipped.
+
+        Returns
+        -------
+        List[str]
+            Paths of the per-file output files written, empty for a global output.
+        """
+        if len(file_results) == 0:
+            return []
+        results = ResultsBatch.concat(to_results_batches(file_results))
+        rel_filepath = _rel_filepath(results.filepath, self.remove_from_filepath)
+
+        extracted = np.flatnonzero(results.detected)
+        offsets = np.cumsum(results.signal_sizes()[extracted], dtype=np.int64)
+        # adapter signals in shard files are copied from the memory-mapped shards
+        signals = results.adapter_signal_pieces(extracted)
+        records = results.records[extracted]
+        metadata = pd.DataFrame(
+            {
+                "rel_filepath": np.full(extracted.size, rel_filepath, dtype=object),
+                "read_id": results.read_ids[extracted],
+                "extraction_buffer": records["extract_buffer"],
+                "digitisation": records["digitisation"],
+                "range": records["pA_range"],
+                "offset": records["offset"],
+            }
+        )
+
+        if self.global_output:
+            self._append(self._global_output, signals, offsets, metadata)
+            return []
+
+        suffix = _output_suffix(rel_filepath)
+        prefix = os.path.join(self.outdir, f"{RESULTS_OUTNAMES['extract']}{suffix}")
+        output = self._open(prefix, tmp=".tmp")
+        self._append(output, signals, offsets, metadata)
+        self._close(output)
+        for path in self._paths(prefix):
+            os.replace(f"{path}.tmp", path)
+        return self._paths(prefix)
+
+    def close(self):
+        """Close the global output files."""
+        if self._global_output is not None:
+            self._close(self._global_output)
+            self._global_output = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# run manifest in the save path, see `RunManifest`
+MANIFEST_NAME = "adapt_manifest.jsonl"
+
+
+class RunManifest:
+    """Manifest of the files completed by a run, in the save path. Used to resume an interrupted run, or to
+    only process the new or changed files of an input directory.
+
+    The manifest is a JSON lines file with an entry per completed file: its source path, size and
+    modification time, the run parameters and the output files written for it (relative to the save path).
+    An entry is appended and synced to disk as soon as the outputs of a file are written, so the manifest
+    describes the completed files when a run is interrupted at any point. A partially written last line is
+    ignored.
+
+    A file is complete if the manifest has an entry for it with the current size and modification time of
+    the file and the same parameters, of which all output files exist.
+
+    Parameters
+    ----------
+    save_path : str
+        The location of the run outputs and the manifest.
+    params : dict
+        JSON-serializable run parameters, that should be equal for a file to be complete.
+    resume : bool, optional
+        Keep and extend the manifest of a previous run. If False, a new manifest is started, by default False
+    """
+
+    def __init__(self, save_path: str, params: dict, resume: bool = False):
+        self.save_path = save_path
+        self.path = os.path.join(save_path, MANIFEST_NAME)
+        # parameters as read back from the manifest
+        self.params = json.loads(json.dumps(params))
+
+        self._entries = dict()
+        if resume and os.path.isfile(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:  # interrupted write
+                        continue
+                    self._entries[entry["src"]] = entry
+
+        self._f = open(self.path, "a" if resume else "w")
+        if self._f.tell() > 0:
+            with open(self.path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # complete the partially written last line, it is ignored
+                    self._f.write("\n")
+
+    def is_complete(self, src: str) -> bool:
+        """Whether the file at `src` was completed with the same parameters and is unchanged since."""
+        entry = self._entries.get(os.path.abspath(src))
+        if entry is None or entry["params"] != self.params:
+            return False
+
+        stat = os.stat(src)
+        return (
+            entry["size"] == stat.st_size
+            and entry["mtime_ns"] == stat.st_mtime_ns
+            and all(os.path.isfile(os.path.join(self.save_path, path)) for path in entry["outputs"])
+        )
+
+    def record(self, src: str, outputs: List[str], n_errors: int = 0) -> None:
+        """Record the file at `src` as completed, with the paths of the output files written for it and the
+        number of its reads that failed to process."""
+        stat = os.stat(src)
+        entry = dict(
+            src=os.path.abspath(src),
+            size=stat.st_size,
+            mtime_ns=stat.st_mtime_ns,
+            params=self.params,
+            outputs=[os.path.relpath(path, self.save_path) for path in outputs],
+            errors=n_errors,
+        )
+        self._f.write(json.dumps(entry) + "\n")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._entries[entry["src"]] = entry
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+ERRORS_NAME = "adapt_errors.csv"
+
+
+class ErrorsWriter:
+    """Streaming writer of the errors of the files and reads that failed to process, to a semicolon-separated
+    csv in the save path with the columns `rel_filepath`, `read_id` (empty for errors of a whole file),
+    `stage` (see `adapt.utils.ERROR_STAGES`), `exception` and `message`. The errors are appended and flushed
+    per file, the csv is created on the first error.
+
+    Parameters
+    ----------
+    save_path : str
+        The location of the run outputs and the errors csv.
+    remove_from_filepath : List[str], optional
+        List of strings to remove from absolute filepath to
+        obtain relative filepath to `input_dir`, by default []
+    resume : bool, optional
+        Append to the errors csv of a previous run. If False, an existing errors csv is removed, by default False
+    """
+
+    def __init__(self, save_path: str, remove_from_filepath: List[str] = [], resume: bool = False):
+        self.path = os.path.join(save_path, ERRORS_NAME)
+        self.remove_from_filepath = remove_from_filepath
+        self.n_errors = 0
+        self._f = None
+
+        if not resume and os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def write(self, errors: List[processError]) -> None:
+        """Write the errors of a file."""
+        if len(errors) == 0:
+            return
+
+        if self._f is None:
+            self._f = open(self.path, "a")
+        df = pd.DataFrame(errors, columns=processError._fields)
+        df["filepath"] = [_rel_filepath(path, self.remove_from_filepath) for path in df.filepath]
+        df = df.rename(columns={"filepath": "rel_filepath"})
+        df.to_csv(self._f, sep=";", index=False, header=self._f.tell() == 0)
+        self._f.flush()
+        self.n_errors += len(errors)
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_table(path: str) -> pd.DataFrame:
+    """Read a table written by `ResultsWriter` or `ExtractedSignalWriter`, the format follows from the extension.
+
+    Parameters
+    ----------
+    path : str
+        Path of the csv, parquet or feather table.
+
+    Returns
+    -------
+    pd.DataFrame
+        The table.
+    """
+    output_format = os.path.splitext(path)[1][1:]
+    if output_format == "parquet":
+        return pd.read_parquet(path)
+    if output_format == "feather":
+        return pd.read_feather(path)
+    return pd.read_csv(path, sep=";")
+
+
+class AdapterBoundaries:
+    """Lookup of adapter boundaries by read id, the read ids are kept sorted for binary search.
+
+    Parameters
+    ----------
+    read_ids : Iterable[str]
+        Read ids, for duplicate read ids the first boundaries are kept.
+    adapter_start : Iterable[int]
+        Adapter start per read.
+    adapter_end : Iterable[int]
+        Adapter end per read.
+    """
+
+    def __init__(self, read_ids: Iterable[str], adapter_start: Iterable[int], adapter_end: Iterable[int]):
+        read_ids = np.asarray(read_ids, dtype=str)
+        order = np.argsort(read_ids, kind="stable")
+        read_ids = read_ids[order]
+
+        # stable sort, the first of duplicate read ids is kept
+        first = np.ones(read_ids.size, dtype=bool)
+        first[1:] = read_ids[1:] != read_ids[:-1]
+
+        self.read_ids = read_ids[first]
+        self.adapter_start = np.asarray(adapter_start, dtype=np.int64)[order][first]
+        self.adapter_end = np.asarray(adapter_end, dtype=np.int64)[order][first]
+
+    def __len__(self) -> int:
+        return self.read_ids.size
+
+    def get(self, read_id: str) -> Optional[detectResults]:
+        """Return the adapter boundaries of a read, None if the read is not in the lookup."""
+        i = np.searchsorted(self.read_ids, read_id)
+        if i == self.read_ids.size or self.read_ids[i] != read_id:
+            return None
+        return detectResults(int(self.adapter_start[i]), int(self.adapter_end[i]))
+
+
+@lru_cache(maxsize=4)
+def load_adapter_boundaries(path: str) -> AdapterBoundaries:
+    """Load the detected adapter boundaries of a previous detect run, cached per process.
+
+    Parameters
+    ----------
+    path : str
+        Path of a detected adapter boundaries table written by `ResultsWriter` (csv, parquet or feather), or
+        of a directory, in which case all detected adapter boundaries tables in it are loaded.
+
+    Returns
+    -------
+    AdapterBoundaries
+        Lookup of the adapter boundaries by read id.
+
+    Raises
+    ------
+    ValueError
+        If the directory contains no detected adapter boundaries tables.
+    """
+    if os.path.isdir(path):
+        paths = sorted(
+            p
+            for output_format in OUTPUT_FORMATS
+            for p in glob.glob(os.path.join(path, f"{RESULTS_OUTNAMES['detect']}*.{output_format}"))
+        )
+        if len(paths) == 0:
+            raise ValueError(f"{path} contains no detected adapter boundaries tables.")
+    else:
+        paths = [path]
+
+    columns = ["read_id", "adapter_start", "adapter_end"]
+    df = pd.concat([read_table(p)[columns] for p in paths], ignore_index=True)
+
+    return AdapterBoundaries(df.read_id, df.adapter_start, df.adapter_end)
+
+
+def read_extracted_adapters(path: str, mmap: bool = True) -> Tuple[pd.DataFrame, np.ndarray, np.ndarray]:
+    """Read extracted adapter signals written in 'npy' or 'hdf5' format, see `ExtractedSignalWriter`.
+
+    Parameters
+    ----------
+    path : str
+        Path of the `extracted_adapters[SUFFIX].hdf5` file, or the `extracted_adapters[SUFFIX]` prefix of the
+        'npy' format files.
+    mmap : bool, optional
+        Memory-map the 'npy' format signal and offsets, by default True
+
+    Returns
+    -------
+    Tuple[pd.DataFrame, np.ndarray, np.ndarray]
+        Metadata table (see `read_table`), concatenated np.int16 adapter signals and np.int64 offsets. The adapter signal of the read
+        in row i of the metadata table is `signal[offsets[i]:offsets[i+1]]`.
+    """
+    if path.endswith(".hdf5"):
+        with h5py.File(path, "r") as f:
+            metadata = pd.DataFrame(
+                {
+                    column: f[column].asstr()[:] if f[column].dtype.kind == "O" else f[column][:]
+                    for column in EXTRACT_METADATA_COLUMNS
+                }
+            )
+            return metadata, f["signal"][:], f["offsets"][:]
+
+    mmap_mode = "r" if mmap else None
+    return (
+        read_table(
+            next(
+                f"{path}_metadata.{output_format}"
+                for output_format in OUTPUT_FORMATS
+                if os.path.isfile(f"{path}_metadata.{output_format}")
+            )
+        ),
+        np.load(f"{path}_signal.npy", mmap_mode=mmap_mode),
+        np.load(f"{path}_offsets.npy", mmap_mode=mmap_mode),
+    )
+
+
 def write_results_to_csv(
     process_results: List[List[processResults]],
     outdir: str,
@@ -153,7 +2020,7 @@ def write_results_to_csv(
     remove_from_filepath: List[str] = [],
     global_output: bool = False,
 ):
-    """Write processing results to disk.
+    """Write processing results to disk, see `ResultsWriter` to write results while processing.
 
     Parameters
     ----------
@@ -163,7 +2030,7 @@ def write_results_to_csv(
     outdir : str
         The location to save the output csv to
     adapt_mode : str
-        One of 'detect', 'trim' and 'extract'
+        One of 'detect' and 'extract'
     remove_from_filepath : List[str], optional
         List of strings to remove from absolute filepath to
         obtain relative filepath to `input_dir`, by default []
@@ -171,58 +2038,6 @@ def write_results_to_csv(
         Boolean flag that indicates whether to output a csv describing all processed files instead of a csv per
                       file, by default False
     """
-
-    def _write_results_to_csv_mode_aux(adapt_mode: str):
-        results_to_df_fn = {
-            "detect": detect_results_to_df,
-            "extract": extract_results_to_df,
-        }[adapt_mode]
-        outname = {
-            "detect": "detected_adapter_boundaries",
-            "extract": "extracted_adapters",
-        }[adapt_mode]
-
-        return results_to_df_fn, outname
-
-    def _write_to_csv(
-        results_df: pd.DataFrame,
-        outdir: str,
-        outname: str,
-        remove_from_filepath=[],
-        global_output=False,
-    ):
-        suffix = ""
-        for rem_str in remove_from_filepath:
-            results_df.rel_filepath = results_df.rel_filepath.apply(
-                lambda x: x.replace(rem_str, "")
-            )
-
-        if not global_output:
-            filename = os.path.splitext(
-                os.path.basename(results_df.rel_filepath.unique().item())
-            )[0]
-            subdirname = os.path.basename(
-                os.path.dirname(results_df.rel_filepath.unique().item())
-            )
-            if len(subdirname):
-                filename = subdirname + "_" + filename
-            suffix = "_" + filename
-
-        results_df.to_csv(
-            os.path.join(outdir, f"{outname}{suffix}.csv"),
-            sep=";",
-            index=False,
-        )
-
-    to_df_fn, outname = _write_results_to_csv_mode_aux(adapt_mode)
-
-    results_dfs = [to_df_fn(r) for r in process_results]
-
-    if global_output:
-        results_df = pd.concat(results_dfs)
-        _write_to_csv(results_df, outdir, outname, remove_from_filepath, global_output)
-    else:
-        for results_df in results_dfs:
-            _write_to_csv(
-                results_df, outdir, outname, remove_from_filepath, global_output
-            )
+    with ResultsWriter(outdir, [adapt_mode], remove_from_filepath, global_output) as writer:
+        for file_results in process_results:
+            writer.write(file_results)
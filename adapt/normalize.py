@@ -6,35 +6,86 @@ Copyright (c) 2023 Wiep K. van der Toorn (w.vandertoorn@fu-berlin.de)
 """
 
 
+from typing import Optional
+
 import numpy as np
 
+try:
+    from ._c_normalize import c_normalize_int16
+except ImportError:  # compiled extension not built, normalize with numpy
+    c_normalize_int16 = None
+
 
-def normalize_signal(signal: np.ndarray, outlier_thresh: int = 5) -> np.ndarray:
+def normalize_signal(
+    signal: np.ndarray,
+    outlier_thresh: int = 5,
+    norm_window: Optional[int] = None,
+    max_obs: Optional[int] = None,
+    out: Optional[np.ndarray] = None,
+    hist: Optional[np.ndarray] = None,
+) -> np.ndarray:
     """MED/MAD normalization with windsorizing
 
+    Signals of dtype np.int16 (raw fast5 signal) are normalized with exact histogram-based
+    MED/MAD statistics in a single pass if the compiled extension is available, other signals
+    are normalized with numpy. Both give identical results.
+
     Parameters
     ----------
     signal : np.ndarray
         signal to normalize
     outlier_thresh : int, optional
         windsorize threshold, by default 5
+    norm_window : int, optional
+        Compute the MED/MAD and windsorizing limits over the first `norm_window` data points only.
+        None indicates the full signal, by default None
+    max_obs : int, optional
+        Only normalize (and return) the first `max_obs` data points. None indicates the full signal,
+        by default None
+    out : np.ndarray, optional
+        Preallocated np.float64 buffer to write the normalized signal to, should be at least as long as
+        the normalized signal. None indicates a new array is allocated, by default None
+    hist : np.ndarray, optional
+        Preallocated zero-filled np.int64 buffer of size 65536 for the histogram-based normalization of
+        np.int16 signals, it is zero-filled again on return. None indicates a new buffer is allocated
+        when needed, by default None
 
     Returns
     -------
     np.ndarray
         numpy array with dtype np.float64 of normalized signal
     """
-    shift = np.median(signal)
-    scale = np.median(np.abs(signal - shift))
+    n_stats = signal[:norm_window].size
+    n_out = signal[:max_obs].size
+
+    if out is None:
+        out = np.empty(n_out, dtype=np.float64)
+    norm_signal = out[:n_out]
 
-    norm_signal = (signal - shift) / scale
+    if c_normalize_int16 is not None and signal.dtype == np.int16 and n_stats > 0:
+        c_normalize_int16(
+            np.ascontiguousarray(signal), n_stats, outlier_thresh, norm_signal, hist
+        )
+        return norm_signal
+
+    stats_signal = signal[:n_stats]
+
+    shift = np.median(stats_signal)
+    scale = np.median(np.abs(stats_signal - shift))
+
+    norm_stats = (stats_signal - shift) / scale
 
     # windsorize the raw signal
-    read_med = np.median(norm_signal)
-    read_mad = np.median(np.abs(norm_signal - read_med))
+    read_med = np.median(norm_stats)
+    read_mad = np.median(np.abs(norm_stats - read_med))
     lower_lim = read_med - (read_mad * outlier_thresh)
     upper_lim = read_med + (read_mad * outlier_thresh)
 
+    if n_stats >= n_out:
+        norm_signal[:] = norm_stats[:n_out]
+    else:
+        np.divide(signal[:n_out] - shift, scale, out=norm_signal)
+
     norm_signal[norm_signal < lower_lim] = lower_lim
     norm_signal[norm_signal > upper_lim] = upper_lim
 
@@ -63,6 +63,31 @@ parent_parser.add_argument(
     help="Size of pool used for multiprocessing read files.",
 )
 
+parent_parser.add_argument(
+    "--unit_size",
+    type=int,
+    default=500,
+    help="Maximum number of reads per work unit. Files are split into work units of consecutive reads, "
+    "\nwhich are distributed over the `j` processes, the largest files first. In `trim` mode whole files are processed. "
+    "\nThe default value is 500.",
+)
+
+parent_parser.add_argument(
+    "--threads",
+    type=int,
+    default=1,
+    help="Number of threads used per read file. With `threads` > 1, reads are fed to a pool of threads "
+    "\nthat process them in parallel, the output keeps the file order.",
+)
+
+parent_parser.add_argument(
+    "--prefetch",
+    type=int,
+    default=0,
+    help="Number of reads of which the stored raw signal is read from disk in the background, ahead of "
+    "\nthe read being processed. Hides the read latency of network filesystems, by default 0 (disabled).",
+)
+
 parent_parser.add_argument(
     "--global_output_csv",
     action="store_true",
@@ -70,28 +95,94 @@ parent_parser.add_argument(
     "\nif the files you are processing are single fast5 files, rather than multi fast5 files. ",
 )
 
-subparsers = parser.add_subparsers(dest="mode", required=True)
+parent_parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="Skip the files that a previous run with the same parameters completed, according to the run manifest "
+    "\nin `save_path`. Files that are new or changed since (size or modification time) are processed. "
+    "\nRequires per-file outputs, it can not be combined with `--global_output_csv`.",
+)
 
-# detect
-parser_detect = subparsers.add_parser(
-    "detect",
-    parents=[parent_parser],
-    description="Outputs detected_adapter_boundaries.csv files to `save_path`.",
+parent_parser.add_argument(
+    "--watch",
+    action="store_true",
+    help="Keep watching `input_path` for fast5 files that are being written, e.g. by a running sequencer, and "
+    "\nprocess every fast5 file once it is complete (see `--watch_settle`). The results are appended to the "
+    "\noutputs. Stops after `--watch_timeout` or when `--stop_file` exists, or on an interrupt (Ctrl+C).",
+)
+
+parent_parser.add_argument(
+    "--watch_interval",
+    type=float,
+    default=10.0,
+    help="Time in seconds between two polls of `input_path` in `--watch` mode. The default value is 10.",
+)
+
+parent_parser.add_argument(
+    "--watch_settle",
+    type=float,
+    default=60.0,
+    help="A fast5 file is complete in `--watch` mode when it was not modified for `watch_settle` seconds, and "
+    "\nits size and modification time did not change since the previous poll. The default value is 60.",
+)
+
+parent_parser.add_argument(
+    "--watch_timeout",
+    type=float,
+    default=None,
+    help="Stop `--watch` mode when no fast5 file was added or changed in `input_path` for `watch_timeout` "
+    "\nseconds, by default there is no timeout.",
+)
+
+parent_parser.add_argument(
+    "--stop_file",
+    type=str,
+    default=None,
+    help="Stop `--watch` mode when a file exists at this path, after processing the remaining fast5 files "
+    "\nof `input_path` as complete.",
+)
+
+parent_parser.add_argument(
+    "--max_errors",
+    type=int,
+    default=None,
+    help="Abort the run when more than `max_errors` reads and files failed to process. Failures are written to "
+    "\n`adapt_errors.csv` in `save_path` and the run continues with the next read, by default the run is never "
+    "\naborted.",
+)
+
+parent_parser.add_argument(
+    "--output_format",
+    type=str,
+    choices=["csv", "parquet", "feather"],
+    default="csv",
+    help="Format of the detected adapter boundaries tables, and of the metadata table of the `npy` extract format. "
+    "\nThe `parquet` and `feather` formats are typed and compressed, they require pyarrow. The default value is `csv`.",
+)
+
+parent_parser.add_argument(
+    "--partial_read",
+    action="store_true",
+    help="Only read the first `max_obs` data points of the raw signal from disk for adapter detection. "
+    "\nNormalization statistics are then computed over this prefix instead of over the full read. ",
 )
 
-parser_detect.add_argument(
+# adapter detection, shared by all modes
+detection_parser = argparse.ArgumentParser(add_help=False)
+
+detection_parser.add_argument(
     "--max_obs",
     type=int,
     default=40000,
     help="Look for adapter in first `max_obs` data points of the raw signal. The default value is 40000, taken from default params in Tombo.",
 )
-parser_detect.add_argument(
+detection_parser.add_argument(
     "--min_obs_adapter",
     type=int,
     default=1000,
     help="Set the minimum length of the adapter signal. The default value is 1000.",
 )
-parser_detect.add_argument(
+detection_parser.add_argument(
     "--border_trim",
     type=int,
     default=500,
@@ -99,11 +190,100 @@ parser_detect.add_argument(
     "between `border_trim` and `max_obs`-`border_trim` observations. "
     "The default value is 500.",
 )
+detection_parser.add_argument(
+    "--engine",
+    type=str,
+    choices=["cython", "numpy"],
+    default=None,
+    help="Adapter detection engine. The `cython` engine requires the compiled extension, the `numpy` engine "
+    "gives identical results without it. The default is `cython` if the compiled extension is available, "
+    "`numpy` otherwise.",
+)
+detection_parser.add_argument(
+    "--search",
+    type=str,
+    choices=["exhaustive", "coarse"],
+    default="exhaustive",
+    help="Boundary search mode. The `exhaustive` search evaluates every possible boundary position. The `coarse` "
+    "search evaluates every `search_step`-th position and refines the best one at full resolution, it is faster "
+    "but can differ from the exhaustive search for a small fraction of reads (see README). "
+    "The default value is `exhaustive`.",
+)
+detection_parser.add_argument(
+    "--search_step",
+    type=int,
+    default=50,
+    help="Step between the evaluated boundary positions in `coarse` search mode. The default value is 50.",
+)
+detection_parser.add_argument(
+    "--normalization",
+    type=str,
+    choices=["full", "window"],
+    default="full",
+    help="Normalization mode. In `full` mode the normalization statistics are computed over the full read, "
+    "in `window` mode over the first `norm_window` data points only. In `window` mode only the data points "
+    "needed for detection and normalization are read from disk. The default value is `full`.",
+)
+detection_parser.add_argument(
+    "--norm_window",
+    type=int,
+    default=None,
+    help="Number of data points to compute the normalization statistics over in `window` mode. "
+    "The default value is `max_obs`.",
+)
+detection_parser.add_argument(
+    "--adaptive",
+    action="store_true",
+    help="Detect the adapter in progressively larger windows, starting from the first `start_window` data points "
+    "\nand doubling the window up to `max_obs` until the detected adapter passes a confidence check (see README). "
+    "\nWith `partial_read` or in `window` normalization mode, only the data points of the window are read from disk. "
+    "\nThe window each adapter was detected in is reported in the `detection_window` column.",
+)
+detection_parser.add_argument(
+    "--start_window",
+    type=int,
+    default=10000,
+    help="First detection window in `adaptive` mode. The default value is 10000.",
+)
+detection_parser.add_argument(
+    "--min_gain",
+    type=float,
+    default=1000.0,
+    help="Minimal LLR gain of the adapter boundary to accept a detection in `adaptive` mode. The default value is 1000.",
+)
+detection_parser.add_argument(
+    "--min_contrast",
+    type=float,
+    default=1.0,
+    help="Minimal difference between the median of the adapter and the medians of its neighbouring segments, in "
+    "normalized units, to accept a detection in `adaptive` mode. The default value is 1.0.",
+)
+
+# adapter boundaries of a previous detect run, trim and extract
+boundaries_parser = argparse.ArgumentParser(add_help=False)
+
+boundaries_parser.add_argument(
+    "--boundaries",
+    type=str,
+    default=None,
+    help="Detected adapter boundaries of a previous `detect` run: a csv, parquet or feather table, or the "
+    "\n`save_path` of the run. The adapters are sliced at these boundaries instead of being detected again, "
+    "\nreads that are not in the table are detected with the detection arguments.",
+)
+
+subparsers = parser.add_subparsers(dest="mode", required=True)
+
+# detect
+parser_detect = subparsers.add_parser(
+    "detect",
+    parents=[parent_parser, detection_parser],
+    description="Outputs detected_adapter_boundaries.csv files to `save_path`.",
+)
 
 # trim
 parser_trim = subparsers.add_parser(
     "trim",
-    parents=[parent_parser],
+    parents=[parent_parser, detection_parser, boundaries_parser],
     description="Detects the adapters and also outputs fast5 files to `save_path` for which the raw signal group only contains the RNA signal after the detected adapter sequence.",
 )
 parser_trim.add_argument(
@@ -113,11 +293,26 @@ parser_trim.add_argument(
     help="Retain `trimming_buffer` number of DNA observation prior to the "
     "detected boundary. The default value is 100.",
 )
+parser_trim.add_argument(
+    "--trim_compression",
+    type=str,
+    choices=["source", "none", "gzip", "vbz"],
+    default="source",
+    help="Compression of the trimmed raw signal. In `source` mode the compression of the input raw signal "
+    "\nis kept, `vbz` is only available if the VBZ filter plugin is installed. The default value is `source`.",
+)
+parser_trim.add_argument(
+    "--trim_chunk_size",
+    type=int,
+    default=None,
+    help="Chunk size of the trimmed raw signal dataset. The default value is the chunk size of the input "
+    "\nraw signal.",
+)
 
 # extract
 parser_extract = subparsers.add_parser(
     "extract",
-    parents=[parent_parser],
+    parents=[parent_parser, detection_parser, boundaries_parser],
     description="Detects the adapters and also outputs extracted_adapters.csv to `save_path`.",
 )
 
@@ -127,3 +322,12 @@ parser_extract.add_argument(
     default=100,
     help="Include `extraction_buffer` number of observation before and after the detected adapter signal. The default value is 100.",
 )
+parser_extract.add_argument(
+    "--extract_format",
+    type=str,
+    choices=["csv", "npy", "hdf5"],
+    default="csv",
+    help="Output format of the extracted adapter signals. In `npy` and `hdf5` format the adapter signals are "
+    "written as a single concatenated int16 array, with an offsets index and a metadata table (see README). "
+    "The default value is `csv`.",
+)
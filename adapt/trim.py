@@ -5,15 +5,26 @@ Copyright (c) 2023 Wiep K. van der Toorn (w.vandertoorn@fu-berlin.de)
 
 """
 
+from typing import Optional, Tuple, Union
+
 from ont_fast5_api.fast5_read import Fast5Read
 
-from .detect import detect_adapter_in_read, detectResults
+from .detect import get_adapter_in_read
+from .io import raw_dataset_layout, write_raw_dataset
+from .utils import adaptiveDetectResults, detectResults
 
 
-def slice_signal_in_read(read: Fast5Read, start: int = 0, stop: int = -1) -> None:
+def slice_signal_in_read(
+    read: Fast5Read,
+    start: int = 0,
+    stop: int = -1,
+    compression: Optional[str] = None,
+    chunk_size: Optional[int] = None,
+) -> None:
     """Modify the raw dataset group of a Fast5Read object.
     The raw data signal is changed to the slice signal[start:stop], the
-    duration attribute is changed accordingly.
+    duration attribute is changed accordingly. The new raw dataset keeps the compression
+    and chunking of the original dataset, unless `compression` or `chunk_size` are given.
 
     Parameters
     ----------
@@ -23,23 +34,40 @@ def slice_signal_in_read(read: Fast5Read, start: int = 0, stop: int = -1) -> Non
         Start of the slice, by default 0
     stop : int, optional
         Stop of the half-open interval slice. Value -1 indicates the signal end, by default -1
+    compression : str, optional
+        Compression of the new raw dataset, one of `adapt.io.RAW_COMPRESSIONS`. None indicates
+        the compression of the original dataset, by default None
+    chunk_size : int, optional
+        Chunk size of the new raw dataset. None indicates the chunk size of the original dataset,
+        by default None
     """
-    signal = read.get_raw_data(scale=False)
+    slice_start = max(0, start)
+    slice_stop = None if stop == -1 else stop
+
+    signal = read.get_raw_data(start=slice_start, end=slice_stop, scale=False)
+    dataset = read.handle[read.raw_dataset_name]
+    dcpl, maxshape = raw_dataset_layout(dataset, signal.size, compression, chunk_size)
+    dataset_attrs = dict(dataset.attrs)
     attrs = dict(read.handle[read.raw_dataset_group_name].attrs)
 
     del read.handle[read.raw_dataset_group_name]
 
-    slice_start = max(0, start)
-    slice_stop = signal.size if stop == -1 else min(stop, signal.size)
-
-    attrs["duration"] = slice_stop - slice_start
-    read.add_raw_data(signal[slice_start:slice_stop], attrs)
+    attrs["duration"] = signal.size
+    group = read.handle.create_group(read.raw_dataset_group_name)
+    group.attrs.update(attrs)
+    dataset = write_raw_dataset(
+        read.handle, read.raw_dataset_name, signal, dcpl, maxshape
+    )
+    dataset.attrs.update(dataset_attrs)
 
 
 def trim_adapter_from_read(
     read: Fast5Read,
     buffer: int = 100,
-) -> detectResults:
+    partial_read: bool = False,
+    boundaries: Optional[str] = None,
+    **detect_kwargs,
+) -> Union[detectResults, adaptiveDetectResults]:
     """Detect and trim the adapter signal from a read.
     The raw signal dataset of the read is changed to the slice `signal[adapter_end - buffer :]`, the
     duration attribute of the raw data group is changed accordingly.
@@ -50,9 +78,56 @@ def trim_adapter_from_read(
         The read to be modified. Should be writable and open.
     buffer : int, optional
         Trimming buffer, retain `buffer` number of DNA observation prior to the detected boundary, by default 0.
+    partial_read : bool, optional
+        Only load the signal prefix used for adapter detection, see `adapt.detect.detect_adapter_in_read`,
+        by default False
+    boundaries : str, optional
+        Path of the detected adapter boundaries of a previous detect run to trim at instead of detecting the
+        adapter, see `adapt.detect.get_adapter_in_read`, by default None
+    **detect_kwargs
+        Keyword arguments for `adapt.detect.detect_adapter_in_read`.
     """
 
-    start, stop = detect_adapter_in_read(read)
-    slice_signal_in_read(read, start=max(0, stop - buffer))
+    res, start, stop = get_trim_slice(
+        read, buffer=buffer, partial_read=partial_read, boundaries=boundaries, **detect_kwargs
+    )
+    slice_signal_in_read(read, start=start, stop=stop)
+
+    return res
 
-    return detectResults(start, stop)
+
+def get_trim_slice(
+    read: Fast5Read,
+    buffer: int = 100,
+    partial_read: bool = False,
+    boundaries: Optional[str] = None,
+    **detect_kwargs,
+) -> Tuple[Union[detectResults, adaptiveDetectResults], int, int]:
+    """Detect the adapter in a read and return the raw signal slice that trims it off.
+    Used by `adapt.io.write_sliced_fast5_file` to write trimmed reads to a new fast5 file.
+
+    Parameters
+    ----------
+    read : Fast5Read
+        The read to detect the adapter in.
+    buffer : int, optional
+        Trimming buffer, retain `buffer` number of DNA observation prior to the detected boundary, by default 100.
+    partial_read : bool, optional
+        Only load the signal prefix used for adapter detection, see `adapt.detect.detect_adapter_in_read`,
+        by default False
+    boundaries : str, optional
+        Path of the detected adapter boundaries of a previous detect run to trim at instead of detecting the
+        adapter, see `adapt.detect.get_adapter_in_read`, by default None
+    **detect_kwargs
+        Keyword arguments for `adapt.detect.detect_adapter_in_read`.
+
+    Returns
+    -------
+    Tuple[Union[detectResults, adaptiveDetectResults], int, int]
+        The adapter boundaries and the slice (start, stop) of the trimmed signal, a stop of -1 indicates the
+        signal end.
+    """
+    res = get_adapter_in_read(
+        read, boundaries=boundaries, partial_read=partial_read, **detect_kwargs
+    )
+    return res, max(0, res.adapter_end - buffer), -1
@@ -7,8 +7,9 @@ Copyright (c) 2023 Wiep K. van der Toorn (w.vandertoorn@fu-berlin.de)
 
 
 from collections import namedtuple
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 
+import numpy as np
 import pandas as pd
 
 
@@ -33,6 +34,30 @@ class detectResults(
     """
 
 
+class adaptiveDetectResults(
+    namedtuple(
+        "adaptiveDetectResults",
+        (
+            "adapter_start",
+            "adapter_end",
+            "detection_window",
+        ),
+    )
+):
+    """Adapter detection results of the adaptive detection mode.
+
+    Parameters
+    ----------
+    adapter_start : int
+        Adapter start coordinate in original, full-length signal data.
+    adapter_end : int
+        Adapter end coordinate in original, full-length signal data.
+    detection_window : int
+        Number of data points of the window the adapter was detected in.
+
+    """
+
+
 class extractResults(
     namedtuple(
         "extractResults",
@@ -64,13 +89,39 @@ class extractResults(
         Signal range as stored in read channel info
     offset : float
         Signal offset as stored in read channel info
-    adapter_signal : np.ndarray
+    adapter_signal : np.ndarray or signalShard
         Extracted adapter signal of length at most
         `adapter_end` - `adapter_start` + 2* `extract_buffer`, can be shorter if
         signal surrounding the adapter is less than the `extract_buffer`.
         This can only happen is `extract_buffer` > `border_trim=500` used in detecting
         the adatper. Adapter signal is in np.int16 format, it can be scaled to pA values using
-        `np.array(pA_range/digitisation * (adapter_signal + offset), dtype=np.float32)`
+        `np.array(pA_range/digitisation * (adapter_signal + offset), dtype=np.float32)`.
+        Results of worker processes refer to the adapter signal in a shard file instead,
+        see `adapt.io.write_signal_shard`.
+
+    """
+
+
+class signalShard(
+    namedtuple(
+        "signalShard",
+        (
+            "path",
+            "start",
+            "stop",
+        ),
+    )
+):
+    """Reference to an adapter signal stored in a shard file.
+
+    Parameters
+    ----------
+    path : str
+        Path of the .npy shard file, a concatenated np.int16 array of adapter signals.
+    start : int
+        Start of the adapter signal in the shard array.
+    stop : int
+        Stop of the half-open interval of the adapter signal in the shard array.
 
     """
 
@@ -93,70 +144,523 @@ class processResults(
         Path of processed fast5 file.
     read_id : str
         Read id as stored in fast5 read entry.
-    results : detectResults or extractResults
+    results : detectResults, adaptiveDetectResults or extractResults
         Results object returned by the processing function.
 
     """
 
 
-def detect_results_to_df(detect_results: List[processResults]) -> pd.DataFrame:
-    """Transform list of adapter detection processing results to a pandas DataFrame format.
+class processError(
+    namedtuple(
+        "processError",
+        (
+            "filepath",
+            "read_id",
+            "stage",
+            "exception",
+            "message",
+        ),
+    )
+):
+    """Error raised while processing a fast5 file or one of its reads.
 
     Parameters
     ----------
-    detect_results : List[processResults]
-        List of adapter detection processing results, see adapt.io.process_fast5_file .
+    filepath : str
+        Path of the fast5 file.
+    read_id : str
+        Read id of the failed read, None for errors of the whole file.
+    stage : str
+        Processing stage that failed, one of `ERROR_STAGES`.
+    exception : str
+        Name of the exception type.
+    message : str
+        Exception message.
+
+    """
+
+    @classmethod
+    def from_exception(
+        cls, filepath: str, read_id: Optional[str], stage: str, exception: BaseException
+    ) -> "processError":
+        return cls(filepath, read_id, stage, type(exception).__name__, str(exception))
+
+
+# processing stages of errors: opening the file or iterating its reads, processing a read (including loading its
+# signal) and writing a read to a new fast5 file
+ERROR_STAGES = ["file", "process", "write"]
+
+
+# numeric fields of the results types, stored as the columns of `ResultsBatch.records`
+RESULTS_FIELDS = {
+    detectResults: [("adapter_start", np.int64), ("adapter_end", np.int64)],
+    adaptiveDetectResults: [
+        ("adapter_start", np.int64),
+        ("adapter_end", np.int64),
+        ("detection_window", np.int64),
+    ],
+    extractResults: [
+        ("adapter_start", np.int64),
+        ("adapter_end", np.int64),
+        ("extract_buffer", np.int64),
+        ("digitisation", np.float64),
+        ("pA_range", np.float64),
+        ("offset", np.float64),
+    ],
+}
+
+
+def _results_type(results_types: Iterable[type]) -> type:
+    """Results type of a batch holding results of `results_types`. Detection results can be combined
+    with adaptive detection results, they are stored with a `detection_window` of -1."""
+    results_types = set(results_types)
+    if len(results_types) == 0:
+        return detectResults
+    if len(results_types) == 1:
+        return results_types.pop()
+    if results_types == {detectResults, adaptiveDetectResults}:
+        return adaptiveDetectResults
+
+    raise ValueError(
+        f"Can not combine results of types {sorted(t.__name__ for t in results_types)} in a batch."
+    )
+
+
+def _records_dtype(results_type: type, read_id_size: int) -> np.dtype:
+    return np.dtype([("read_id", f"S{max(1, read_id_size)}")] + RESULTS_FIELDS[results_type])
+
+
+class ResultsBatch:
+    """Processing results of the reads of a single file, stored column-wise.
+
+    The filepath is stored once, the read ids (as fixed-width bytes) and the numeric fields of the results
+    are stored in a NumPy structured array with a row per read, see `RESULTS_FIELDS`. The adapter signals of
+    adapter extraction results are stored as a single concatenated np.int16 signal with an np.int64 offsets
+    index of N+1 entries, the concatenated signal consists of parts that are arrays in memory or ranges of
+    .npy shard files written by `adapt.io.write_signal_shard`.
+
+    A batch is a sequence of `processResults`, that are created when the batch is indexed or iterated. The
+    adapter signals of shard files are returned as `signalShard` references. Batches compare equal to
+    batches and lists of the same `processResults`. The errors of the reads that failed to process, or of
+    the file, are kept apart from the results.
+
+    Parameters
+    ----------
+    filepath : str
+        Path of the processed fast5 file.
+    results_type : type
+        One of `detectResults`, `adaptiveDetectResults` and `extractResults`. Batches of adaptive detection
+        results can hold detection results, which have a `detection_window` of -1.
+    records : np.ndarray
+        Structured array with the `read_id` field and the fields of `results_type` in `RESULTS_FIELDS`.
+    signal_parts : List[Tuple[Union[np.ndarray, str], int, int]], optional
+        Parts (array or shard path, start, stop) of the concatenated adapter signal, of extraction results
+        only, by default None
+    signal_offsets : np.ndarray, optional
+        Offsets index of the concatenated adapter signal, of extraction results only, by default None
+    errors : List[processError], optional
+        Errors of the file and its reads that failed to process, by default None
+    """
+
+    def __init__(
+        self,
+        filepath: str,
+        results_type: type,
+        records: np.ndarray,
+        signal_parts: Optional[List[Tuple[Union[np.ndarray, str], int, int]]] = None,
+        signal_offsets: Optional[np.ndarray] = None,
+        errors: Optional[List[processError]] = None,
+    ):
+        self.filepath = filepath
+        self.results_type = results_type
+        self.records = records
+        self.signal_parts = signal_parts
+        self.signal_offsets = signal_offsets
+        self.errors = [] if errors is None else list(errors)
+
+        if results_type is extractResults:
+            # start of the parts in the concatenated signal
+            self._part_offsets = np.cumsum(
+                [0] + [stop - start for _, start, stop in signal_parts[:-1]], dtype=np.int64
+            )
+
+    @classmethod
+    def from_results(
+        cls,
+        results: Sequence[processResults],
+        filepath: Optional[str] = None,
+        errors: Optional[List[processError]] = None,
+    ) -> "ResultsBatch":
+        """Batch of the processing results of the reads of a single file.
+
+        Parameters
+        ----------
+        results : Sequence[processResults]
+            Processing results, all of the same file.
+        filepath : str, optional
+            Path of the processed fast5 file, only needed if `results` is empty, by default None
+        errors : List[processError], optional
+            Errors of the file and its reads that failed to process, by default None
+
+        Returns
+        -------
+        ResultsBatch
+            The batch.
+
+        Raises
+        ------
+        ValueError
+            If the results are of more than one file, or of results types that can not be combined.
+        """
+        filepaths = {x.filepath for x in results}
+        if filepath is not None:
+            filepaths.add(filepath)
+        if len(filepaths) != 1:
+            raise ValueError(
+                f"A results batch holds the results of a single file, got {len(filepaths)} filepaths."
+            )
+
+        results_type = _results_type(type(x.results) for x in results)
+        read_ids = [x.read_id.encode() for x in results]
+        records = np.empty(
+            len(results), dtype=_records_dtype(results_type, max(map(len, read_ids), default=1))
+        )
+        records["read_id"] = read_ids
+        for name, _ in RESULTS_FIELDS[results_type]:
+            records[name] = [getattr(x.results, name, -1) for x in results]
+
+        if results_type is not extractResults:
+            return cls(filepaths.pop(), results_type, records, errors=errors)
+
+        return cls(
+            filepaths.pop(),
+            results_type,
+            records,
+            *_signal_parts([x.results.adapter_signal for x in results]),
+            errors=errors,
+        )
+
+    @classmethod
+    def concat(cls, batches: Sequence["ResultsBatch"]) -> "ResultsBatch":
+        """Concatenate batches of the same file, e.g. of the work units of a file. The errors of all batches
+        are kept, empty batches are otherwise skipped.
+
+        Raises
+        ------
+        ValueError
+            If the batches are of more than one file, or of results types that can not be combined.
+        """
+        filepaths = {batch.filepath for batch in batches}
+        if len(filepaths) != 1:
+            raise ValueError(
+                f"A results batch holds the results of a single file, got {len(filepaths)} filepaths."
+            )
+
+        errors = [error for batch in batches for error in batch.errors]
+        if any(len(batch) for batch in batches):
+            # empty batches, e.g. of a work unit of failed reads, can be of another results type
+            batches = [batch for batch in batches if len(batch)]
+
+        results_type = _results_type(batch.results_type for batch in batches)
+        records = np.empty(
+            sum(len(batch) for batch in batches),
+            dtype=_records_dtype(
+                results_type, max(batch.records.dtype["read_id"].itemsize for batch in batches)
+            ),
+        )
+        start = 0
+        for batch in batches:
+            for name in records.dtype.names:
+                if name in batch.records.dtype.names:
+                    records[name][start : start + len(batch)] = batch.records[name]
+                else:  # `detection_window` of detection results
+                    records[name][start : start + len(batch)] = -1
+            start += len(batch)
+
+        if results_type is not extractResults:
+            return cls(filepaths.pop(), results_type, records, errors=errors)
+
+        signal_offsets = [np.zeros(1, dtype=np.int64)]
+        for batch in batches:
+            signal_offsets.append(batch.signal_offsets[1:] + signal_offsets[-1][-1])
+        return cls(
+            filepaths.pop(),
+            results_type,
+            records,
+            [part for batch in batches for part in batch.signal_parts],
+            np.concatenate(signal_offsets),
+            errors,
+        )
+
+    def __len__(self) -> int:
+        return self.records.size
+
+    def _results(self, i: int, values: tuple):
+        if self.results_type is extractResults:
+            return extractResults(*values, adapter_signal=self._adapter_signal(i))
+        if self.results_type is adaptiveDetectResults and values[-1] == -1:
+            return detectResults(*values[:-1])
+        return self.results_type(*values)
+
+    def __iter__(self) -> Iterator[processResults]:
+        for i, (read_id, *values) in enumerate(self.records.tolist()):
+            yield processResults(self.filepath, read_id.decode(), self._results(i, values))
+
+    def __getitem__(self, key: Union[int, slice]) -> Union[processResults, "ResultsBatch"]:
+        if isinstance(key, slice):
+            return self.take(np.arange(len(self))[key])
+
+        read_id, *values = self.records[key].tolist()
+        return processResults(
+            self.filepath, read_id.decode(), self._results(range(len(self))[key], values)
+        )
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, (ResultsBatch, list, tuple)):
+            return NotImplemented
+        return len(self) == len(other) and list(self) == list(other)
+
+    def __repr__(self) -> str:
+        return f"ResultsBatch({self.filepath!r}, {self.results_type.__name__}, {len(self)} reads)"
+
+    @property
+    def read_ids(self) -> np.ndarray:
+        """Read ids as np.str_ array."""
+        return self.records["read_id"].astype(str)
+
+    @property
+    def detected(self) -> np.ndarray:
+        """Boolean mask of the reads with a detected adapter."""
+        return self.records["adapter_end"] > self.records["adapter_start"]
+
+    def signal_sizes(self) -> np.ndarray:
+        """Size of the adapter signal per read, of extraction results."""
+        return np.diff(self.signal_offsets)
+
+    def shard_paths(self) -> List[str]:
+        """Paths of the shard files the adapter signals are stored in."""
+        return sorted({source for source, _, _ in self.signal_parts or [] if isinstance(source, str)})
+
+    def take(self, indices: np.ndarray) -> "ResultsBatch":
+        """Batch of the rows `indices`, without errors."""
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.results_type is not extractResults:
+            return ResultsBatch(self.filepath, self.results_type, self.records[indices])
+
+        signal_offsets = np.zeros(indices.size + 1, dtype=np.int64)
+        np.cumsum(self.signal_sizes()[indices], out=signal_offsets[1:])
+        return ResultsBatch(
+            self.filepath,
+            self.results_type,
+            self.records[indices],
+            _merge_signal_pieces(self._signal_pieces(indices)),
+            signal_offsets,
+        )
+
+    def _signal_pieces(self, indices: Iterable[int]) -> Iterator[Tuple[Union[np.ndarray, str], int, int]]:
+        """Part ranges (array or shard path, start, stop) of the adapter signals of the rows `indices`."""
+        for i in indices:
+            start, stop = self.signal_offsets[i], self.signal_offsets[i + 1]
+            if stop == start:
+                continue
+            j = np.searchsorted(self._part_offsets, start, side="right") - 1
+            source, part_start, _ = self.signal_parts[j]
+            part_start += int(start - self._part_offsets[j])
+            yield source, part_start, part_start + int(stop - start)
+
+    def _adapter_signal(self, i: int) -> Union[np.ndarray, signalShard]:
+        pieces = list(self._signal_pieces([i]))
+        if len(pieces) == 0:
+            return np.empty(0, dtype=np.int16)
+
+        source, start, stop = pieces[0]
+        if isinstance(source, str):
+            return signalShard(source, start, stop)
+        return source[start:stop]
+
+    def adapter_signal_pieces(self, indices: Optional[Iterable[int]] = None) -> List[np.ndarray]:
+        """Adapter signals of the rows `indices` (all rows if None) as arrays, that concatenated form the
+        adapter signals in row order. Consecutive adapter signals are returned as a single slice of the
+        concatenated signal, slices of shard files are memory-mapped."""
+        if indices is None:
+            indices = range(len(self))
+
+        pieces = []
+        shards = dict()
+        for source, start, stop in _merge_signal_pieces(self._signal_pieces(indices)):
+            if isinstance(source, str):
+                if source not in shards:
+                    shards[source] = np.load(source, mmap_mode="r")
+                source = shards[source]
+            pieces.append(source[start:stop])
+        return pieces
+
+    def adapter_signals(self) -> List[np.ndarray]:
+        """Adapter signal per row, loaded into memory."""
+        if len(self) == 0:
+            return []
+        pieces = self.adapter_signal_pieces()
+        signal = np.concatenate(pieces) if len(pieces) else np.empty(0, dtype=np.int16)
+        return np.split(signal, self.signal_offsets[1:-1])
+
+
+def _signal_parts(
+    adapter_signals: List[Union[np.ndarray, signalShard]]
+) -> Tuple[List[Tuple[Union[np.ndarray, str], int, int]], np.ndarray]:
+    """Signal parts and offsets index of the adapter signals of a batch, adapter signals in memory are
+    concatenated, consecutive adapter signals of a shard file are merged to a single part."""
+    sizes = [
+        x.stop - x.start if isinstance(x, signalShard) else len(x) for x in adapter_signals
+    ]
+    signal_offsets = np.zeros(len(adapter_signals) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=signal_offsets[1:])
+
+    pieces = []
+    arrays = []
+    for adapter_signal in adapter_signals:
+        if isinstance(adapter_signal, signalShard):
+            if len(arrays):
+                signal = np.concatenate(arrays).astype(np.int16, copy=False)
+                pieces.append((signal, 0, signal.size))
+                arrays = []
+            pieces.append(tuple(adapter_signal))
+        else:
+            arrays.append(adapter_signal)
+    if len(arrays):
+        signal = np.concatenate(arrays).astype(np.int16, copy=False)
+        pieces.append((signal, 0, signal.size))
+
+    return _merge_signal_pieces(pieces), signal_offsets
+
+
+def _merge_signal_pieces(
+    pieces: Iterable[Tuple[Union[np.ndarray, str], int, int]]
+) -> List[Tuple[Union[np.ndarray, str], int, int]]:
+    """Merge consecutive ranges of the same array or shard file and drop empty ranges."""
+    parts = []
+    for source, start, stop in pieces:
+        if stop == start:
+            continue
+        if len(parts) and parts[-1][2] == start and (
+            parts[-1][0] is source or (isinstance(source, str) and parts[-1][0] == source)
+        ):
+            parts[-1] = (source, parts[-1][1], stop)
+        else:
+            parts.append((source, start, stop))
+    return parts
+
+
+def to_results_batches(
+    results: Union[ResultsBatch, Sequence[processResults]]
+) -> List[ResultsBatch]:
+    """Batches of processing results, a batch per run of results of the same file."""
+    if isinstance(results, ResultsBatch):
+        return [results]
+
+    batches = []
+    start = 0
+    for i in range(1, len(results) + 1):
+        if i == len(results) or results[i].filepath != results[start].filepath:
+            batches.append(ResultsBatch.from_results(results[start:i]))
+            start = i
+    return batches
+
+
+def _results_columns(
+    batches: List[ResultsBatch], results_type: type
+) -> Dict[str, np.ndarray]:
+    """Columns of the processing results of batches, with the fields of `results_type`."""
+    columns = {
+        "rel_filepath": np.repeat(
+            np.array([batch.filepath for batch in batches], dtype=object),
+            [len(batch) for batch in batches],
+        ),
+        "read_id": np.concatenate(
+            [batch.read_ids for batch in batches] + [np.empty(0, dtype=str)]
+        ),
+    }
+    for name, dtype in RESULTS_FIELDS[results_type]:
+        columns[name] = np.concatenate(
+            [
+                batch.records[name]
+                if name in batch.records.dtype.names
+                else np.full(len(batch), -1, dtype=dtype)
+                for batch in batches
+            ]
+            + [np.empty(0, dtype=dtype)]
+        )
+    return columns
+
+
+def detect_results_to_df(
+    detect_results: Union[ResultsBatch, List[processResults]]
+) -> pd.DataFrame:
+    """Transform adapter detection processing results to a pandas DataFrame format.
+
+    Parameters
+    ----------
+    detect_results : Union[ResultsBatch, List[processResults]]
+        Batch or list of adapter detection processing results, see adapt.io.process_fast5_file .
 
     Returns
     -------
     pd.DataFrame
-        Dataframe of adapter detection processing results.
+        Dataframe of adapter detection processing results. Results of the adaptive detection mode
+        include the `detection_window` column.
     """
-    return pd.DataFrame(
-        [
-            (x.filepath, x.read_id, x.results.adapter_start, x.results.adapter_end)
-            for x in detect_results
-        ],
-        columns=["rel_filepath", "read_id", "adapter_start", "adapter_end"],
+    batches = to_results_batches(detect_results)
+    adaptive = any(batch.results_type is adaptiveDetectResults for batch in batches)
+    columns = _results_columns(
+        batches, adaptiveDetectResults if adaptive else detectResults
     )
 
+    df = pd.DataFrame(
+        {
+            name: columns[name]
+            for name in ["rel_filepath", "read_id", "adapter_start", "adapter_end"]
+        }
+    )
+    if adaptive:
+        detection_window = columns["detection_window"]
+        if (detection_window == -1).any():
+            # detection results without a detection window
+            detection_window = np.where(detection_window == -1, np.nan, detection_window)
+        df["detection_window"] = detection_window
+    return df
 
-def extract_results_to_df(extract_results: List[processResults]) -> pd.DataFrame:
-    """Transform list of adapter extraction processing results to a pandas DataFrame format.
+
+def extract_results_to_df(
+    extract_results: Union[ResultsBatch, List[processResults]]
+) -> pd.DataFrame:
+    """Transform adapter extraction processing results to a pandas DataFrame format.
 
     Parameters
     ----------
-    extract_results : List[processResults]
-        List of adapter extraction processing results, see adapt.io.process_fast5_file .
+    extract_results : Union[ResultsBatch, List[processResults]]
+        Batch or list of adapter extraction processing results, see adapt.io.process_fast5_file .
 
     Returns
     -------
     pd.DataFrame
         Dataframe of adapter extraction processing results.
     """
+    batches = to_results_batches(extract_results)
+    columns = _results_columns(batches, extractResults)
+
     df = pd.DataFrame(
-        [
-            (
-                x.filepath,
-                x.read_id,
-                x.results.adapter_end > x.results.adapter_start,
-                x.results.extract_buffer,
-                x.results.digitisation,
-                x.results.pA_range,
-                x.results.offset,
-                x.results.adapter_signal.tolist(),
-            )
-            for x in extract_results
-        ],
-        columns=[
-            "rel_filepath",
-            "read_id",
-            "detected",
-            "extraction_buffer",
-            "digitisation",
-            "range",
-            "offset",
-            "adapter_signal",
-        ],
+        {
+            "rel_filepath": columns["rel_filepath"],
+            "read_id": columns["read_id"],
+            "detected": columns["adapter_end"] > columns["adapter_start"],
+            "extraction_buffer": columns["extract_buffer"],
+            "digitisation": columns["digitisation"],
+            "range": columns["pA_range"],
+            "offset": columns["offset"],
+            "adapter_signal": [
+                adapter_signal.tolist()
+                for batch in batches
+                for adapter_signal in batch.adapter_signals()
+            ],
+        }
     )
     return df.loc[df.detected].drop(columns=["detected"])
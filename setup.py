@@ -1,3 +1,5 @@
+import sys
+
 import numpy as np
 from Cython.Build import cythonize
 from setuptools import Extension, setup
@@ -5,6 +7,9 @@ from setuptools.command.build_ext import build_ext
 
 VERSION = "0.0.1"
 
+# batched detection runs in parallel with OpenMP, Apple clang does not ship OpenMP
+OPENMP_ARGS = [] if sys.platform == "darwin" else ["-fopenmp"]
+
 
 # Avoid a gcc warning below:
 # cc1plus: warning: command line option ‘-Wstrict-prototypes’ is valid for C/ObjC but not for C++
@@ -22,11 +27,23 @@ ext_modules = [
         include_dirs=[np.get_include()],
         language="c++",
         define_macros=[("NPY_NO_DEPRECATED_API", "NPY_1_7_API_VERSION")],
-    )
+        # keep cumsums bit-identical to numpy (no fused multiply-add)
+        extra_compile_args=["-ffp-contract=off"] + OPENMP_ARGS,
+        extra_link_args=OPENMP_ARGS,
+    ),
+    Extension(
+        name=str("adapt._c_normalize"),
+        sources=[str("adapt/_c_normalize.pyx")],
+        include_dirs=[np.get_include()],
+        language="c++",
+        define_macros=[("NPY_NO_DEPRECATED_API", "NPY_1_7_API_VERSION")],
+    ),
 ]
 
 for e in ext_modules:
     e.cython_directives = {"embedsignature": True}
+    # without a compiler, ADAPT is installed with the numpy detection engine only
+    e.optional = True
 
 
 setup(
@@ -38,6 +55,7 @@ setup(
         "ont-fast5-api>=4",
         "pandas",
     ],
+    extras_require={"arrow": ["pyarrow"]},
     author="Wiep van der Toorn",
     author_email="w.vandertoorn@fu-berlin.de",
     description="Adapter detection in direct RNA sequencing reads.",
@@ -5,8 +5,21 @@ Copyright (c) 2023 Wiep K. van der Toorn (w.vandertoorn@fu-berlin.de)
 
 """
 
+import os
+
 import numpy as np
-from adapt.detect import detect_adapter_in_signal
+import pytest
+from adapt import Detector
+from adapt.detect import (
+    detect_adapter_in_read,
+    detect_adapter_in_signal,
+    detect_adapters_in_signals,
+)
+from adapt.normalize import normalize_signal
+
+from ont_fast5_api.fast5_interface import get_fast5_file
+
+test_data = os.path.join(os.path.dirname(__file__), "data")
 
 
 def test_constant_signal():
@@ -63,3 +76,263 @@ def test_trim_too_much():
     res = detect_adapter_in_signal(signal, min_obs_adapter=12000, border_trim=2000)
     assert res.adapter_start == 0
     assert res.adapter_end == 0
+
+
+def test_partial_read():
+    f5path = os.path.join(test_data, "batch0.fast5")
+
+    with get_fast5_file(f5path, mode="r") as f5:
+        for read in f5.get_reads():
+            # reads are shorter than `max_obs`, the full signal is loaded either way
+            res = detect_adapter_in_read(read)
+            res_partial = detect_adapter_in_read(read, partial_read=True)
+            assert res == res_partial
+
+            res_partial = detect_adapter_in_read(read, max_obs=8000, partial_read=True)
+            assert res_partial.adapter_end < 8000
+
+
+def test_normalization_window():
+    f5path = os.path.join(test_data, "batch0.fast5")
+
+    with get_fast5_file(f5path, mode="r") as f5:
+        for read in f5.get_reads():
+            # `norm_window` covers the full read, statistics are computed over the same data points
+            res = detect_adapter_in_read(read)
+            res_window = detect_adapter_in_read(
+                read, normalization="window", norm_window=40000
+            )
+            assert res == res_window
+
+            res_window = detect_adapter_in_read(read, normalization="window")
+            assert res_window == detect_adapter_in_read(read, partial_read=True)
+
+        with pytest.raises(ValueError):
+            detect_adapter_in_read(read, normalization="unknown")
+
+
+def test_fused_splits_match_trace():
+    from adapt._c_llr_segmentation import c_llr_detect_adapter_trace
+
+    signal = np.concatenate(
+        [
+            np.random.normal(120, 5, 1000),
+            np.random.normal(60, 3, 5000),
+            np.random.normal(100, 7, 10000),
+        ]
+    )
+
+    res = detect_adapter_in_signal(signal, max_obs=16000)
+    gains_first, gains_head, gains_tail = c_llr_detect_adapter_trace(signal, 1000, 500)
+    x_first = np.argmax(gains_first)
+
+    assert res.adapter_end == x_first
+    assert res.adapter_start == np.argmax(gains_head)
+
+
+def test_batch_matches_single():
+    f5path = os.path.join(test_data, "batch0.fast5")
+
+    with get_fast5_file(f5path, mode="r") as f5:
+        signals = [read.get_raw_data(scale=False) for read in f5.get_reads()]
+    signals.append(np.ones(10, dtype=np.int16))
+    signals.append(np.zeros(0, dtype=np.int16))
+
+    offsets = np.cumsum([0] + [s.size for s in signals])
+    res = detect_adapters_in_signals(np.concatenate(signals), offsets, threads=2)
+
+    assert res.shape == (len(signals), 2)
+    assert res.dtype == np.int64
+    for signal, boundaries in zip(signals[:-1], res):
+        with np.errstate(invalid="ignore"):  # MAD is 0 for constant signal
+            norm_signal = normalize_signal(signal)
+        assert tuple(boundaries) == detect_adapter_in_signal(norm_signal)
+    assert tuple(res[-1]) == (0, 0)
+
+    norm_signals = [normalize_signal(s) for s in signals[:-2]]
+    res_norm = detect_adapters_in_signals(np.concatenate(norm_signals), offsets[:-2])
+    assert (res_norm == res[:-2]).all()
+
+
+def test_batch_invalid_offsets():
+    signals = np.ones(100, dtype=np.int16)
+
+    with pytest.raises(ValueError):
+        detect_adapters_in_signals(signals, np.array([0, 50, 20]))
+    with pytest.raises(ValueError):
+        detect_adapters_in_signals(signals, np.array([0, 101]))
+
+
+def test_numpy_engine():
+    signals = [
+        np.ones(5000, dtype=np.float64),
+        np.concatenate(
+            [
+                np.random.normal(120, 5, 1000),
+                np.random.normal(60, 3, 5000),
+                np.random.normal(100, 7, 10000),
+            ]
+        ),
+    ]
+    with get_fast5_file(os.path.join(test_data, "batch0.fast5"), mode="r") as f5:
+        signals += [normalize_signal(read.get_raw_data()) for read in f5.get_reads()]
+
+    for signal in signals:
+        for min_obs_adapter, border_trim in [(1000, 500), (0, 0), (12000, 2000)]:
+            res_cython = detect_adapter_in_signal(
+                signal, min_obs_adapter=min_obs_adapter, border_trim=border_trim
+            )
+            res_numpy = detect_adapter_in_signal(
+                signal,
+                min_obs_adapter=min_obs_adapter,
+                border_trim=border_trim,
+                engine="numpy",
+            )
+            assert res_cython == res_numpy
+
+    offsets = np.cumsum([0] + [s.size for s in signals])
+    res_cython = detect_adapters_in_signals(np.concatenate(signals), offsets)
+    res_numpy = detect_adapters_in_signals(
+        np.concatenate(signals), offsets, engine="numpy"
+    )
+    assert (res_cython == res_numpy).all()
+
+    with pytest.raises(ValueError):
+        detect_adapter_in_signal(signals[0], engine="unknown")
+
+
+def test_missing_extension(monkeypatch):
+    import adapt.detect
+
+    monkeypatch.setattr(adapt.detect, "c_llr_detect_adapter", None)
+
+    with pytest.raises(ImportError):
+        detect_adapter_in_signal(np.ones(5000), engine="cython")
+
+
+def test_coarse_search():
+    signal = np.concatenate(
+        [
+            np.random.normal(120, 5, 1000),
+            np.random.normal(60, 3, 5000),
+            np.random.normal(100, 7, 10000),
+        ]
+    )
+
+    res = detect_adapter_in_signal(signal)
+    res_coarse = detect_adapter_in_signal(signal, search="coarse")
+    assert res == res_coarse
+
+    res_numpy = detect_adapter_in_signal(signal, search="coarse", engine="numpy")
+    assert res_coarse == res_numpy
+
+    # step 1 is the exhaustive search
+    res_coarse = detect_adapter_in_signal(signal, search="coarse", search_step=1)
+    assert res == res_coarse
+
+    with pytest.raises(ValueError):
+        detect_adapter_in_signal(signal, search="unknown")
+
+
+def test_coarse_search_reads():
+    f5path = os.path.join(test_data, "batch0.fast5")
+
+    with get_fast5_file(f5path, mode="r") as f5:
+        for read in f5.get_reads():
+            res = detect_adapter_in_read(read)
+            res_coarse = detect_adapter_in_read(read, search="coarse")
+            assert res == res_coarse
+
+
+def test_adaptive():
+    signal = np.concatenate(
+        [
+            np.random.normal(120, 5, 1000),
+            np.random.normal(60, 3, 5000),
+            np.random.normal(100, 7, 50000),
+        ]
+    )
+
+    res = detect_adapter_in_signal(signal)
+    res_adaptive = detect_adapter_in_signal(signal, adaptive=True)
+    assert tuple(res_adaptive[:2]) == res
+    assert res_adaptive.detection_window == 10000
+
+    # adapter does not fit in the first window
+    res_adaptive = detect_adapter_in_signal(signal, adaptive=True, start_window=5000)
+    assert tuple(res_adaptive[:2]) == res
+    assert res_adaptive.detection_window == 10000
+
+    # no confident detection, the window grows up to max_obs
+    res_adaptive = detect_adapter_in_signal(signal, adaptive=True, min_gain=np.inf)
+    assert tuple(res_adaptive[:2]) == res
+    assert res_adaptive.detection_window == 40000
+
+    res_numpy = detect_adapter_in_signal(signal, adaptive=True, engine="numpy")
+    assert tuple(res_numpy[:2]) == res
+
+
+def test_adaptive_reads():
+    f5path = os.path.join(test_data, "batch0.fast5")
+
+    with get_fast5_file(f5path, mode="r") as f5:
+        for read in f5.get_reads():
+            norm_signal = normalize_signal(read.get_raw_data(scale=False))
+            res = detect_adapter_in_signal(norm_signal, adaptive=True)
+            assert detect_adapter_in_read(read, adaptive=True) == res
+
+            # the signal is loaded incrementally
+            res_partial = detect_adapter_in_read(read, adaptive=True, partial_read=True)
+            window = res_partial.detection_window
+            signal = read.get_raw_data(end=window, scale=False)
+            assert tuple(res_partial[:2]) == detect_adapter_in_signal(
+                normalize_signal(signal), max_obs=window
+            )
+            assert res_partial == detect_adapter_in_read(
+                read, adaptive=True, normalization="window"
+            )
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        dict(),
+        dict(max_obs=8000, partial_read=True),
+        dict(normalization="window", norm_window=12000),
+        dict(search="coarse"),
+        dict(engine="numpy"),
+    ],
+)
+def test_detector(kwargs):
+    detector = Detector(**kwargs)
+    work = detector._work
+
+    for fname in ["batch0.fast5", "read0.fast5"]:
+        with get_fast5_file(os.path.join(test_data, fname), mode="r") as f5:
+            for read in f5.get_reads():
+                assert detector.detect_read(read) == detect_adapter_in_read(read, **kwargs)
+
+    # work buffers are reused
+    assert detector._work is work
+
+    signal = np.concatenate(
+        [
+            np.random.normal(120, 5, 1000),
+            np.random.normal(60, 3, 5000),
+            np.random.normal(100, 7, 10000),
+        ]
+    )
+    max_obs = kwargs.get("max_obs", 40000)
+    assert detector.detect(signal) == detect_adapter_in_signal(signal, max_obs=max_obs)
+
+    with pytest.raises(ValueError):
+        Detector(normalization="unknown")
+
+
+def test_work_buffer():
+    from adapt._c_llr_segmentation import c_llr_detect_adapter
+
+    signal = np.random.normal(100, 7, 5000)
+
+    with pytest.raises(ValueError):
+        c_llr_detect_adapter(signal, 1000, 500, 1, np.empty(4 * 5000 - 1))
@@ -7,7 +7,7 @@ Copyright (c) 2023 Wiep K. van der Toorn (w.vandertoorn@fu-berlin.de)
 
 import os
 
-from adapt.extract import extract_adapter_from_read
+from adapt.extract import extract_adapter_from_read, extract_signal_slice_from_read
 
 from ont_fast5_api.fast5_interface import get_fast5_file
 
@@ -45,3 +45,19 @@ def test_extract_adapter_single():
     assert res.digitisation == 8192.0
     assert res.offset == 4.0
     assert res.pA_range == 1194.820068359375
+
+
+def test_extract_signal_slice():
+    f5path = os.path.join(test_data, "batch0.fast5")
+
+    with get_fast5_file(f5path, mode="r") as f5:
+        read = next(f5.get_reads())
+        signal = read.get_raw_data(scale=False)
+
+        res = extract_signal_slice_from_read(read, 50, 1000, extract_buffer=100)
+        assert (res == signal[:1100]).all()
+
+        res = extract_signal_slice_from_read(
+            read, 1000, signal.size - 50, extract_buffer=100
+        )
+        assert (res == signal[900:]).all()
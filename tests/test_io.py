@@ -7,8 +7,27 @@ Copyright (c) 2023 Wiep K. van der Toorn (w.vandertoorn@fu-berlin.de)
 
 import os
 import shutil
+import time
+from functools import partial
+from multiprocessing import Pool
 
-from adapt.io import remove_reads_from_fast5
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+from adapt.detect import detect_adapter_in_read
+from adapt.extract import extract_adapter_from_read
+from adapt.io import (AdapterBoundaries, ExtractedSignalWriter,
+                      MultiFast5Reader, ReadContext, ResultsWriter,
+                      _prefetch_reads, _raw_byte_ranges,
+                      load_adapter_boundaries, load_adapter_signals,
+                      make_work_units, open_fast5_file, process_fast5_file,
+                      process_fast5_files, read_extracted_adapters, read_table,
+                      remove_reads_from_fast5, remove_signal_shards,
+                      watch_fast5_files)
+from adapt.utils import (ResultsBatch, adaptiveDetectResults,
+                         detect_results_to_df, extract_results_to_df,
+                         processError, signalShard)
 
 from ont_fast5_api.fast5_interface import get_fast5_file
 
@@ -54,3 +73,468 @@ def test_remove_reads_from_fast5_multi():
     # should remove whole file
     remove_reads_from_fast5(f5path_trim, remaining_read_ids)
     assert not os.path.isfile(f5path_trim)
+
+
+def test_process_fast5_file_threads():
+    f5path = os.path.join(test_data, "batch0.fast5")
+
+    res = process_fast5_file(f5path, "r", detect_adapter_in_read)
+    res_threads = process_fast5_file(f5path, "r", detect_adapter_in_read, threads=3)
+
+    assert len(res) == 5
+    assert res == res_threads
+
+
+def test_process_fast5_file_read_range():
+    f5path = os.path.join(test_data, "batch0.fast5")
+
+    res = process_fast5_file(f5path, "r", detect_adapter_in_read)
+    res_range = process_fast5_file(f5path, "r", detect_adapter_in_read, read_range=(1, 3))
+
+    assert res_range == res[1:3]
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_process_fast5_file_prefetch(threads):
+    f5path = os.path.join(test_data, "batch0.fast5")
+
+    res = process_fast5_file(f5path, "r", detect_adapter_in_read)
+    res_prefetch = process_fast5_file(
+        f5path, "r", detect_adapter_in_read, threads=threads, prefetch=2, prefetch_end=40000
+    )
+
+    assert res_prefetch == res
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+def test_process_fast5_file_record_errors(threads):
+    f5path = os.path.join(test_data, "batch0.fast5")
+    res = process_fast5_file(f5path, "r", detect_adapter_in_read)
+
+    def detect_or_fail(read):
+        if read.read_id == res[1].read_id:
+            raise ValueError("corrupt read")
+        return detect_adapter_in_read(read)
+
+    with pytest.raises(ValueError):
+        process_fast5_file(f5path, "r", detect_or_fail, threads=threads)
+
+    res_errors = process_fast5_file(f5path, "r", detect_or_fail, threads=threads, record_errors=True)
+    assert res_errors == [x for i, x in enumerate(res) if i != 1]
+    assert res_errors.errors == [
+        processError(f5path, res[1].read_id, "process", "ValueError", "corrupt read")
+    ]
+    assert ResultsBatch.concat([res_errors, res_errors[:0]]).errors == res_errors.errors
+
+    # errors of the whole file
+    res_errors = process_fast5_file(f5path + ".missing", "r", detect_or_fail, record_errors=True)
+    assert len(res_errors) == 0
+    assert [(x.read_id, x.stage) for x in res_errors.errors] == [(None, "file")]
+
+
+@pytest.mark.parametrize("prefetch", [0, 1, 2, 10])
+def test_prefetch_reads(prefetch):
+    f5path = os.path.join(test_data, "batch0.fast5")
+
+    with open_fast5_file(f5path, mode="r") as f5:
+        read_ids = [read.read_id for read in _prefetch_reads(f5.get_reads(), f5path, prefetch)]
+        assert read_ids == f5.get_read_ids()
+
+
+def test_raw_byte_ranges():
+    f5path = os.path.join(test_data, "batch0.fast5.tmp")
+    shutil.copy(os.path.join(test_data, "batch0.fast5"), f5path)
+
+    with get_fast5_file(f5path, mode="a") as f5:
+        read_chunked, read_contiguous = list(f5.get_reads())[:2]
+        signal = read_contiguous.get_raw_data()
+        del read_contiguous.handle[read_contiguous.raw_dataset_name]
+        read_contiguous.handle.create_dataset(read_contiguous.raw_dataset_name, data=signal)
+
+        # a single chunk holds the full signal
+        ranges = _raw_byte_ranges(read_chunked)
+        assert len(ranges) == 1
+        assert _raw_byte_ranges(read_chunked, end=100) == ranges
+
+        offset, size = _raw_byte_ranges(read_contiguous)[0]
+        assert size == signal.nbytes
+        assert _raw_byte_ranges(read_contiguous, end=100) == [(offset, 100 * signal.itemsize)]
+        with open(f5path, "rb") as f:
+            f.seek(offset)
+            assert np.array_equal(np.frombuffer(f.read(size), dtype=signal.dtype), signal)
+
+    os.remove(f5path)
+
+    # reads of `MultiFast5Reader` give the same ranges
+    f5path = os.path.join(test_data, "batch0.fast5")
+    with open_fast5_file(f5path, mode="r") as f5, get_fast5_file(f5path, mode="r") as f5_ont:
+        for read, read_ont in zip(f5.get_reads(), f5_ont.get_reads()):
+            assert _raw_byte_ranges(read) == _raw_byte_ranges(read_ont)
+
+
+def test_make_work_units():
+    units = make_work_units([5, 1, 0, 3], unit_size=2)
+    assert units == [(0, 0, 2), (0, 2, 4), (0, 4, 5), (3, 0, 2), (3, 2, 3), (1, 0, 1)]
+
+    # the last unit of a file does not wait for the units of other files
+    units = make_work_units([1200, 1200, 1200, 4000, 30], unit_size=500)
+    assert units.index((0, 1000, 1200)) == 8 + 2
+
+    assert make_work_units([1, 5, 3]) == [(1, 0, 5), (2, 0, 3), (0, 0, 1)]
+
+
+def test_process_fast5_files():
+    f5paths = [os.path.join(test_data, "read0.fast5"), os.path.join(test_data, "batch0.fast5")]
+    process_call = partial(process_fast5_file, mode="r", process_fn=detect_adapter_in_read)
+    process_args = [[f5path] for f5path in f5paths]
+
+    res = [process_fast5_file(f5path, "r", detect_adapter_in_read) for f5path in f5paths]
+
+    res_units = [None] * len(f5paths)
+    for i, file_res in process_fast5_files(
+        process_call, process_args, f5paths, processes=2, unit_size=2
+    ):
+        res_units[i] = file_res
+
+    assert res_units == res
+
+    # the units of a file are processed together, on a single process the largest file completes first
+    with Pool(1) as pool:
+        order = [
+            i
+            for i, _ in process_fast5_files(
+                process_call, process_args, f5paths, unit_size=2, pool=pool
+            )
+        ]
+    assert order == [1, 0]
+
+
+def test_results_csv_writer():
+    f5paths = [os.path.join(test_data, "read0.fast5"), os.path.join(test_data, "batch0.fast5")]
+    outdir = os.path.join(test_data, "tmp")
+    os.makedirs(outdir, exist_ok=True)
+
+    res = [process_fast5_file(f5path, "r", detect_adapter_in_read) for f5path in f5paths]
+
+    with ResultsWriter(outdir, ["detect"], [test_data]) as writer:
+        writer.write(res[0])
+        # written before the writer is closed
+        df_read0 = pd.read_csv(f"{outdir}/detected_adapter_boundaries_read0.csv", sep=";")
+        assert len(df_read0) == 1
+        writer.write(res[1])
+        writer.write([])
+
+    with ResultsWriter(outdir, ["detect"], [test_data], global_output=True) as writer:
+        for file_res in res:
+            writer.write(file_res)
+            writer.write([])
+
+    df_batch0 = pd.read_csv(f"{outdir}/detected_adapter_boundaries_batch0.csv", sep=";")
+    df = pd.read_csv(f"{outdir}/detected_adapter_boundaries.csv", sep=";")
+    pd.testing.assert_frame_equal(df, pd.concat([df_read0, df_batch0], ignore_index=True))
+    assert df.rel_filepath.tolist() == ["/read0.fast5"] + ["/batch0.fast5"] * 5
+
+    shutil.rmtree(outdir)
+
+
+@pytest.mark.parametrize("extract_format", ["npy", "hdf5"])
+@pytest.mark.parametrize("global_output", [False, True])
+def test_extracted_signal_writer(extract_format, global_output):
+    f5paths = [os.path.join(test_data, "read0.fast5"), os.path.join(test_data, "batch0.fast5")]
+    outdir = os.path.join(test_data, "tmp")
+    os.makedirs(outdir, exist_ok=True)
+
+    res = [process_fast5_file(f5path, "r", extract_adapter_from_read) for f5path in f5paths]
+
+    with ExtractedSignalWriter(outdir, extract_format, [test_data], global_output) as writer:
+        for file_res in res:
+            writer.write(file_res)
+
+    path = os.path.join(outdir, "extracted_adapters" + ("" if global_output else "_batch0"))
+    if extract_format == "hdf5":
+        path += ".hdf5"
+    metadata, signal, offsets = read_extracted_adapters(path)
+
+    extracted = [
+        x
+        for file_res in (res if global_output else res[1:])
+        for x in file_res
+        if x.results.adapter_end > x.results.adapter_start
+    ]
+    assert metadata.read_id.tolist() == [x.read_id for x in extracted]
+    assert offsets.size == len(extracted) + 1
+    for i, x in enumerate(extracted):
+        assert np.array_equal(signal[offsets[i] : offsets[i + 1]], x.results.adapter_signal)
+        assert metadata.digitisation[i] == x.results.digitisation
+
+    shutil.rmtree(outdir)
+
+
+def test_results_batch():
+    f5path = os.path.join(test_data, "batch0.fast5")
+
+    res = process_fast5_file(f5path, "r", detect_adapter_in_read)
+    rows = list(res)
+    assert isinstance(res, ResultsBatch)
+    assert res == rows
+    assert res[1] == rows[1] and res[-1] == rows[-1]
+    assert res[1:4] == rows[1:4]
+    assert ResultsBatch.concat([res[:2], res[2:]]) == res
+    pd.testing.assert_frame_equal(detect_results_to_df(res), detect_results_to_df(rows))
+
+    # detection results combined with adaptive detection results
+    adaptive = [x._replace(results=adaptiveDetectResults(*x.results, 3000)) for x in rows[:2]]
+    mixed = ResultsBatch.concat([ResultsBatch.from_results(adaptive), res[2:]])
+    assert mixed == adaptive + rows[2:]
+    assert detect_results_to_df(mixed).detection_window.isna().tolist() == [False, False, True, True, True]
+
+    with pytest.raises(ValueError):
+        ResultsBatch.from_results(rows + [rows[0]._replace(filepath="other.fast5")])
+
+    # adapter signals of extraction results, of which some are empty
+    res = process_fast5_file(f5path, "r", extract_adapter_from_read)
+    rows = [
+        x._replace(results=x.results._replace(adapter_signal=x.results.adapter_signal[:0]))
+        if i % 2
+        else x
+        for i, x in enumerate(res)
+    ]
+    batch = ResultsBatch.from_results(rows)
+    for indices in [[0, 1, 2, 3, 4], [4, 0, 3], [1, 3], []]:
+        for x, y in zip(batch.take(indices), [rows[i] for i in indices]):
+            assert np.array_equal(x.results.adapter_signal, y.results.adapter_signal)
+    pd.testing.assert_frame_equal(extract_results_to_df(batch), extract_results_to_df(rows))
+
+
+def test_signal_shards():
+    f5path = os.path.join(test_data, "batch0.fast5")
+    outdir = os.path.join(test_data, "tmp")
+    os.makedirs(outdir, exist_ok=True)
+
+    res = process_fast5_file(f5path, "r", extract_adapter_from_read)
+    res_shards = ResultsBatch.concat(
+        [
+            process_fast5_file(f5path, "r", extract_adapter_from_read, read_range=(0, 2), shard_dir=outdir),
+            process_fast5_file(f5path, "r", extract_adapter_from_read, read_range=(2, 5), shard_dir=outdir),
+        ]
+    )
+
+    assert all(isinstance(x.results.adapter_signal, signalShard) for x in res_shards)
+    assert len(res_shards.shard_paths()) == len(os.listdir(outdir)) == 2
+    res_loaded = load_adapter_signals(res_shards)
+    assert res_loaded.shard_paths() == []
+    for x, x_shards in zip(res, res_loaded):
+        assert np.array_equal(x.results.adapter_signal, x_shards.results.adapter_signal)
+        assert x._replace(results=x.results[:-1]) == x_shards._replace(results=x_shards.results[:-1])
+
+    # detection results are not sharded
+    res_detect = process_fast5_file(f5path, "r", detect_adapter_in_read, shard_dir=outdir)
+    assert res_detect == process_fast5_file(f5path, "r", detect_adapter_in_read)
+
+    # written from the shards
+    with ExtractedSignalWriter(outdir, "npy", [test_data]) as writer:
+        writer.write(res_shards)
+    _, signal, offsets = read_extracted_adapters(os.path.join(outdir, "extracted_adapters_batch0"))
+    extracted = [x for x in res if x.results.adapter_end > x.results.adapter_start]
+    assert np.array_equal(signal, np.concatenate([x.results.adapter_signal for x in extracted]))
+    assert offsets.size == len(extracted) + 1
+
+    remove_signal_shards(res_shards)
+    assert not any(name.startswith("signal_shard_") for name in os.listdir(outdir))
+
+    shutil.rmtree(outdir)
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "feather"])
+def test_results_writer_arrow(output_format):
+    pytest.importorskip("pyarrow")
+
+    f5paths = [os.path.join(test_data, "read0.fast5"), os.path.join(test_data, "batch0.fast5")]
+    outdir = os.path.join(test_data, "tmp")
+    os.makedirs(outdir, exist_ok=True)
+
+    res = [process_fast5_file(f5path, "r", detect_adapter_in_read) for f5path in f5paths]
+
+    for global_output in [False, True]:
+        with ResultsWriter(outdir, ["detect"], [test_data], global_output, output_format) as writer:
+            for file_res in res:
+                writer.write(file_res)
+        with ResultsWriter(outdir, ["detect"], [test_data], global_output) as writer:
+            for file_res in res:
+                writer.write(file_res)
+
+    for suffix in ["", "_batch0"]:
+        df = read_table(f"{outdir}/detected_adapter_boundaries{suffix}.{output_format}")
+        df_csv = read_table(f"{outdir}/detected_adapter_boundaries{suffix}.csv")
+        assert df.adapter_start.dtype == np.int64
+        if output_format == "parquet":
+            assert isinstance(df.rel_filepath.dtype, pd.CategoricalDtype)
+        pd.testing.assert_frame_equal(
+            df.astype({"rel_filepath": str, "read_id": str}),
+            df_csv.astype({"rel_filepath": str, "read_id": str}),
+        )
+
+    shutil.rmtree(outdir)
+
+
+def test_adapter_boundaries():
+    boundaries = AdapterBoundaries(["c", "a", "b", "a"], [3, 1, 2, 4], [30, 10, 20, 40])
+
+    assert len(boundaries) == 3
+    assert boundaries.get("a") == (1, 10)
+    assert boundaries.get("c") == (3, 30)
+    assert boundaries.get("d") is None
+    assert boundaries.get("0") is None
+
+
+def test_load_adapter_boundaries():
+    f5path = os.path.join(test_data, "batch0.fast5")
+    outdir = os.path.join(test_data, "tmp_boundaries")
+    os.makedirs(outdir, exist_ok=True)
+
+    results = process_fast5_file(f5path, "r", detect_adapter_in_read)
+    with ResultsWriter(outdir, ["detect"], [test_data]) as writer:
+        writer.write(results)
+
+    boundaries_dir = load_adapter_boundaries(outdir)
+    boundaries_file = load_adapter_boundaries(
+        os.path.join(outdir, "detected_adapter_boundaries_batch0.csv")
+    )
+    for res in results:
+        assert boundaries_dir.get(res.read_id) == res.results
+        assert boundaries_file.get(res.read_id) == res.results
+
+    shutil.rmtree(outdir)
+
+    with pytest.raises(ValueError):
+        load_adapter_boundaries(test_data)
+
+
+def test_read_context():
+    f5path = os.path.join(test_data, "batch0.fast5")
+
+    with get_fast5_file(f5path, mode="r") as f5:
+        read = next(f5.get_reads())
+        context = ReadContext(read)
+
+        # count the reads from disk
+        loads = []
+        get_raw_data = read.get_raw_data
+        read.get_raw_data = lambda **kwargs: loads.append(kwargs) or get_raw_data(**kwargs)
+
+        signal = get_raw_data()
+        assert np.array_equal(context.get_raw_data(end=1000), signal[:1000])
+        assert np.array_equal(context.get_raw_data(start=200, end=500), signal[200:500])
+        assert len(loads) == 1
+        assert np.array_equal(context.get_raw_data(start=500, end=3000), signal[500:3000])
+        assert loads[-1] == dict(start=1000, end=3000, scale=False)
+        assert np.array_equal(context.get_raw_data(), signal)
+        assert np.array_equal(context.get_raw_data(start=-10), signal[-10:])
+        assert np.array_equal(context.get_raw_data(end=signal.size + 10), signal)
+        assert len(loads) == 3
+
+        assert np.allclose(context.get_raw_data(end=100, scale=True), get_raw_data(end=100, scale=True))
+        assert context.get_channel_info() == read.get_channel_info()
+        assert context.raw_attrs["duration"] == signal.size
+        assert context.raw_dataset_name == read.raw_dataset_name
+
+
+def test_multi_fast5_reader():
+    f5path = os.path.join(test_data, "batch0.fast5")
+
+    with open_fast5_file(f5path, mode="r") as f5, get_fast5_file(f5path, mode="r") as f5_ont:
+        assert isinstance(f5, MultiFast5Reader)
+        assert f5.get_read_ids() == f5_ont.get_read_ids()
+
+        for read, read_ont in zip(f5.get_reads(), f5_ont.get_reads()):
+            assert read.read_id == read_ont.read_id
+            assert read.handle.name == read_ont.handle.name
+            assert read.get_channel_info() == read_ont.get_channel_info()
+
+            signal = read_ont.get_raw_data()
+            assert read.get_raw_data().dtype == signal.dtype
+            assert np.array_equal(read.get_raw_data(), signal)
+            assert np.array_equal(read.get_raw_data(start=100, end=2000), signal[100:2000])
+            assert np.array_equal(read.get_raw_data(end=signal.size + 10), signal)
+            assert np.array_equal(read.get_raw_data(start=-50), signal[-50:])
+            assert read.get_raw_data(start=signal.size, end=signal.size + 10).size == 0
+            assert np.array_equal(
+                read.get_raw_data(end=100, scale=True), read_ont.get_raw_data(end=100, scale=True)
+            )
+
+
+def test_multi_fast5_reader_vlen_str_attrs():
+    f5path = os.path.join(test_data, "batch0.fast5")
+    f5path_vlen = f5path + ".tmp"
+    shutil.copy(f5path, f5path_vlen)
+
+    # channel attributes stored as variable-length strings
+    with h5py.File(f5path_vlen, "a") as f:
+        for name in f:
+            attrs = f[name]["channel_id"].attrs
+            channel_number = attrs["channel_number"].decode()
+            del attrs["channel_number"]
+            attrs.create("channel_number", channel_number, dtype=h5py.string_dtype())
+
+    with open_fast5_file(f5path_vlen, mode="r") as f5, get_fast5_file(f5path, mode="r") as f5_ont:
+        assert isinstance(f5, MultiFast5Reader)
+        for read, read_ont in zip(f5.get_reads(), f5_ont.get_reads()):
+            assert read.get_channel_info() == read_ont.get_channel_info()
+
+    for process_fn in [detect_adapter_in_read, extract_adapter_from_read]:
+        res = process_fast5_file(f5path, "r", process_fn)
+        res_vlen = process_fast5_file(f5path_vlen, "r", process_fn)
+        assert res_vlen.read_ids.tolist() == res.read_ids.tolist()
+        assert np.array_equal(res_vlen.records, res.records)
+        if process_fn is extract_adapter_from_read:
+            assert all(map(np.array_equal, res_vlen.adapter_signals(), res.adapter_signals()))
+
+    os.remove(f5path_vlen)
+
+
+def test_open_fast5_file_fallback():
+    # single read files are read with ont_fast5_api
+    with open_fast5_file(os.path.join(test_data, "read0.fast5"), mode="r") as f5:
+        assert not isinstance(f5, MultiFast5Reader)
+        assert len(list(f5.get_reads())) == 1
+
+    # files opened for writing are read with ont_fast5_api
+    f5path = os.path.join(test_data, "batch0.fast5.tmp")
+    shutil.copy(os.path.join(test_data, "batch0.fast5"), f5path)
+    with open_fast5_file(f5path, mode="a") as f5:
+        assert not isinstance(f5, MultiFast5Reader)
+    os.remove(f5path)
+
+
+def test_watch_fast5_files():
+    watch_dir = os.path.join(test_data, "tmp_watch")
+    os.makedirs(watch_dir, exist_ok=True)
+
+    def touch(name, age):
+        path = os.path.join(watch_dir, name)
+        with open(path, "wb") as f:
+            f.write(name.encode())
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    a = touch("a.fast5", 120)
+    touch("a.txt", 120)
+    # files are complete at the earliest on the second poll they are seen in
+    assert list(watch_fast5_files(watch_dir, settle_time=60, timeout=0)) == []
+
+    watcher = watch_fast5_files(watch_dir, interval=0.01, settle_time=60, timeout=0.5)
+    assert next(watcher) == [a]
+
+    b = touch("b.fast5", 120)
+    assert next(watcher) == [b]
+
+    # files modified within the settle time are not complete, the watcher times out
+    c = touch("c.fast5", 0)
+    assert list(watcher) == []
+
+    # after a stop file all files are complete
+    stop_file = touch("stop", 0)
+    assert list(watch_fast5_files(watch_dir, settle_time=60, stop_file=stop_file)) == [[a, b, c]]
+
+    shutil.rmtree(watch_dir)
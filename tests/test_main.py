@@ -8,8 +8,15 @@ Copyright (c) 2023 Wiep K. van der Toorn (w.vandertoorn@fu-berlin.de)
 import os
 import shutil
 
+import h5py
+import numpy as np
+import pandas as pd
 import pytest
 from adapt.__main__ import main
+from adapt.io import read_extracted_adapters
+
+from ont_fast5_api.compression_settings import VBZ
+from ont_fast5_api.fast5_interface import get_fast5_file
 
 test_data = os.path.join(os.path.dirname(__file__), "data")
 if os.path.isdir(os.path.join(test_data, "tmp")):
@@ -28,6 +35,7 @@ def test_main_detect_single_f5_single_file():
     main(args)
 
     os.remove(f"{test_data}/tmp/detected_adapter_boundaries_read0.csv")
+    os.remove(f"{test_data}/tmp/adapt_manifest.jsonl")
     os.rmdir(f"{test_data}/tmp")
 
 
@@ -43,6 +51,7 @@ def test_main_detect_multi_f5_single_file():
     main(args)
 
     os.remove(f"{test_data}/tmp/detected_adapter_boundaries_batch0.csv")
+    os.remove(f"{test_data}/tmp/adapt_manifest.jsonl")
     os.rmdir(f"{test_data}/tmp")
 
 
@@ -54,6 +63,7 @@ def test_main_detect_mixed_multi_file():
 
     os.remove(f"{test_data}/tmp/detected_adapter_boundaries_read0.csv")
     os.remove(f"{test_data}/tmp/detected_adapter_boundaries_batch0.csv")
+    os.remove(f"{test_data}/tmp/adapt_manifest.jsonl")
     os.rmdir(f"{test_data}/tmp")
 
 
@@ -80,9 +90,40 @@ def test_main_detect_global_output_csv():
     main(args)
 
     os.remove(f"{test_data}/tmp/detected_adapter_boundaries.csv")
+    os.remove(f"{test_data}/tmp/adapt_manifest.jsonl")
     os.rmdir(f"{test_data}/tmp")
 
 
+@pytest.mark.parametrize("mode", ["detect", "extract"])
+def test_main_global_output_csv_order(mode):
+    # the largest file is processed first, the global output keeps the input file order
+    input_path = f"{test_data}/order_input"
+    os.makedirs(input_path, exist_ok=True)
+    for fname in ["batch0.fast5", "read0.fast5"]:
+        shutil.copy(f"{test_data}/{fname}", f"{input_path}/{fname}")
+    fast5_subset = "read0.fast5 batch0.fast5"
+
+    tables = []
+    for j in [1, 2]:
+        save_path = f"{test_data}/tmp_order_{j}"
+        args = (
+            f"{mode} --input_path {input_path} --save_path {save_path} --global_output_csv "
+            f"--j {j} --unit_size 1 --fast5_subset {fast5_subset}"
+        )
+        main(args.split(" "))
+        tables.append(
+            pd.read_csv(f"{save_path}/detected_adapter_boundaries.csv", sep=";")
+            if mode == "detect"
+            else pd.read_csv(f"{save_path}/extracted_adapters.csv", sep=";")
+        )
+        shutil.rmtree(save_path)
+
+    assert tables[0].rel_filepath.unique().tolist() == ["/read0.fast5", "/batch0.fast5"]
+    pd.testing.assert_frame_equal(tables[1], tables[0])
+
+    shutil.rmtree(input_path)
+
+
 def test_main_detect_fast5_subset_txt():
     args = (
         "detect "
@@ -95,6 +136,7 @@ def test_main_detect_fast5_subset_txt():
     main(args)
 
     os.remove(f"{test_data}/tmp/detected_adapter_boundaries_read0.csv")
+    os.remove(f"{test_data}/tmp/adapt_manifest.jsonl")
     os.rmdir(f"{test_data}/tmp")
 
 
@@ -111,6 +153,7 @@ def test_main_trim_single_f5_single_file():
 
     os.remove(f"{test_data}/tmp/detected_adapter_boundaries_read0.csv")
     os.remove(f"{test_data}/tmp/read0.fast5")
+    os.remove(f"{test_data}/tmp/adapt_manifest.jsonl")
     os.rmdir(f"{test_data}/tmp")
 
 
@@ -127,6 +170,7 @@ def test_main_trim_multi_f5_single_file():
 
     os.remove(f"{test_data}/tmp/detected_adapter_boundaries_batch0.csv")
     os.remove(f"{test_data}/tmp/batch0.fast5")
+    os.remove(f"{test_data}/tmp/adapt_manifest.jsonl")
     os.rmdir(f"{test_data}/tmp")
 
 
@@ -140,6 +184,7 @@ def test_main_trim_mixed_multi_file():
     os.remove(f"{test_data}/tmp/detected_adapter_boundaries_batch0.csv")
     os.remove(f"{test_data}/tmp/read0.fast5")
     os.remove(f"{test_data}/tmp/batch0.fast5")
+    os.remove(f"{test_data}/tmp/adapt_manifest.jsonl")
     os.rmdir(f"{test_data}/tmp")
 
 
@@ -167,6 +212,7 @@ def test_main_extract_single_f5_single_file():
 
     os.remove(f"{test_data}/tmp/detected_adapter_boundaries_read0.csv")
     os.remove(f"{test_data}/tmp/extracted_adapters_read0.csv")
+    os.remove(f"{test_data}/tmp/adapt_manifest.jsonl")
     os.rmdir(f"{test_data}/tmp")
 
 
@@ -183,4 +229,355 @@ def test_main_extract_multi_f5_single_file():
 
     os.remove(f"{test_data}/tmp/detected_adapter_boundaries_batch0.csv")
     os.remove(f"{test_data}/tmp/extracted_adapters_batch0.csv")
+    os.remove(f"{test_data}/tmp/adapt_manifest.jsonl")
+    os.rmdir(f"{test_data}/tmp")
+
+
+def test_main_detect_partial_read():
+    args = (
+        "detect "
+        + f"--input_path {test_data} "
+        + f"--save_path {test_data}/tmp "
+        + "--fast5_subset batch0.fast5 "
+        + "--max_obs 8000 "
+        + "--partial_read"
+    )
+
+    args = [x for x in args.split(" ") if len(x)]
+    main(args)
+
+    os.remove(f"{test_data}/tmp/detected_adapter_boundaries_batch0.csv")
+    os.remove(f"{test_data}/tmp/adapt_manifest.jsonl")
+    os.rmdir(f"{test_data}/tmp")
+
+
+def test_main_trim_threads():
+    args = (
+        "trim "
+        + f"--input_path {test_data} "
+        + f"--save_path {test_data}/tmp "
+        + "--fast5_subset batch0.fast5 "
+        + "--threads 2"
+    )
+
+    args = [x for x in args.split(" ") if len(x)]
+    main(args)
+
+    os.remove(f"{test_data}/tmp/detected_adapter_boundaries_batch0.csv")
+    os.remove(f"{test_data}/tmp/batch0.fast5")
+    os.remove(f"{test_data}/tmp/adapt_manifest.jsonl")
+    os.rmdir(f"{test_data}/tmp")
+
+
+def test_main_trim_compression():
+    args = (
+        "trim "
+        + f"--input_path {test_data} "
+        + f"--save_path {test_data}/tmp "
+        + "--fast5_subset batch0.fast5 "
+        + "--trim_compression vbz "
+        + "--trim_chunk_size 4096"
+    )
+
+    args = [x for x in args.split(" ") if len(x)]
+    main(args)
+
+    with get_fast5_file(f"{test_data}/tmp/batch0.fast5", mode="r") as f5:
+        for read in f5.get_reads():
+            dataset = read.handle[read.raw_dataset_name]
+            assert list(dataset._filters) == [str(VBZ.compression)]
+            assert dataset.chunks == (4096,)
+
+    os.remove(f"{test_data}/tmp/detected_adapter_boundaries_batch0.csv")
+    os.remove(f"{test_data}/tmp/batch0.fast5")
+    os.remove(f"{test_data}/tmp/adapt_manifest.jsonl")
+    os.rmdir(f"{test_data}/tmp")
+
+
+def test_main_detect_adaptive():
+    args = (
+        "detect "
+        + f"--input_path {test_data} "
+        + f"--save_path {test_data}/tmp "
+        + "--fast5_subset batch0.fast5 "
+        + "--adaptive "
+        + "--start_window 5000"
+    )
+
+    args = [x for x in args.split(" ") if len(x)]
+    main(args)
+
+    df = pd.read_csv(f"{test_data}/tmp/detected_adapter_boundaries_batch0.csv", sep=";")
+    assert (df.detection_window >= 5000).all()
+
+    os.remove(f"{test_data}/tmp/detected_adapter_boundaries_batch0.csv")
+    os.remove(f"{test_data}/tmp/adapt_manifest.jsonl")
     os.rmdir(f"{test_data}/tmp")
+
+
+def test_main_detect_work_units():
+    args = (
+        "detect "
+        + f"--input_path {test_data} "
+        + f"--save_path {test_data}/tmp "
+        + "--j 2 "
+        + "--unit_size 2"
+    )
+
+    args = [x for x in args.split(" ") if len(x)]
+    main(args)
+
+    df = pd.read_csv(f"{test_data}/tmp/detected_adapter_boundaries_batch0.csv", sep=";")
+    assert len(df) == 5
+
+    os.remove(f"{test_data}/tmp/detected_adapter_boundaries_read0.csv")
+    os.remove(f"{test_data}/tmp/detected_adapter_boundaries_batch0.csv")
+    os.remove(f"{test_data}/tmp/adapt_manifest.jsonl")
+    os.rmdir(f"{test_data}/tmp")
+
+
+def test_main_extract_npy():
+    args = (
+        "extract "
+        + f"--input_path {test_data} "
+        + f"--save_path {test_data}/tmp "
+        + "--fast5_subset batch0.fast5 "
+        + "--extract_format npy"
+    )
+
+    args = [x for x in args.split(" ") if len(x)]
+    main(args)
+
+    assert not os.path.exists(f"{test_data}/tmp/extracted_adapters_batch0.csv")
+    for suffix in ["signal.npy", "offsets.npy", "metadata.csv"]:
+        os.remove(f"{test_data}/tmp/extracted_adapters_batch0_{suffix}")
+    os.remove(f"{test_data}/tmp/detected_adapter_boundaries_batch0.csv")
+    os.remove(f"{test_data}/tmp/adapt_manifest.jsonl")
+    os.rmdir(f"{test_data}/tmp")
+
+
+def test_main_extract_npy_parquet():
+    pytest.importorskip("pyarrow")
+
+    args = (
+        "extract "
+        + f"--input_path {test_data} "
+        + f"--save_path {test_data}/tmp "
+        + "--fast5_subset batch0.fast5 "
+        + "--extract_format npy "
+        + "--output_format parquet"
+    )
+
+    args = [x for x in args.split(" ") if len(x)]
+    main(args)
+
+    df = pd.read_parquet(f"{test_data}/tmp/detected_adapter_boundaries_batch0.parquet")
+    assert len(df) == 5
+
+    for suffix in ["signal.npy", "offsets.npy", "metadata.parquet"]:
+        os.remove(f"{test_data}/tmp/extracted_adapters_batch0_{suffix}")
+    os.remove(f"{test_data}/tmp/detected_adapter_boundaries_batch0.parquet")
+    os.remove(f"{test_data}/tmp/adapt_manifest.jsonl")
+    os.rmdir(f"{test_data}/tmp")
+
+
+@pytest.mark.parametrize("extract_format", ["csv", "npy", "hdf5"])
+@pytest.mark.parametrize("global_output", [False, True])
+def test_main_extract_shards(extract_format, global_output):
+    outputs = []
+    for processes in [1, 2]:
+        args = (
+            "extract "
+            + f"--input_path {test_data} "
+            + f"--save_path {test_data}/tmp "
+            + f"--extract_format {extract_format} "
+            + f"--j {processes} "
+            + "--unit_size 2"
+            + (" --global_output_csv" if global_output else "")
+        )
+
+        args = [x for x in args.split(" ") if len(x)]
+        main(args)
+
+        # worker shards are deleted
+        assert not any(name.startswith(".adapt_shards_") for name in os.listdir(f"{test_data}/tmp"))
+
+        prefix = f"{test_data}/tmp/extracted_adapters" + ("" if global_output else "_batch0")
+        if extract_format == "csv":
+            outputs.append(pd.read_csv(f"{prefix}.csv", sep=";"))
+        else:
+            outputs.append(
+                read_extracted_adapters(prefix + (".hdf5" if extract_format == "hdf5" else ""), mmap=False)
+            )
+        shutil.rmtree(f"{test_data}/tmp")
+
+    if extract_format == "csv":
+        pd.testing.assert_frame_equal(outputs[0], outputs[1])
+    else:
+        (metadata, signal, offsets), (metadata_j, signal_j, offsets_j) = outputs
+        pd.testing.assert_frame_equal(metadata, metadata_j)
+        assert np.array_equal(signal, signal_j)
+        assert np.array_equal(offsets, offsets_j)
+        assert signal.size > 0
+
+
+@pytest.mark.parametrize("mode", ["trim", "extract"])
+def test_main_boundaries(mode):
+    boundaries_path = f"{test_data}/boundaries.csv"
+    with get_fast5_file(f"{test_data}/batch0.fast5", mode="r") as f5:
+        read_ids = f5.get_read_ids()
+    # boundaries that detection would not find, the first read is detected
+    boundaries = pd.DataFrame(
+        dict(
+            read_id=read_ids[1:],
+            adapter_start=[100, 200, 300, 400],
+            adapter_end=[1100, 1200, 1300, 1400],
+        )
+    )
+    boundaries.to_csv(boundaries_path, sep=";", index=False)
+
+    args = (
+        f"{mode} "
+        + f"--input_path {test_data} "
+        + f"--save_path {test_data}/tmp "
+        + "--fast5_subset batch0.fast5 "
+        + f"--boundaries {boundaries_path}"
+    )
+
+    args = [x for x in args.split(" ") if len(x)]
+    main(args)
+
+    df = pd.read_csv(f"{test_data}/tmp/detected_adapter_boundaries_batch0.csv", sep=";")
+    assert df.read_id.tolist() == read_ids
+    assert df.adapter_start.tolist()[1:] == boundaries.adapter_start.tolist()
+    assert df.adapter_end.tolist()[1:] == boundaries.adapter_end.tolist()
+    assert df.adapter_end.iloc[0] > 0
+
+    if mode == "trim":
+        with get_fast5_file(f"{test_data}/batch0.fast5", mode="r") as f5:
+            size = f5.get_read(read_ids[1]).get_raw_data().size
+        with get_fast5_file(f"{test_data}/tmp/batch0.fast5", mode="r") as f5:
+            # trimmed at adapter_end - trimming_buffer
+            assert f5.get_read(read_ids[1]).get_raw_data().size == size - (1100 - 100)
+        os.remove(f"{test_data}/tmp/batch0.fast5")
+    else:
+        os.remove(f"{test_data}/tmp/extracted_adapters_batch0.csv")
+
+    os.remove(boundaries_path)
+    os.remove(f"{test_data}/tmp/detected_adapter_boundaries_batch0.csv")
+    os.remove(f"{test_data}/tmp/adapt_manifest.jsonl")
+    os.rmdir(f"{test_data}/tmp")
+
+
+def test_main_resume():
+    input_path = f"{test_data}/resume_input"
+    os.makedirs(input_path, exist_ok=True)
+    for fname in ["read0.fast5", "batch0.fast5"]:
+        shutil.copy(f"{test_data}/{fname}", f"{input_path}/{fname}")
+
+    def run(extra_args=""):
+        args = f"detect --input_path {input_path} --save_path {test_data}/tmp " + extra_args
+        main([x for x in args.split(" ") if len(x)])
+        with open(f"{test_data}/tmp/adapt_manifest.jsonl") as f:
+            return f.read().splitlines()
+
+    assert len(run()) == 2
+    assert len(run("--resume")) == 2
+
+    # only redo the missing output
+    os.remove(f"{test_data}/tmp/detected_adapter_boundaries_batch0.csv")
+    lines = run("--resume")
+    assert len(lines) == 3 and "batch0.fast5" in lines[-1]
+    assert os.path.isfile(f"{test_data}/tmp/detected_adapter_boundaries_batch0.csv")
+
+    # changed input files and new parameters
+    stat = os.stat(f"{input_path}/read0.fast5")
+    os.utime(f"{input_path}/read0.fast5", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    lines = run("--resume")
+    assert len(lines) == 4 and "read0.fast5" in lines[-1]
+    assert len(run("--resume --max_obs 30000")) == 6
+
+    # an interrupted write of the manifest is ignored
+    with open(f"{test_data}/tmp/adapt_manifest.jsonl", "a") as f:
+        f.write('{"src": "')
+    assert len(run("--resume --max_obs 30000")) == 7
+
+    # without `--resume` a new manifest is started
+    assert len(run()) == 2
+
+    with pytest.raises(ValueError):
+        run("--resume --global_output_csv")
+
+    shutil.rmtree(input_path)
+    shutil.rmtree(f"{test_data}/tmp")
+
+
+@pytest.mark.parametrize("mode,j", [("detect", 1), ("detect", 2), ("extract", 2), ("trim", 1)])
+def test_main_errors(mode, j):
+    input_path = f"{test_data}/errors_input"
+    os.makedirs(input_path, exist_ok=True)
+    shutil.copy(f"{test_data}/batch0.fast5", f"{input_path}/batch0.fast5")
+    with h5py.File(f"{input_path}/batch0.fast5", "a") as f:
+        read_id = sorted(f)[1][len("read_") :]
+        del f[f"read_{read_id}/Raw/Signal"]
+    with open(f"{input_path}/corrupt.fast5", "wb") as f:
+        f.write(b"not a fast5 file")
+
+    args = f"{mode} --input_path {input_path} --save_path {test_data}/tmp --j {j} --unit_size 2"
+    main(args.split(" "))
+
+    errors = pd.read_csv(f"{test_data}/tmp/adapt_errors.csv", sep=";")
+    errors = errors.sort_values("rel_filepath", ignore_index=True)
+    assert errors.rel_filepath.str.endswith(("batch0.fast5", "corrupt.fast5")).all()
+    assert errors.read_id.tolist()[0] == read_id and errors.read_id.isna().tolist() == [False, True]
+    assert errors.stage.tolist() == ["process", "file"]
+    assert errors.exception.tolist()[0] == "KeyError"
+
+    # the other reads are processed, the failed file is not complete
+    if mode == "trim":
+        with get_fast5_file(f"{test_data}/tmp/batch0.fast5", mode="r") as f5:
+            assert len(f5.get_read_ids()) == 4 and read_id not in f5.get_read_ids()
+    else:
+        df = pd.read_csv(f"{test_data}/tmp/detected_adapter_boundaries_batch0.csv", sep=";")
+        assert len(df) == 4 and read_id not in df.read_id.tolist()
+    with open(f"{test_data}/tmp/adapt_manifest.jsonl") as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 1 and "batch0.fast5" in lines[0] and '"errors": 1' in lines[0]
+
+    with pytest.raises(RuntimeError):
+        main((args + " --max_errors 1").split(" "))
+
+    shutil.rmtree(input_path)
+    shutil.rmtree(f"{test_data}/tmp")
+
+
+@pytest.mark.parametrize("j", [1, 2])
+def test_main_watch(j):
+    input_path = f"{test_data}/watch_input"
+    os.makedirs(input_path, exist_ok=True)
+    for fname in ["read0.fast5", "batch0.fast5"]:
+        shutil.copy(f"{test_data}/{fname}", f"{input_path}/{fname}")
+
+    args = (
+        f"detect --input_path {input_path} --save_path {test_data}/tmp --j {j} --watch "
+        "--watch_interval 0.05 --watch_settle 0 --watch_timeout 0.5"
+    )
+    main(args.split(" "))
+
+    for fname in ["read0", "batch0"]:
+        assert os.path.isfile(f"{test_data}/tmp/detected_adapter_boundaries_{fname}.csv")
+    with open(f"{test_data}/tmp/adapt_manifest.jsonl") as f:
+        assert len(f.read().splitlines()) == 2
+
+    # a stop file ends the run after the remaining files
+    stop_file = f"{test_data}/tmp/adapt.stop"
+    open(stop_file, "w").close()
+    main(f"detect --input_path {input_path} --save_path {test_data}/tmp --watch --stop_file {stop_file}".split(" "))
+    with open(f"{test_data}/tmp/adapt_manifest.jsonl") as f:
+        assert len(f.read().splitlines()) == 2
+
+    with pytest.raises(ValueError):
+        main((args + " --fast5_subset batch0.fast5").split(" "))
+
+    shutil.rmtree(input_path)
+    shutil.rmtree(f"{test_data}/tmp")
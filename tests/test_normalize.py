@@ -37,3 +37,55 @@ def test_windsorizing():
 
     assert (norm_med <= upper_lim).all()
     assert (norm_med >= lower_lim).all()
+
+
+def test_max_obs():
+    signal = np.random.randint(50, 350, 1000, dtype=np.int16)
+    norm_signal = normalize_signal(signal, max_obs=100)
+
+    assert norm_signal.shape == (100,)
+    assert (norm_signal == normalize_signal(signal)[:100]).all()
+
+
+def test_norm_window():
+    signal = np.random.randint(50, 350, 1000, dtype=np.int16)
+
+    norm_signal = normalize_signal(signal, norm_window=200)
+    assert norm_signal.shape == signal.shape
+    assert (norm_signal[:200] == normalize_signal(signal[:200])).all()
+
+    norm_signal = normalize_signal(signal, norm_window=200, max_obs=100)
+    assert (norm_signal == normalize_signal(signal[:200])[:100]).all()
+
+    norm_signal = normalize_signal(signal, norm_window=200, max_obs=500)
+    assert norm_signal.shape == (500,)
+    assert (norm_signal[:200] == normalize_signal(signal[:200])).all()
+
+
+def test_int16_matches_float():
+    # int16 signal is normalized with histogram statistics, float signal with numpy
+    for size in [1, 2, 99, 100, 5000]:
+        signal = np.random.normal(500, 80, size).astype(np.int16)
+        for outlier_thresh in [2, 5]:
+            norm_int = normalize_signal(signal, outlier_thresh)
+            with np.errstate(invalid="ignore"):  # MAD is 0 for size 1
+                norm_float = normalize_signal(signal.astype(np.float64), outlier_thresh)
+
+            assert (norm_int.view(np.int64) == norm_float.view(np.int64)).all()
+
+    signal = np.random.randint(-32768, 32767, 1000, dtype=np.int16)
+    norm_int = normalize_signal(signal, norm_window=100, max_obs=500)
+    norm_float = normalize_signal(
+        signal.astype(np.float64), norm_window=100, max_obs=500
+    )
+    assert (norm_int.view(np.int64) == norm_float.view(np.int64)).all()
+
+
+def test_out():
+    signal = np.random.randint(50, 350, 100, dtype=np.int16)
+    out = np.zeros(200, dtype=np.float64)
+    norm_signal = normalize_signal(signal, out=out)
+
+    assert np.shares_memory(norm_signal, out)
+    assert (norm_signal == out[:100]).all()
+    assert (out[100:] == 0).all()
@@ -9,8 +9,13 @@ Copyright (c) 2023 Wiep K. van der Toorn (w.vandertoorn@fu-berlin.de)
 import os
 import shutil
 
-from adapt.trim import slice_signal_in_read
+import h5py
+import numpy as np
+import pytest
+from adapt.io import raw_dataset_layout, write_sliced_fast5_file
+from adapt.trim import get_trim_slice, slice_signal_in_read
 
+from ont_fast5_api.compression_settings import VBZ
 from ont_fast5_api.fast5_interface import get_fast5_file
 
 test_data = os.path.join(os.path.dirname(__file__), "data")
@@ -50,3 +55,95 @@ def test_slice_signal_multi():
         assert duration == 1000
 
         os.remove(f5path_trim)
+
+
+@pytest.mark.parametrize("fname", ["read0.fast5", "batch0.fast5"])
+@pytest.mark.parametrize("threads", [1, 2])
+def test_write_sliced_fast5_file(fname, threads):
+    f5path = os.path.join(test_data, fname)
+    f5path_trim = f5path + ".tmp"
+
+    results = write_sliced_fast5_file(
+        f5path, f5path_trim, get_trim_slice, dict(buffer=100), threads=threads
+    )
+    assert [res.filepath for res in results] == [f5path_trim] * len(results)
+
+    with get_fast5_file(f5path, mode="r") as f5, get_fast5_file(f5path_trim, mode="r") as f5_trim:
+        reads_trim = list(f5_trim.get_reads())
+        assert [read.read_id for read in reads_trim] == [res.read_id for res in results]
+
+        for read, read_trim, res in zip(f5.get_reads(), reads_trim, results):
+            signal = read.get_raw_data()[max(0, res.results.adapter_end - 100):]
+            assert np.array_equal(read_trim.get_raw_data(), signal)
+
+            duration = read_trim.handle[read_trim.raw_dataset_group_name].attrs["duration"]
+            assert duration == signal.size
+
+            # compression and chunking of the source are kept
+            dataset = read.handle[read.raw_dataset_name]
+            dataset_trim = read_trim.handle[read_trim.raw_dataset_name]
+            assert dataset_trim._filters == dataset._filters
+            assert dataset_trim.chunks == dataset.chunks
+
+            assert read_trim.get_channel_info() == read.get_channel_info()
+            assert read_trim.get_tracking_id() == read.get_tracking_id()
+
+    if fname == "batch0.fast5":
+        # shared groups stay hard linked
+        with h5py.File(f5path_trim, "r") as f5_trim:
+            groups = list(f5_trim.values())
+            assert groups[0]["tracking_id"].id == groups[-1]["tracking_id"].id
+
+    os.remove(f5path_trim)
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip", "vbz"])
+@pytest.mark.parametrize("chunk_size", [None, 1000])
+def test_slice_signal_compression(compression, chunk_size):
+    f5path = os.path.join(test_data, "read0.fast5")
+    f5path_trim = f5path + ".tmp"
+    shutil.copy(f5path, f5path_trim)
+
+    with get_fast5_file(f5path_trim, mode="a") as f5:
+        read = next(f5.get_reads())
+        signal = read.get_raw_data()[500:]
+
+        slice_signal_in_read(read, start=500, compression=compression, chunk_size=chunk_size)
+
+        assert np.array_equal(read.get_raw_data(), signal)
+
+        dataset = read.handle[read.raw_dataset_name]
+        filters = {"none": [], "gzip": ["gzip"], "vbz": [str(VBZ.compression)]}
+        assert list(dataset._filters) == filters[compression]
+        if chunk_size is not None:
+            assert dataset.chunks == (chunk_size,)
+
+    os.remove(f5path_trim)
+
+
+def test_slice_signal_keeps_compression():
+    f5path = os.path.join(test_data, "read0.fast5")
+    f5path_trim = f5path + ".tmp"
+    shutil.copy(f5path, f5path_trim)
+
+    with get_fast5_file(f5path_trim, mode="a") as f5:
+        read = next(f5.get_reads())
+        dataset = read.handle[read.raw_dataset_name]
+        filters, chunks = dataset._filters, dataset.chunks
+
+        slice_signal_in_read(read, start=500)
+
+        dataset = read.handle[read.raw_dataset_name]
+        assert dataset._filters == filters
+        assert dataset.chunks == chunks
+
+    os.remove(f5path_trim)
+
+
+def test_raw_dataset_layout_errors():
+    with h5py.File(os.path.join(test_data, "read0.fast5"), "r") as f5:
+        dataset = f5["Raw/Reads/Read_4219/Signal"]
+        with pytest.raises(ValueError):
+            raw_dataset_layout(dataset, 100, compression="lzf")
+        with pytest.raises(ValueError):
+            raw_dataset_layout(dataset, 100, chunk_size=0)